@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Time `tea add` of P new files into an index that already holds N
+entries, and `tea rm` of the same files.
+
+    python3 bench/add_large_index.py 100000 10000
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, index_write, rm
+from lib.staging import TeaIndex, TeaIndexEntry, index_read
+from lib.repo_functions import TeaRepository, repo_create
+
+def bench(count, added):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        # The existing entries don't need files behind them
+        entries = [ TeaIndexEntry(ctime=(1700000000, 0), mtime=(1700000000, 0),
+                                  dev=2049, ino=1000 + i,
+                                  mode_type=0b1000, mode_perms=0o644,
+                                  uid=1000, gid=1000, fsize=i,
+                                  sha=f"{i:040x}",
+                                  flag_assume_valid=False, flag_stage=0,
+                                  name=f"old/dir_{i // 100}/file_{i}.txt")
+                    for i in range(count) ]
+        index_write(repo, TeaIndex(entries=entries))
+
+        paths = list()
+        for i in range(added):
+            name = os.path.join(path, "new", f"dir_{i // 100}", f"file_{i}.txt")
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, "w") as f:
+                f.write(f"{i}\n")
+            paths.append(name)
+
+        start = time.perf_counter()
+        add(repo, paths)
+        add_time = time.perf_counter() - start
+
+        assert len(index_read(repo).entries) == count + added
+
+        start = time.perf_counter()
+        rm(repo, paths, delete=False)
+        rm_time = time.perf_counter() - start
+
+        print(f"{added} paths into {count} entries: add {add_time:.2f}s, rm {rm_time:.2f}s")
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    added = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    bench(count, added)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Measure the wall-time speedup of `tea add -j N` on a synthetic tree.
+
+    python3 bench/add_parallel.py [files] [file_kb]
+"""
+
+import os
+import sys
+import time
+import random
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add
+from lib.repo_functions import TeaRepository, repo_create
+
+def make_tree(path, count, size):
+    files = list()
+    rng = random.Random(42)
+    words = [ b"tea", b"index", b"object", b"tree", b"commit", b"blob", b"pack", b"delta" ]
+
+    for i in range(count):
+        d = os.path.join(path, f"dir_{i % 64}")
+        os.makedirs(d, exist_ok=True)
+
+        name = os.path.join(d, f"file_{i}.txt")
+        with open(name, 'wb') as f:
+            f.write(b" ".join(rng.choice(words) for _ in range(size // 5))[:size])
+        files.append(name)
+
+    return files
+
+def bench(count, size):
+    cpus = os.cpu_count() or 1
+    jobs = sorted(set([ 1, 2, 4, 8, cpus ]))
+
+    print(f"{count} files of {size // 1024} KiB, {cpus} CPUs")
+    print(f"  {'jobs':>4} {'seconds':>8} {'speedup':>8}")
+
+    baseline = None
+    for j in jobs:
+        with tempfile.TemporaryDirectory() as path:
+            repo_create(path)
+            repo = TeaRepository(path)
+            files = make_tree(path, count, size)
+
+            start = time.perf_counter()
+            add(repo, files, jobs=j)
+            elapsed = time.perf_counter() - start
+
+            if (baseline is None):
+                baseline = elapsed
+
+            print(f"  {j:4} {elapsed:8.2f} {baseline / elapsed:7.2f}x")
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    size = (int(sys.argv[2]) if len(sys.argv) > 2 else 64) * 1024
+    bench(count, size)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Compare ignore-rule matching throughput, in paths per second, between
+the original matcher (fnmatch for every rule, every parent directory
+walked for every path) and the compiled rulesets.
+
+The rules are a root .teaignore of 40 patterns, negations included,
+and a .teaignore of 5 patterns in each of 200 directories.
+
+    python3 bench/check_ignore.py 100000
+"""
+
+import os
+import sys
+import time
+import random
+
+from fnmatch import fnmatch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.staging import TeaIgnore, TeaIgnoreRuleset, check_ignore
+
+def legacy_check_ignore_single(rules, path):
+    result = None
+
+    for (pattern, value) in rules:
+        if (fnmatch(path, pattern)):
+            result = value
+
+    return result
+
+def legacy_check_ignore(scoped, path):
+    parent = os.path.dirname(path)
+
+    while (True):
+        if (parent in scoped):
+            result = legacy_check_ignore_single(scoped[parent], path)
+            if (result != None):
+                return result
+        if (parent == ""):
+            break
+        parent = os.path.dirname(parent)
+
+    return False
+
+def make_rules(rng):
+    exts = [ "o", "a", "so", "pyc", "class", "tmp", "log", "bak", "swp", "out" ]
+
+    root = [ (f"*.{ext}", True) for ext in exts ]
+    root += [ (f"build{i}", True) for i in range(10) ]
+    root += [ (f"*/cache{i}/*", True) for i in range(10) ]
+    root += [ (f"keep{i}.log", False) for i in range(10) ]
+
+    scoped = { "": root }
+    for i in range(200):
+        dir_name = f"dir_{i}/sub_{i % 7}"
+        scoped[dir_name] = [ (f"{dir_name}/gen_{j}*", j % 4 != 0) for j in range(5) ]
+
+    return scoped
+
+def make_paths(rng, count):
+    exts = [ "c", "h", "py", "o", "log", "txt", "pyc", "md" ]
+    names = [ "main", "util", "gen_1", "gen_3", "keep3", "cache4", "file" ]
+
+    paths = list()
+    for _ in range(count):
+        parts = [ f"dir_{rng.randrange(300)}", f"sub_{rng.randrange(7)}" ]
+        parts += [ rng.choice([ "src", "lib", "cache4", "deep" ]) for _ in range(rng.randrange(3)) ]
+        parts.append(f"{rng.choice(names)}.{rng.choice(exts)}")
+        paths.append("/".join(parts))
+
+    return paths
+
+def bench(count):
+    rng = random.Random(7)
+    scoped = make_rules(rng)
+    paths = make_paths(rng, count)
+
+    start = time.perf_counter()
+    legacy = [ legacy_check_ignore(scoped, p) for p in paths ]
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rules = TeaIgnore(absolute=list(), scoped={ d: TeaIgnoreRuleset(r) for (d, r) in scoped.items() })
+    new = [ check_ignore(rules, p) for p in paths ]
+    new_time = time.perf_counter() - start
+
+    assert legacy == new, "compiled rules disagree with fnmatch"
+
+    print(f"{count} paths, {sum(new)} ignored")
+    print(f"  fnmatch:  {count / legacy_time:10.0f} paths/s")
+    print(f"  compiled: {count / new_time:10.0f} paths/s ({legacy_time / new_time:.1f}x)")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 100000 ]
+    for count in counts:
+        bench(count)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Time checking out a tree of N small files, loose then packed: the
+original one-object-at-a-time checkout, and the current one with 1 and
+4 jobs. Then compare the peak memory used to check out a single 64MB
+blob.
+
+    python3 bench/checkout.py 10000 100000
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, tree_from_index
+from lib.object_cache import object_caches
+from lib.repo_functions import TeaRepository, repo_create
+from lib.staging import index_read
+from lib.tea_object_function import object_read
+from lib.wrapper import repack, tree_checkout
+
+def legacy_tree_checkout(repo, tree, path):
+    for item in tree.items:
+        dest = os.path.join(path, item.path)
+
+        if (item.mode.startswith(b'04')):
+            os.mkdir(dest)
+            legacy_tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif (item.mode.startswith(b'10') or item.mode.startswith(b'12')):
+            with open(dest, 'wb') as f:
+                f.write(object_read(repo, item.sha).blobdata)
+
+def make_repo(path, names):
+    """ A repository holding the files names, with their tree. """
+
+    repo_create(path)
+    repo = TeaRepository(path)
+
+    for (name, data) in names.items():
+        full_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(data)
+
+    add(repo, [ os.path.join(path, name) for name in names ])
+
+    return (repo, tree_from_index(repo, index_read(repo)))
+
+def timed_checkout(repo, tree_sha, checkout, runs=3):
+    """
+    Check tree_sha out into a new directory: the best time it took, out
+    of runs (file creation times vary a lot from one run to the next).
+    """
+
+    best = None
+
+    for _ in range(runs):
+        dest = tempfile.mkdtemp()
+
+        try:
+            # Start cold: the object cache would hold the blobs otherwise
+            object_caches.pop(repo.teadir, None)
+            start = time.perf_counter()
+            checkout(repo, object_read(repo, tree_sha), dest)
+            elapsed = time.perf_counter() - start
+        finally:
+            shutil.rmtree(dest)
+
+        best = min(best or elapsed, elapsed)
+
+    return best
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        names = { f"dir_{i // 1000}/sub_{i // 50}/file_{i}.txt": b"line %d\n" % i * (i % 64 + 1)
+                  for i in range(count) }
+        (repo, tree_sha) = make_repo(path, names)
+
+        print(f"{count} files")
+
+        for label in [ "loose", "packed" ]:
+            if (label == "packed"):
+                repack(repo)
+
+            legacy = timed_checkout(repo, tree_sha, legacy_tree_checkout)
+            print(f"  {label:6} original: {legacy:6.2f}s ({count / legacy:7.0f} files/s)")
+
+            for jobs in [ 1, 4 ]:
+                new = timed_checkout(repo, tree_sha, lambda r, t, d: tree_checkout(r, t, d, jobs=jobs))
+                print(f"  {label:6} -j{jobs}:      {new:6.2f}s ({count / new:7.0f} files/s)")
+
+def bench_memory():
+    with tempfile.TemporaryDirectory() as path:
+        (repo, tree_sha) = make_repo(path, { "big/blob.bin": os.urandom(1 << 20) * 64 })
+
+        print("one 64MB blob")
+
+        for (label, checkout) in [ ("original", legacy_tree_checkout), ("streamed", tree_checkout) ]:
+            tracemalloc.start()
+            timed_checkout(repo, tree_sha, checkout, runs=1)
+            (_, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"  {label}: peak {peak / 2**20:6.1f}MB")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
+    bench_memory()
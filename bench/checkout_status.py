@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Check a commit of N files out into an emptied worktree, then time the
+worktree part of `tea status` and count the files it hashes: with the
+index the files were committed from (stale stat data), and with the
+index checkout writes.
+
+    python3 bench/checkout_status.py 10000 100000
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import lib.staging
+
+from lib.commit import add, index_from_checkout, index_read, index_write, tree_from_index
+from lib.repo_functions import TeaRepository, repo_create
+from lib.staging import cmd_status_index_worktree
+from lib.tea_object_function import object_read
+from lib.wrapper import tree_checkout
+
+def make_files(path, count):
+    paths = list()
+
+    for i in range(count):
+        name = os.path.join(path, f"dir_{i // 1000}", f"sub_{i // 20}", f"file_{i}.txt")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(b"x\n")
+        paths.append(name)
+
+    return paths
+
+def status(repo):
+    """ Time one status run, and count the files it hashed. """
+
+    hashed = 0
+    status_hash_one = lib.staging.status_hash_one
+
+    def counting_hash_one(path):
+        nonlocal hashed
+        hashed += 1
+        return status_hash_one(path)
+
+    lib.staging.status_hash_one = counting_hash_one
+    try:
+        index = index_read(repo)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            cmd_status_index_worktree(repo, index)
+        return (time.perf_counter() - start, hashed)
+    finally:
+        lib.staging.status_hash_one = status_hash_one
+
+def checkout(repo, tree, write_index):
+    for name in os.listdir(repo.worktree):
+        if (name != ".tea"):
+            shutil.rmtree(os.path.join(repo.worktree, name))
+
+    files = tree_checkout(repo, object_read(repo, tree), repo.worktree)
+
+    if (write_index):
+        index_from_checkout(repo, tree, files)
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        add(repo, make_files(path, count))
+        index = index_read(repo)
+        tree = tree_from_index(repo, index)
+        index_write(repo, index)
+        committed = index_read(repo)
+
+        print(f"{count} files")
+
+        for (label, write_index) in [ ("stale index", False), ("checkout index", True) ]:
+            if (not write_index):
+                index_write(repo, committed)
+
+            checkout(repo, tree, write_index)
+            (elapsed, hashed) = status(repo)
+            print(f"  {label:14}: status {elapsed * 1000:8.1f}ms, {hashed} files hashed")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
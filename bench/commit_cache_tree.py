@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Measure how long commit spends writing trees, without a cache tree
+(every directory rebuilt) and with one, after a single file changed.
+
+    python3 bench/commit_cache_tree.py 10000 100000
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import tree_from_index
+from lib.staging import TeaIndex, TeaIndexEntry, cache_tree_invalidate
+from lib.repo_functions import TeaRepository, repo_create
+
+def make_entries(count):
+    entries = list()
+
+    for i in range(count):
+        entries.append(TeaIndexEntry(ctime=(1700000000, 0), mtime=(1700000000, 0),
+                                     dev=2049, ino=1000 + i,
+                                     mode_type=0b1000, mode_perms=0o644,
+                                     uid=1000, gid=1000, fsize=i,
+                                     sha=f"{i:040x}",
+                                     flag_assume_valid=False, flag_stage=0,
+                                     name=f"src/pkg_{i // 1000}/mod_{i // 100}/file_{i}.py"))
+
+    entries.sort(key=lambda e: e.name)
+    return entries
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+        index = TeaIndex(entries=make_entries(count))
+
+        start = time.perf_counter()
+        full = tree_from_index(repo, index)
+        full_time = time.perf_counter() - start
+
+        changed = index.entries[count // 2]
+        changed.sha = f"{count:040x}"
+        cache_tree_invalidate(index.cache_tree, changed.name)
+
+        start = time.perf_counter()
+        tree_from_index(repo, index)
+        cached_time = time.perf_counter() - start
+
+        assert index.cache_tree.sha != full
+
+        print(f"{count} files, one changed: full {full_time:.3f}s, cached {cached_time * 1000:.1f}ms")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Measure index load time and peak memory, with eagerly decoded entries
+(the previous TeaIndexEntry, a plain object with a __dict__) against the
+lazy, __slots__ based entries read from the mapped index.
+
+Each measurement runs in a fresh interpreter so peak RSS is its own.
+"names" only lists the entries' names (ls-files, status); "all" also
+touches every field (commit, index rewrite).
+
+    python3 bench/index_memory.py 100000 1000000
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import index_write
+from lib.staging import INDEX_ENTRY, INDEX_HEADER, TeaIndex, TeaIndexEntry, index_entry_size, index_read
+from lib.repo_functions import TeaRepository, repo_create
+
+class LegacyIndexEntry(object):
+    def __init__(self, **kwargs):
+        for (k, v) in kwargs.items():
+            setattr(self, k, v)
+
+def legacy_index_read(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
+
+    (_, _, count) = INDEX_HEADER.unpack_from(raw, 0)
+    entries = list()
+
+    idx = INDEX_HEADER.size
+    for _ in range(count):
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = INDEX_ENTRY.unpack_from(raw, idx)
+
+        name_start = idx + INDEX_ENTRY.size
+        name_end = name_start + (flags & 0xFFF)
+
+        entries.append(LegacyIndexEntry(
+            ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns),
+            dev=dev, ino=ino, mode_type=mode >> 12, mode_perms=mode & 0o777,
+            uid=uid, gid=gid, fsize=fsize, sha=sha.hex(),
+            flag_assume_valid=(flags & 0x8000) != 0, flag_stage=flags & 0x3000,
+            name=raw[name_start:name_end].decode('utf8')))
+
+        idx += index_entry_size(name_end - name_start)
+
+    return entries
+
+def measure(path, reader, access):
+    """ Runs in the child: prints load seconds and peak RSS in KiB. """
+
+    start = time.perf_counter()
+
+    if (reader == "legacy"):
+        entries = legacy_index_read(os.path.join(path, ".tea", "index"))
+    else:
+        entries = index_read(TeaRepository(path)).entries
+
+    total = 0
+    for e in entries:
+        total += len(e.name)
+        if (access == "all"):
+            total += e.fsize + e.mtime[0] + len(e.sha)
+
+    elapsed = time.perf_counter() - start
+    print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def make_index(path, count):
+    repo_create(path)
+    repo = TeaRepository(path)
+
+    entries = [ TeaIndexEntry(ctime=(1700000000, 0), mtime=(1700000000, 0),
+                              dev=2049, ino=1000 + i,
+                              mode_type=0b1000, mode_perms=0o644,
+                              uid=1000, gid=1000, fsize=i,
+                              sha=f"{i:040x}",
+                              flag_assume_valid=False, flag_stage=0,
+                              name=f"src/module_{i // 100}/file_{i}.py")
+                for i in range(count) ]
+
+    index_write(repo, TeaIndex(entries=entries))
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        # Built in a child too: the parent's peak RSS would otherwise
+        # carry over into the measuring children's ru_maxrss
+        subprocess.run([ sys.executable, __file__, "--make", path, str(count) ], check=True)
+        size = os.path.getsize(os.path.join(path, ".tea", "index"))
+
+        print(f"{count} entries, {size / 1024**2:.1f} MiB index")
+        print(f"  {'':14} {'seconds':>8} {'peak MiB':>9}")
+
+        for access in [ "names", "all" ]:
+            for reader in [ "legacy", "lazy" ]:
+                out = subprocess.run([ sys.executable, __file__, "--child", path, reader, access ],
+                                     check=True, capture_output=True, text=True).stdout.split()
+                print(f"  {reader + ' ' + access:14} {float(out[0]):8.2f} {int(out[1]) / 1024:9.1f}")
+
+if __name__ == '__main__':
+    if (sys.argv[1:2] == [ "--child" ]):
+        measure(*sys.argv[2:5])
+    elif (sys.argv[1:2] == [ "--make" ]):
+        make_index(sys.argv[2], int(sys.argv[3]))
+    else:
+        counts = [ int(c) for c in sys.argv[1:] ] or [ 100000, 1000000 ]
+        for count in counts:
+            bench(count)
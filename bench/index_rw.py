@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of index serialization and parsing.
+
+Compares the struct-based index_serialize/index_read with the original
+per-field implementation (kept below for reference), and checks that
+both produce byte-identical index files.
+
+    python3 bench/index_rw.py 10000 100000 1000000
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+
+from math import ceil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import index_serialize
+from lib.repo_functions import TeaRepository, repo_create, repo_file
+from lib.staging import TeaIndex, TeaIndexEntry, index_read
+
+def legacy_index_write(f, index):
+    f.write(b"DIRC")
+    f.write(index.version.to_bytes(4, "big"))
+    f.write(len(index.entries).to_bytes(4, "big"))
+
+    idx = 0
+    for e in index.entries:
+        f.write(e.ctime[0].to_bytes(4, "big"))
+        f.write(e.ctime[1].to_bytes(4, "big"))
+        f.write(e.mtime[0].to_bytes(4, "big"))
+        f.write(e.mtime[1].to_bytes(4, "big"))
+        f.write(e.dev.to_bytes(4, "big"))
+        f.write(e.ino.to_bytes(4, "big"))
+        mode = (e.mode_type << 12) | e.mode_perms
+        f.write(mode.to_bytes(4, "big"))
+        f.write(e.uid.to_bytes(4, "big"))
+        f.write(e.gid.to_bytes(4, "big"))
+        f.write(e.fsize.to_bytes(4, "big"))
+        f.write(int(e.sha, 16).to_bytes(20, "big"))
+
+        flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+        name_bytes = e.name.encode("utf8")
+        name_length = min(len(name_bytes), 0xFFF)
+        f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+        f.write(name_bytes)
+        f.write((0).to_bytes(1, "big"))
+
+        idx += 62 + len(name_bytes) + 1
+        if (idx % 8 != 0):
+            pad = 8 - (idx % 8)
+            f.write((0).to_bytes(pad, "big"))
+            idx += pad
+
+def legacy_index_parse(raw):
+    count = int.from_bytes(raw[8:12], 'big')
+    entries = list()
+
+    content = raw[12:]
+    idx = 0
+    for _ in range(0, count):
+        ctime_s = int.from_bytes(content[idx : idx+4], 'big')
+        ctime_ns = int.from_bytes(content[idx+4 : idx+8], 'big')
+        mtime_s = int.from_bytes(content[idx+8 : idx+12], 'big')
+        mtime_ns = int.from_bytes(content[idx+12 : idx+16], 'big')
+        dev = int.from_bytes(content[idx+16 : idx+20], 'big')
+        ino = int.from_bytes(content[idx+20 : idx+24], 'big')
+        mode = int.from_bytes(content[idx+26 : idx+28], 'big')
+        uid = int.from_bytes(content[idx+28 : idx+32], 'big')
+        gid = int.from_bytes(content[idx+32 : idx+36], 'big')
+        fsize = int.from_bytes(content[idx+36 : idx+40], 'big')
+        sha = format(int.from_bytes(content[idx+40 : idx+60], 'big'), '040x')
+        flags = int.from_bytes(content[idx+60 : idx+62], 'big')
+        name_length = flags & 0b0000111111111111
+
+        idx += 62
+        raw_name = content[idx : idx+name_length]
+        idx += name_length + 1
+        idx = 8 * ceil(idx / 8)
+
+        entries.append(TeaIndexEntry(
+            ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=dev, ino=ino,
+            mode_type=mode >> 12, mode_perms=mode & 0o777, uid=uid, gid=gid, fsize=fsize,
+            sha=sha, flag_assume_valid=(flags & 0x8000) != 0, flag_stage=flags & 0x3000,
+            name=raw_name.decode('utf8')
+        ))
+
+    return TeaIndex(version=2, entries=entries)
+
+def make_index(count):
+    rng = random.Random(count)
+    entries = list()
+
+    for i in range(count):
+        depth = rng.randint(1, 6)
+        name = "/".join(f"dir_{rng.randint(0, 30)}" for _ in range(depth)) + f"/file_{i}.py"
+        entries.append(TeaIndexEntry(
+            ctime=(1700000000 + i, rng.randint(0, 10**9 - 1)),
+            mtime=(1700000000 + i, rng.randint(0, 10**9 - 1)),
+            dev=2049, ino=rng.randint(0, 2**32 - 1),
+            mode_type=0b1000, mode_perms=0o644,
+            uid=1000, gid=1000, fsize=rng.randint(0, 2**20),
+            sha="%040x" % rng.getrandbits(160),
+            flag_assume_valid=False, flag_stage=False,
+            name=name
+        ))
+
+    entries.sort(key=lambda e: e.name)
+    return TeaIndex(entries=entries)
+
+def timed(function, *args):
+    start = time.perf_counter()
+    ret = function(*args)
+    return (ret, time.perf_counter() - start)
+
+def bench(count):
+    index = make_index(count)
+
+    legacy = io.BytesIO()
+    (_, legacy_write) = timed(legacy_index_write, legacy, index)
+    legacy = legacy.getvalue()
+
+    (new, new_write) = timed(index_serialize, index)
+    # The original writer predates the trailing checksum
+    assert bytes(new[:-20]) == legacy, "index_serialize output differs from the original writer"
+
+    (_, legacy_read) = timed(legacy_index_parse, legacy)
+
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        with open(repo_file(repo, "index"), "wb") as f:
+            f.write(new)
+
+        (parsed, new_read) = timed(index_read, repo)
+
+    assert [ e.name for e in parsed.entries ] == [ e.name for e in index.entries ]
+    assert [ e.sha for e in parsed.entries ] == [ e.sha for e in index.entries ]
+
+    print(f"{count} entries, {len(legacy) / 1024**2:.1f} MiB, output identical")
+    print(f"  write: {legacy_write:7.3f}s -> {new_write:7.3f}s ({legacy_write / new_write:.1f}x)")
+    print(f"  read:  {legacy_read:7.3f}s -> {new_read:7.3f}s ({legacy_read / new_read:.1f}x)")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10**4, 10**5, 10**6 ]
+    for count in counts:
+        bench(count)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Compare index size, read and write time between format versions 2 and 4
+on a deep, monorepo-like tree where names share long prefixes.
+
+    python3 bench/index_v4.py 100000 1000000
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import index_write
+from lib.staging import TeaIndex, TeaIndexEntry, index_read
+from lib.repo_functions import TeaRepository, repo_create
+
+def make_entries(count):
+    entries = list()
+
+    for i in range(count):
+        name = "services/platform/{}/src/main/java/com/example/{}/{}/Handler{}.java".format(
+            f"team_{i // 10000}", f"component_{i // 500}", f"module_{i // 50}", i)
+
+        entries.append(TeaIndexEntry(ctime=(1700000000, 0), mtime=(1700000000, 0),
+                                     dev=2049, ino=1000 + i,
+                                     mode_type=0b1000, mode_perms=0o644,
+                                     uid=1000, gid=1000, fsize=i,
+                                     sha=f"{i:040x}",
+                                     flag_assume_valid=False, flag_stage=0,
+                                     name=name))
+
+    return entries
+
+def bench(count):
+    entries = make_entries(count)
+    print(f"{count} entries")
+    print(f"  {'':8} {'MiB':>8} {'read s':>8} {'write s':>8}")
+
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+        index_file = os.path.join(path, ".tea", "index")
+
+        for version in [ 2, 4 ]:
+            index = TeaIndex(version=version, entries=entries)
+
+            start = time.perf_counter()
+            index_write(repo, index)
+            write = time.perf_counter() - start
+
+            start = time.perf_counter()
+            names = [ e.name for e in index_read(repo).entries ]
+            read = time.perf_counter() - start
+
+            assert names == [ e.name for e in entries ]
+
+            print(f"  {'v' + str(version):8} {os.path.getsize(index_file) / 1024**2:8.1f} {read:8.2f} {write:8.2f}")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 100000, 1000000 ]
+    for count in counts:
+        bench(count)
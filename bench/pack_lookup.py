@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Compare object lookup latency between loose objects and a pack with its
+index.
+
+Builds a throwaway repository with N small blobs, times object_resolve
+(full and abbreviated SHAs) and object_read_raw on the loose objects,
+repacks, then times the same lookups again.
+
+    python3 bench/pack_lookup.py 100000 1000000
+"""
+
+import os
+import sys
+import time
+import zlib
+import random
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.pack import pack_write
+from lib.repo_functions import TeaRepository, repo_create, repo_file
+from lib.tea_object_function import object_info, object_loose_list, object_read_into, object_read_raw, object_resolve
+
+LOOKUPS = 2000
+
+def make_loose_objects(repo, count):
+    shas = list()
+
+    for i in range(count):
+        data = f"blob number {i}\n".encode()
+        raw = b'blob ' + str(len(data)).encode() + b'\x00' + data
+        sha = hashlib.sha1(raw).hexdigest()
+
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(raw))
+
+        shas.append(sha)
+
+    return shas
+
+def time_lookups(repo, names, function):
+    start = time.perf_counter()
+    for name in names:
+        function(repo, name)
+    return (time.perf_counter() - start) / len(names) * 10**6
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+        shas = make_loose_objects(repo, count)
+
+        sample = random.sample(shas, min(LOOKUPS, count))
+        short = [ sha[0:10] for sha in sample ]
+
+        results = dict()
+        for store in [ "loose", "pack" ]:
+            if (store == "pack"):
+                objects = [ (sha, *object_info(repo, sha)) for sha in object_loose_list(repo) ]
+                pack_write(repo, objects, lambda sha, out: object_read_into(repo, sha, out))
+
+                for sha in shas:
+                    os.unlink(repo_file(repo, "objects", sha[0:2], sha[2:]))
+
+            results[store] = (
+                time_lookups(repo, sample, object_resolve),
+                time_lookups(repo, short, object_resolve),
+                time_lookups(repo, sample, object_read_raw),
+            )
+
+        print(f"{count} objects, {len(sample)} lookups (us per lookup)")
+        print(f"  {'':6} {'resolve':>10} {'resolve-10':>10} {'read':>10}")
+        for (store, times) in results.items():
+            print(f"  {store:6} {times[0]:10.1f} {times[1]:10.1f} {times[2]:10.1f}")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 100000, 1000000 ]
+    for count in counts:
+        bench(count)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Repack N versions of a 200KB text file, each a few lines away from the
+first, and time object_info against a full read on them. Most of them
+are stored as deltas large enough to be deflated with dynamic Huffman
+tables. object_info must agree with the full read on every object.
+
+    python3 bench/pack_object_info.py 50
+"""
+
+import io
+import os
+import sys
+import time
+import random
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.pack import PACK_OBJ_OFS_DELTA, pack_list
+from lib.repo_functions import TeaRepository, repo_create
+from lib.tea_object import TeaBlob
+from lib.tea_object_function import object_info, object_loose_list, object_read_raw, object_write
+from lib.wrapper import repack
+
+def make_blobs(repo, count):
+    base = [ f"line {i} {random.random()}\n" for i in range(5000) ]
+
+    for _ in range(count):
+        lines = list(base)
+        for _ in range(60):
+            lines[random.randrange(len(lines))] = f"changed {random.random()}\n"
+        object_write(TeaBlob("".join(lines).encode()), repo)
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        make_blobs(repo, count)
+        shas = object_loose_list(repo)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            repack(repo)
+
+        pack = pack_list(repo)[0]
+        deltas = sum(pack.entry_header(pack.lookup(sha))[0] == PACK_OBJ_OFS_DELTA for sha in shas)
+
+        start = time.perf_counter()
+        infos = [ object_info(repo, sha) for sha in shas ]
+        info_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        raws = [ object_read_raw(repo, sha) for sha in shas ]
+        read_time = time.perf_counter() - start
+
+        for (sha, info, (fmt, data)) in zip(shas, infos, raws):
+            assert info == (fmt, len(data)), f"object_info({sha}) = {info}, not {(fmt, len(data))}"
+
+        print(f"{len(shas)} objects, {deltas} deltas: "
+              f"object_info {info_time / len(shas) * 10**6:.0f}us, full read {read_time / len(shas) * 10**6:.0f}us per object")
+
+if __name__ == '__main__':
+    random.seed(1)
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Time `tea status` on an unchanged tree of N tracked files, then after
+modifying one of them, with and without the fsmonitor daemon (the
+untracked cache is on in both cases).
+
+    python3 bench/status_fsmonitor.py 10000 100000
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, index_write
+from lib.staging import cmd_status_index_worktree, index_read
+from lib.repo_functions import TeaRepository, repo_create
+
+TEA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tea')
+
+def make_files(path, prefix, count):
+    paths = list()
+
+    for i in range(count):
+        name = os.path.join(path, prefix, f"dir_{i // 1000}", f"sub_{i // 20}", f"file_{i}.txt")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(b"x\n")
+        paths.append(name)
+
+    return paths
+
+def run(repo):
+    """ One status run, its time and output. """
+
+    index = index_read(repo)
+    out = io.StringIO()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        if (cmd_status_index_worktree(repo, index)):
+            index_write(repo, index, opportunistic=True)
+
+    return (time.perf_counter() - start, out.getvalue())
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+        repo.conf.set("core", "untrackedCache", "true")
+
+        paths = make_files(path, "src", count)
+        add(repo, paths)
+
+        # Out of the untracked cache's racy window
+        time.sleep(1.1)
+
+        print(f"{count} tracked files, {count // 20} directories")
+
+        for fsmonitor in [ False, True ]:
+            repo.conf.set("core", "fsmonitor", str(fsmonitor).lower())
+            if (fsmonitor):
+                subprocess.run([ TEA, "fsmonitor", "--detach" ], cwd=path, check=True)
+
+            try:
+                # The first run records the token
+                run(repo)
+                run(repo)
+                (clean, _) = run(repo)
+
+                with open(paths[count // 2], "ab") as f:
+                    f.write(b"y\n")
+                (dirty, out) = run(repo)
+                assert "modified:" in out
+
+                with open(paths[count // 2], "wb") as f:
+                    f.write(b"x\n")
+                run(repo)
+            finally:
+                if (fsmonitor):
+                    subprocess.run([ TEA, "fsmonitor", "--stop" ], cwd=path, check=True)
+
+            print(f"  fsmonitor={str(fsmonitor).lower():5}: clean {clean * 1000:7.1f}ms, one file modified {dirty * 1000:7.1f}ms")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
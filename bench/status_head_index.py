@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Time the staged-changes part of `tea status` on a tree of N files, one
+of which is staged modified: the original comparison (HEAD flattened
+into a dict), the tree diff without a cache tree, and with one.
+
+    python3 bench/status_head_index.py 10000 100000
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, index_write, tree_from_index
+from lib.staging import index_read, status_diff_tree_index
+from lib.repo_functions import TeaRepository, repo_create
+from lib.tea_object_function import object_find, object_read
+
+def make_files(path, count):
+    paths = list()
+
+    for i in range(count):
+        name = os.path.join(path, f"dir_{i // 1000}", f"sub_{i // 20}", f"file_{i}.txt")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(b"x\n")
+        paths.append(name)
+
+    return paths
+
+def legacy_tree_to_dict(repo, ref, prefix=''):
+    ret = dict()
+    tree_sha = object_find(repo, ref, fmt=b'tree')
+    tree = object_read(repo, tree_sha)
+
+    for leaf in tree.items:
+        full_path = os.path.join(prefix, leaf.path)
+
+        if (leaf.mode.startswith(b'04')):
+            ret.update(legacy_tree_to_dict(repo, leaf.sha, full_path))
+        else:
+            ret[full_path] = leaf.sha
+
+    return ret
+
+def legacy_status_head_index(repo, tree_sha, index):
+    ret = list()
+
+    head = legacy_tree_to_dict(repo, tree_sha)
+    for entry in index.entries:
+        if (entry.name in head):
+            if (head[entry.name] != entry.sha):
+                ret.append(("modified:", entry.name))
+            del head[entry.name]
+        else:
+            ret.append(("added:   ", entry.name))
+
+    for name in head.keys():
+        ret.append(("deleted: ", name))
+
+    return ret
+
+def timed(f):
+    start = time.perf_counter()
+    ret = f()
+    return (ret, time.perf_counter() - start)
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        paths = make_files(path, count)
+        add(repo, paths)
+
+        index = index_read(repo)
+        head = tree_from_index(repo, index)
+
+        with open(paths[count // 2], "ab") as f:
+            f.write(b"y\n")
+        add(repo, [ paths[count // 2] ])
+
+        # add invalidated the directories above the file only
+        index = index_read(repo)
+        tree_from_index(repo, index)
+        index_write(repo, index)
+
+        index = index_read(repo)
+        (legacy, legacy_time) = timed(lambda: legacy_status_head_index(repo, head, index))
+
+        index = index_read(repo)
+        index.cache_tree = None
+        (no_cache, no_cache_time) = timed(lambda: list(status_diff_tree_index(repo, head, None, index.entries, 0, "")))
+
+        index = index_read(repo)
+        (cached, cached_time) = timed(lambda: list(status_diff_tree_index(repo, head, index.cache_tree, index.entries, 0, "")))
+
+        assert legacy == no_cache == cached == [ ("modified:", os.path.relpath(paths[count // 2], path)) ]
+
+        print(f"{count} files, one staged change")
+        print(f"  HEAD as a dict:          {legacy_time * 1000:8.1f}ms")
+        print(f"  tree diff:               {no_cache_time * 1000:8.1f}ms")
+        print(f"  tree diff + cache tree:  {cached_time * 1000:8.1f}ms")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
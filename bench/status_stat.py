@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Time the worktree part of `tea status` on N files: right after adding
+them, after touching every file (new mtimes, same contents), and once
+more after that.
+
+    python3 bench/status_stat.py 10000
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, index_write
+from lib.staging import cmd_status_index_worktree, index_read
+from lib.repo_functions import TeaRepository, repo_create
+
+def status(repo):
+    index = index_read(repo)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        refreshed = cmd_status_index_worktree(repo, index)
+
+    # Older versions neither refresh nor return anything
+    if (refreshed):
+        index_write(repo, index, opportunistic=True)
+
+    return time.perf_counter() - start
+
+def bench(count, size):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        paths = list()
+        for i in range(count):
+            name = os.path.join(path, f"dir_{i // 100}", f"file_{i}.txt")
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name, "wb") as f:
+                f.write(b"%d\n" % i * (size // 8))
+            paths.append(name)
+
+        add(repo, paths)
+
+        # Let the files' timestamps fall behind the index's
+        time.sleep(0.01)
+        clean = status(repo)
+
+        for (root, _, files) in os.walk(path):
+            if (".tea" not in root):
+                for f in files:
+                    os.utime(os.path.join(root, f))
+
+        # Same, for the index written by the first status after touching
+        time.sleep(0.01)
+        touched = status(repo)
+        time.sleep(0.01)
+        again = status(repo)
+
+        print(f"{count} files of {size} bytes: clean {clean:.2f}s, touched {touched:.2f}s, again {again:.2f}s")
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 16384
+    bench(count, size)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Time repeated `tea status` runs on an unchanged tree, with and without
+core.untrackedCache: the untracked-file scan alone, and the whole
+worktree part of status.
+
+    python3 bench/status_untracked_cache.py 10000 100000
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, index_write
+from lib.staging import cmd_status_index_worktree, index_read, status_untracked, teaignore_read
+from lib.repo_functions import TeaRepository, repo_create
+
+def make_files(path, prefix, count):
+    paths = list()
+
+    for i in range(count):
+        name = os.path.join(path, prefix, f"dir_{i // 1000}", f"sub_{i // 20}", f"file_{i}.txt")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(b"x\n")
+        paths.append(name)
+
+    return paths
+
+def run(repo):
+    """ One status run: untracked scan time, whole status time. """
+
+    index = index_read(repo)
+    ignore = teaignore_read(repo, index)
+
+    start = time.perf_counter()
+    status_untracked(repo, index, ignore)
+    scan = time.perf_counter() - start
+
+    index = index_read(repo)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if (cmd_status_index_worktree(repo, index)):
+            index_write(repo, index, opportunistic=True)
+    whole = time.perf_counter() - start
+
+    return (scan, whole)
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        add(repo, make_files(path, "src", count))
+        make_files(path, "scratch", count // 100)
+
+        # Out of the untracked cache's racy window
+        time.sleep(1.1)
+
+        print(f"{count} tracked files, {count // 20} directories")
+
+        for enabled in [ "false", "true" ]:
+            repo.conf.set("core", "untrackedCache", enabled)
+            run(repo)
+            (scan, whole) = run(repo)
+            print(f"  untrackedCache={enabled:5}: scan {scan * 1000:7.1f}ms, status {whole * 1000:7.1f}ms")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
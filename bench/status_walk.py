@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Time the worktree part of `tea status` on a tree of N tracked files,
+with an ignored build directory of N more files and an untracked
+directory of N / 10 files.
+
+    python3 bench/status_walk.py 10000 100000
+"""
+
+import io
+import os
+import sys
+import time
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import index_write
+from lib.staging import TeaIndex, TeaIndexEntry, cmd_status_index_worktree, index_read
+from lib.repo_functions import TeaRepository, repo_create
+from lib.tea_object import TeaBlob
+from lib.tea_object_function import object_write
+
+def make_files(path, prefix, count):
+    names = list()
+
+    for i in range(count):
+        name = f"{prefix}/dir_{i // 100}/file_{i}.txt"
+        full_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, "wb") as f:
+            f.write(b"x\n")
+        names.append(name)
+
+    return names
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        with open(os.path.join(path, ".teaignore"), "wb") as f:
+            f.write(b"build\n")
+
+        shas = { ".teaignore": object_write(TeaBlob(b"build\n"), repo) }
+        file_sha = object_write(TeaBlob(b"x\n"), repo)
+
+        entries = list()
+        for name in [ ".teaignore" ] + make_files(path, "src", count):
+            stat = os.stat(os.path.join(path, name))
+            entries.append(TeaIndexEntry(ctime=divmod(stat.st_ctime_ns, 10**9),
+                                         mtime=divmod(stat.st_mtime_ns, 10**9),
+                                         dev=stat.st_dev, ino=stat.st_ino,
+                                         mode_type=0b1000, mode_perms=0o644,
+                                         uid=stat.st_uid, gid=stat.st_gid,
+                                         fsize=stat.st_size,
+                                         sha=shas.get(name, file_sha),
+                                         flag_assume_valid=False, flag_stage=0,
+                                         name=name))
+
+        entries.sort(key=lambda e: e.name)
+        time.sleep(0.01)
+        index_write(repo, TeaIndex(entries=entries))
+
+        make_files(path, "build", count)
+        make_files(path, "untracked", count // 10)
+
+        index = index_read(repo)
+        out = io.StringIO()
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            cmd_status_index_worktree(repo, index)
+        elapsed = time.perf_counter() - start
+
+        lines = out.getvalue().count("\n")
+        print(f"{count} tracked files: {elapsed:.2f}s, {lines} lines of output")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
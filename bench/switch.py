@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Time `tea switch` between two branches of a repository of N files that
+differ in 10 of them, against checking out the whole target commit.
+
+    python3 bench/switch.py 10000 100000
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.commit import add, commit_create, index_write, tree_from_index
+from lib.refs_tags_branch import ref_create
+from lib.repo_functions import TeaRepository, repo_create
+from lib.staging import index_read
+from lib.switch import switch
+from lib.tea_object_function import object_read
+from lib.wrapper import tree_checkout
+
+def make_files(path, count):
+    paths = list()
+
+    for i in range(count):
+        name = os.path.join(path, f"dir_{i // 1000}", f"sub_{i // 20}", f"file_{i}.txt")
+        os.makedirs(os.path.dirname(name), exist_ok=True)
+        with open(name, "wb") as f:
+            f.write(b"x\n")
+        paths.append(name)
+
+    return paths
+
+def make_commit(repo, branch, parent):
+    index = index_read(repo)
+    tree = tree_from_index(repo, index)
+    index_write(repo, index)
+
+    commit = commit_create(repo, tree, parent, "bench <bench@example.com>", datetime.now(), branch)
+    ref_create(repo, f"heads/{branch}", commit)
+
+    return commit
+
+def bench(count):
+    with tempfile.TemporaryDirectory() as path:
+        repo_create(path)
+        repo = TeaRepository(path)
+
+        paths = make_files(path, count)
+        add(repo, paths)
+        base = make_commit(repo, "main", None)
+
+        changed = paths[::count // 10]
+        for name in changed:
+            with open(name, "ab") as f:
+                f.write(b"y\n")
+        add(repo, changed)
+        make_commit(repo, "topic", base)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            times = list()
+            for branch in [ "main", "topic", "main" ]:
+                start = time.perf_counter()
+                switch(repo, branch)
+                times.append(time.perf_counter() - start)
+
+        dest = tempfile.mkdtemp()
+        try:
+            start = time.perf_counter()
+            tree_checkout(repo, object_read(repo, object_read(repo, base).kvlm[b"tree"].decode("ascii")), dest)
+            full = time.perf_counter() - start
+        finally:
+            shutil.rmtree(dest)
+
+        print(f"{count} files, {len(changed)} changed between the branches")
+        print(f"  full checkout: {full * 1000:8.1f}ms")
+        print(f"  switch:        {min(times) * 1000:8.1f}ms")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 10000, 100000 ]
+    for count in counts:
+        bench(count)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Compare parsing and serializing a tree of N entries between the
+original code (a hex string per leaf, one slice per field, `ret +=`
+serialization) and the current one, along with the memory the parsed
+leaves take.
+
+    python3 bench/tree_parse.py 1000 100000
+"""
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from lib.tea_object import TeaTree
+from lib.trees_checkout import tree_leaf_sort_key, tree_parse, tree_serialize
+
+class LegacyTreeLeaf(object):
+    def __init__(self, mode, path, sha):
+        self.mode = mode
+        self.path = path
+        self.sha  = sha
+
+def legacy_tree_parse_one(raw, start=0):
+    x = raw.find(b' ', start)
+
+    mode = raw[start:x]
+    if (len(mode) == 5):
+        mode = b" " + mode
+
+    y = raw.find(b'\x00', x)
+    path = raw[x+1:y]
+    sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
+
+    return (y+21, LegacyTreeLeaf(mode, path.decode("utf8"), sha))
+
+def legacy_tree_parse(raw):
+    pos = 0
+    ret = list()
+
+    while (pos < len(raw)):
+        pos, data = legacy_tree_parse_one(raw, pos)
+        ret.append(data)
+
+    return ret
+
+def legacy_tree_serialize(items):
+    items.sort(key=tree_leaf_sort_key)
+
+    ret = b''
+    for i in items:
+        ret += i.mode
+        ret += b' '
+        ret += i.path.encode("utf8")
+        ret += b'\x00'
+        ret += int(i.sha, 16).to_bytes(20, byteorder="big")
+
+    return ret
+
+def make_tree(count):
+    rng = random.Random(3)
+    names = sorted(f"file_{i:06}.txt" for i in range(count))
+
+    return b"".join(b"100644 %s\x00%s" % (name.encode("utf8"), rng.randbytes(20)) for name in names)
+
+def measure(parse, raw):
+    """ Parse raw: the leaves, the time it took, and their size. """
+
+    # Tracing allocations slows everything down: time a separate run
+    start = time.perf_counter()
+    parse(raw)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    items = parse(raw)
+    (size, _) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return (items, elapsed, size)
+
+def bench(count):
+    raw = make_tree(count)
+
+    (legacy_items, legacy_parse, legacy_size) = measure(legacy_tree_parse, raw)
+    start = time.perf_counter()
+    legacy_raw = legacy_tree_serialize(legacy_items)
+    legacy_serialize = time.perf_counter() - start
+
+    (items, new_parse, new_size) = measure(tree_parse, raw)
+    tree = TeaTree()
+    tree.items = items
+    start = time.perf_counter()
+    new_raw = tree_serialize(tree)
+    new_serialize = time.perf_counter() - start
+
+    assert legacy_raw == new_raw == raw, "round trip changed the tree"
+    assert [ i.sha for i in items ] == [ i.sha for i in legacy_items ]
+
+    print(f"{count} entries ({len(raw)} bytes)")
+    print(f"  parse:     {legacy_parse * 1000:8.1f}ms -> {new_parse * 1000:8.1f}ms")
+    print(f"  serialize: {legacy_serialize * 1000:8.1f}ms -> {new_serialize * 1000:8.1f}ms")
+    print(f"  leaves:    {legacy_size / count:8.0f}B  -> {new_size / count:8.0f}B per entry")
+
+if __name__ == '__main__':
+    counts = [ int(c) for c in sys.argv[1:] ] or [ 1000, 100000 ]
+    for count in counts:
+        bench(count)
@@ -1,85 +1,265 @@
 import configparser
+import hashlib
 import os
 
-from lib.repo_functions import repo_file
-from lib.staging import TeaIndexEntry, index_read
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.repo_functions import repo_file, repo_jobs
+from lib.staging import INDEX_ENTRY, INDEX_EXTENSION, INDEX_HEADER, TeaCacheTree, TeaIndex, cache_tree_invalidate, check_ignore, index_entry_from_stat, index_entry_size, index_read, index_varint_encode, teaignore_read, untracked_cache_invalidate
 from lib.tea_object import TeaCommit, TeaTree
-from lib.tea_object_function import object_write
+from lib.fsync import FSYNC_NONE, fsync_dir, fsync_file, fsync_mode
+from lib.tea_object_function import object_flush, object_read, object_write
 from lib.trees_checkout import TeaTreeLeaf
 from lib.wrapper import hash_object
 
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
+def index_write(repo, index, opportunistic=False, newest_mtime_ns=None):
+    """
+    Write index to the repository. An opportunistic write, that only
+    saves information the next command could compute again (such as
+    refreshed stat data), gives up quietly when the index is locked, or
+    was changed since index was read: it returns False.
+
+    Callers that just gave entries the stat data of files they wrote
+    pass the newest of their mtimes: entries as new as the index itself
+    get smudged (see index_smudge_racy).
+    """
+
+    # The index may point to objects written in batch mode: make them
+    # durable before it does.
+    object_flush(repo)
+
+    # We write .tea/index.lock, then rename it over the index. Creating
+    # the lock fails if another tea process is already writing, and a
+    # crash never leaves a truncated index behind.
+    path = repo_file(repo, "index")
+    lock_path = path + ".lock"
+
+    try:
+        fd = os.open(lock_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        if (opportunistic):
+            return False
+
+        raise Exception(f"Unable to create {lock_path}: another tea process seems to be running. If not, remove the file.")
+
+    # Nobody can replace the index while we hold the lock: if it's
+    # still the one index was read from, writing it back loses nothing
+    # (such as an add that ran in between).
+    if (opportunistic and index_file_sha(path) != index.sha):
+        os.close(fd)
+        os.unlink(lock_path)
+        return False
+
+    # The index's mtime will be no earlier than its lock's creation
+    if (newest_mtime_ns is not None):
+        index_smudge_racy(index, newest_mtime_ns, os.fstat(fd).st_mtime_ns)
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            data = index_serialize(index)
+            f.write(data)
+
+            if (fsync_mode(repo) != FSYNC_NONE):
+                fsync_file(f)
+
+        os.replace(lock_path, path)
+    except:
+        os.unlink(lock_path)
+        raise
+
+    # The rename itself lives in the directory
+    if (fsync_mode(repo) != FSYNC_NONE):
+        fsync_dir(repo.teadir)
+
+    index.sha = bytes(data[-20:])
+
+    return True
+
+def index_file_sha(path):
+    """
+    The trailing checksum of the index file at path, or None if there's
+    no index.
+    """
+
+    try:
+        with open(path, "rb") as f:
+            f.seek(-20, os.SEEK_END)
+            return f.read(20)
+    except FileNotFoundError:
+        return None
+
+def index_smudge_racy(index, newest_mtime_ns, index_mtime_ns):
+    """
+    Zero the size of the new entries (those not copied as they were
+    read) whose mtime isn't earlier than index_mtime_ns, like git does.
+    They would be racy (see index_entry_racy); smudged, only they get
+    read again by the next status, which then refreshes them.
+
+    That's only a few entries: those of the last clock tick, or second
+    on filesystems with coarse timestamps. None when newest_mtime_ns is
+    earlier than the index.
+    """
+
+    if (newest_mtime_ns < index_mtime_ns):
+        return
 
-        # HEADER
+    for e in index.entries:
+        if (e.raw is None and e.mtime[0] * 10**9 + e.mtime[1] >= index_mtime_ns):
+            e.fsize = 0
+
+def index_serialize(index):
+    """
+    Serialize the index into a single buffer.
+    """
+
+    names = [ e.name.encode("utf8") for e in index.entries ]
+
+    # What follows each entry's fixed part: the NUL-terminated name
+    # padded to eight bytes in version 2, the prefix-compressed name
+    # without padding in version 4.
+    if (index.version == 4):
+        tails = list()
+        prev = b''
+
+        for name in names:
+            common = index_common_prefix(prev, name)
+            tails.append(index_varint_encode(len(prev) - common) + name[common:] + b'\x00')
+            prev = name
+
+        sizes = [ INDEX_ENTRY.size + len(tail) for tail in tails ]
+    else:
+        tails = names
+        sizes = [ index_entry_size(len(name)) for name in names ]
+
+    # The buffer starts zeroed: padding and name terminators come free.
+    buf = bytearray(INDEX_HEADER.size + sum(sizes))
+
+    INDEX_HEADER.pack_into(buf, 0, b"DIRC", index.version, len(index.entries))
+
+    idx = INDEX_HEADER.size
+    for (e, name, tail, size) in zip(index.entries, names, tails, sizes):
+        name_start = idx + INDEX_ENTRY.size
+        buf[name_start:name_start + len(tail)] = tail
+
+        # Entries nobody looked at are copied as they were read
+        record = e.raw_record()
+
+        if (record):
+            buf[idx:name_start] = record
+            idx += size
+            continue
+
+        # Mode
+        mode = (e.mode_type << 12) | e.mode_perms
+
+        flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+
+        # Names of 0xFFF bytes or more store 0xFFF as their length
+        name_length = min(len(name), 0xFFF)
+
+        # Device and inode numbers may not fit on 32 bits: like git, we
+        # keep the low bits only.
+        INDEX_ENTRY.pack_into(
+            buf,
+            idx,
+            e.ctime[0],
+            e.ctime[1],
+            e.mtime[0],
+            e.mtime[1],
+            e.dev & 0xFFFFFFFF,
+            e.ino & 0xFFFFFFFF,
+            mode,
+            e.uid,
+            e.gid,
+            e.fsize,
+            bytes.fromhex(e.sha),
+            # We merge back three pieces of data (two flags and the
+            # length of the name) on the same two bytes.
+            flag_assume_valid | int(e.flag_stage) | name_length
+        )
 
-        # Write the magic bytes.
-        f.write(b"DIRC")
-        # Write version number.
-        f.write(index.version.to_bytes(4, "big"))
-        # Write the number of entries.
-        f.write(len(index.entries).to_bytes(4, "big"))
+        idx += size
 
-        # ENTRIES
+    if (index.cache_tree):
+        data = b"".join(cache_tree_serialize("", index.cache_tree))
+        buf += INDEX_EXTENSION.pack(b"TREE", len(data)) + data
 
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
+    if (index.untracked_cache is not None):
+        data = b"".join(untracked_cache_serialize(index.untracked_cache))
+        buf += INDEX_EXTENSION.pack(b"TEAU", len(data)) + data
 
-            # Mode
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
+    if (index.fsmonitor_token):
+        data = "\x00".join([ index.fsmonitor_token ] + sorted(index.fsmonitor_dirty)).encode("utf8")
+        buf += INDEX_EXTENSION.pack(b"TEAF", len(data)) + data
 
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
+    # Like git, end with the SHA-1 of everything before.
+    buf += hashlib.sha1(buf).digest()
 
-            f.write(e.fsize.to_bytes(4, "big"))
-            # @FIXME Convert back to int
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
+    return buf
 
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+def cache_tree_serialize(name, node):
+    """
+    The TREE extension data for node and its subtrees, as a list of
+    byte strings (see cache_tree_parse).
+    """
 
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if (bytes_len >= 0xFFF):
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
+    ret = [ f"{name}\x00{node.entry_count} {len(node.subtrees)}\n".encode("utf8") ]
 
-            # We merge back three pieces of data (two flags and the
-            # lengthh of the name) on the same two bytes.
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+    if (node.entry_count >= 0):
+        ret.append(bytes.fromhex(node.sha))
+
+    for (child_name, child) in node.subtrees.items():
+        ret += cache_tree_serialize(child_name, child)
+
+    return ret
+
+def untracked_cache_serialize(untracked_cache):
+    """
+    The TEAU extension data, as a list of byte strings (see
+    untracked_cache_parse).
+    """
+
+    ret = list()
+
+    for (path, d) in untracked_cache.items():
+        ret.append(f"{path}\x00{d.mtime_ns} {d.ignore_sha} {len(d.untracked)} {len(d.subdirs)}\n".encode("utf8"))
+
+        for name in d.untracked + d.subdirs:
+            ret.append(name.encode("utf8") + b"\x00")
 
-            # Write back the name, and a final 0x00.
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+    return ret
 
-            idx += 62 + len(name_bytes) + 1
+def index_common_prefix(a, b):
+    """
+    Length of the common prefix of a and b. The first differing byte is
+    the highest set byte of their XOR, which spares a byte by byte loop.
+    """
 
-            # Add padding if necessary.
-            if (idx % 8 != 0):
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
+    n = min(len(a), len(b))
+    diff = int.from_bytes(a[:n], "big") ^ int.from_bytes(b[:n], "big")
+
+    return n - (diff.bit_length() + 7) // 8
 
 def rm(repo, paths, delete=True, skip_missing=False):
-    # Find and read the index
+    # Find and read the index, remove the paths, write it back.
     index = index_read(repo)
+    index_rm(repo, index, paths, delete, skip_missing)
+    index_write(repo, index)
+
+def index_rm(repo, index, paths, delete=True, skip_missing=False):
+    """
+    Remove paths from index, in memory.
+    """
 
     worktree = repo.worktree + os.sep
 
-    # Make paths absolute
-    abspaths = list()
+    # Make paths relative to the worktree, like index entries' names
+    relpaths = set()
     for path in paths:
         abspath = os.path.abspath(path)
 
         if (abspath.startswith(worktree)):
-            abspaths.append(abspath)
+            relpaths.add(os.path.relpath(abspath, repo.worktree))
         else:
             raise Exception(f"Cannot remove paths outside of worktree: {paths}")
 
@@ -87,83 +267,110 @@ def rm(repo, paths, delete=True, skip_missing=False):
     remove = list()
 
     for e in index.entries:
-        full_path = os.path.join(repo.worktree, e.name)
-
-        if (full_path in abspaths):
-            remove.append(full_path)
-            abspaths.remove(full_path)
+        if (e.name in relpaths):
+            remove.append(e.name)
+            cache_tree_invalidate(index.cache_tree, e.name)
+            untracked_cache_invalidate(index.untracked_cache, e.name)
         else:
             keep_entries.append(e) # Preserve entry
 
-    if (len(abspaths) > 0 and not skip_missing):
-        raise Exception(f"Cannot remove pathhs not in the index: {abspaths}")
+    missing = relpaths.difference(remove)
+    if (len(missing) > 0 and not skip_missing):
+        raise Exception(f"Cannot remove pathhs not in the index: {sorted(missing)}")
 
     if (delete):
-        for path in remove:
-            os.unlink(path)
+        for name in remove:
+            os.unlink(os.path.join(repo.worktree, name))
 
     index.entries = keep_entries
-    index_write(repo, index)
 
-def add(repo, paths, delete=True, skip_missing=False):
-
-    # First remove all paths from the index, if they exist.
-    rm (repo, paths, delete=False, skip_missing=True)
+def add(repo, paths, delete=True, skip_missing=False, jobs=None):
+    # The index is read once, and written once at the end.
+    index = index_read(repo)
 
     worktree = repo.worktree + os.sep
 
-    # Convert the paths to pairs: (absolute, relative_to_worktree).
-    # Also delete them from the index if they're present.
-    clean_paths = list()
+    # Map the files to add, relative to the worktree, to their absolute
+    # path. Directories are walked for the files they hold.
+    clean_paths = dict()
+    rules = None
+
     for path in paths:
         abspath = os.path.abspath(path)
-        
-        if (not (abspath.startswith(worktree) and os.path.isfile(abspath))):
-            raise Exception(f"Not a file, or outside the worktree: {paths}")
-
-        relpath = os.path.relpath(abspath, repo.worktree)
-        clean_paths.append((abspath, relpath))
-
-    # Find and read the index. It was modified by rm. (This isn't
-    # optimal, but good enough for tea)
-    #
-    # @FIXME though: we could just
-    # move the index through commands instead of reading and writing
-    # it over again.
-    index = index_read(repo)
 
-    for (abspath, relpath) in clean_paths:
-        with open(abspath, "rb") as fd:
-            sha = hash_object(fd, b"blob", repo)
-
-        stat = os.stat(abspath)
-
-        ctime_s = int(stat.st_ctime)
-        ctime_ns = stat.st_ctime_ns % 10**9
-        mtime_s = int(stat.st_mtime)
-        mtime_ns = stat.st_mtime_ns % 10**9
-        
-        entry = TeaIndexEntry(
-                    ctime = (ctime_s, ctime_ns),
-                    mtime = (mtime_s, mtime_ns),
-                    dev = stat.st_dev,
-                    ino = stat.st_ino,
-                    mode_type = 0b1000,
-                    mode_perms = 0o644,
-                    uid = stat.st_uid,
-                    gid = stat.st_gid,
-                    fsize = stat.st_size,
-                    sha = sha,
-                    flag_assume_valid = False,
-                    flag_stage = False,
-                    name = relpath
-                )
-
-        index.entries.append(entry)
+        if (not (abspath + os.sep).startswith(worktree)):
+            raise Exception(f"Outside the worktree: {path}")
+
+        if (os.path.isdir(abspath)):
+            # The ignore rules only matter when walking directories
+            if (not rules):
+                rules = teaignore_read(repo, index)
+
+            for file_path in add_walk(repo, abspath, rules):
+                clean_paths[os.path.relpath(file_path, repo.worktree)] = file_path
+        elif (os.path.isfile(abspath)):
+            clean_paths[os.path.relpath(abspath, repo.worktree)] = abspath
+        else:
+            raise Exception(f"Not a file or a directory: {path}")
+
+    clean_paths = list((abspath, relpath) for (relpath, abspath) in clean_paths.items())
+
+    # Hashing and compressing is where the time goes, and both release
+    # the GIL: spread the files over a thread pool. map() hands results
+    # back in order, so the index is built the same way whatever the
+    # number of jobs.
+    with ThreadPoolExecutor(max_workers=repo_jobs(repo, "add", jobs)) as pool:
+        hashed = pool.map(lambda p: add_hash_one(repo, p[0]), clean_paths)
+
+        # New entries replace the old ones with the same name
+        entries = { e.name: e for e in index.entries }
+
+        for ((_, relpath), (sha, stat)) in zip(clean_paths, hashed):
+            entries[relpath] = index_entry_from_stat(stat, sha, relpath)
+            cache_tree_invalidate(index.cache_tree, relpath)
+            untracked_cache_invalidate(index.untracked_cache, relpath)
+
+    # Keep the index sorted by name, like git: tree_from_index relies on
+    # each directory's entries being contiguous. The existing entries
+    # are already sorted, so this merges in the new ones.
+    index.entries = sorted(entries.values(), key=lambda e: e.name)
 
     # Write the index back
     index_write(repo, index)
 
+def add_walk(repo, abspath, rules):
+    """
+    Yield the files under directory abspath, skipping the repository's
+    .tea directory and whatever rules ignore. Ignored directories are
+    not descended into.
+    """
+
+    for (root, dirs, files) in os.walk(abspath):
+        relroot = os.path.relpath(root, repo.worktree)
+        if (relroot == "."):
+            relroot = ""
+
+        dirs[:] = [ d for d in dirs
+                    if os.path.join(root, d) != repo.teadir
+                    and not check_ignore(rules, os.path.join(relroot, d)) ]
+        dirs.sort()
+
+        for f in sorted(files):
+            file_path = os.path.join(root, f)
+
+            if (os.path.isfile(file_path) and not check_ignore(rules, os.path.join(relroot, f))):
+                yield file_path
+
+def add_hash_one(repo, abspath):
+    """
+    Write the blob for abspath. Return its SHA and the stat of the file.
+    """
+
+    with open(abspath, "rb") as fd:
+        sha = hash_object(fd, b"blob", repo)
+
+    return (sha, os.stat(abspath))
+
 def teaconfig_read():
     xdg_config_home = os.environ["XDG_CONFIG_HOME"] if "XDG_CONFIG_HOME" in os.environ else "~/.config"
 
@@ -183,70 +390,120 @@ def teaconfig_user_get(config):
 
     return None
 
+def index_from_checkout(repo, tree, files):
+    """
+    Write the index for a checkout of tree (a SHA) into the worktree.
+    files are the (sha, path, stat) of the files written, as returned by
+    tree_checkout: entries are built from them, not from the files, and
+    the cache tree from the trees. The index then describes the
+    worktree exactly, and neither status nor the next commit has
+    anything to read again.
+    """
+
+    old = index_read(repo)
+
+    entries = [ index_entry_from_stat(stat, sha, os.path.relpath(path, repo.worktree))
+                for (sha, path, stat) in files ]
+    entries.sort(key=lambda e: e.name)
+
+    index = TeaIndex(version=old.version, entries=entries,
+                     cache_tree=cache_tree_from_tree(repo, tree),
+                     untracked_cache=dict() if old.untracked_cache is not None else None)
+
+    index_write(repo, index, newest_mtime_ns=max((stat.st_mtime_ns for (_, _, stat) in files), default=0))
+
+def cache_tree_from_tree(repo, sha):
+    """
+    The cache tree node for tree sha, for an index holding exactly its
+    files. Trees holding anything checkout doesn't write (submodules)
+    can't be rebuilt from such an index: they, and the trees above
+    them, are left invalid.
+    """
+
+    node = TeaCacheTree(0, sha)
+
+    for item in object_read(repo, sha).items:
+        if (item.mode.startswith(b'04')):
+            child = cache_tree_from_tree(repo, item.sha)
+            node.subtrees[item.path] = child
+            count = child.entry_count
+        elif (item.mode.startswith(b'10') or item.mode.startswith(b'12')):
+            count = 1
+        else:
+            count = -1
+
+        if (count < 0):
+            node.entry_count = -1
+        elif (node.entry_count >= 0):
+            node.entry_count += count
+
+    return node
+
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are dictionaries, and values are list of directory contents.
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-
-        # We create all dictionary entries up to root (""). We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree
-        key = dirname
-        
-        while (key != ""):
-            if (not key in contents):
-                contents[key] = list()
-
-            key = os.path.dirname(key)
-
-        # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (=directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1. After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    # We get through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new, empty tree object
-        tree = TeaTree()
-
-        # Add each entry to our new tree, in turn
-        for entry in contents[path]:
-            # An entry can be a normal TeaIndexEntry read from the
-            # index, or a tree we've created.
-            if (isinstance(entry, TeaIndexEntry)): # Regular entry (a file)
-
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation of the key
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = TeaTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree. We've stored it as a pair (basename, sha)
-                leaf = TeaTreeLeaf(mode=b"040000", path=entry[0], sha=entry[1])
-
-            tree.items.append(leaf)
-
-        # Write the new tree object to the store.
-        sha = object_write(tree, repo)
-
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, eg main.go for src/main.go
-        contents[parent].append((base, sha))
-
-    return sha
+    """
+    Write the trees for the index, and return the SHA of the root tree.
+
+    Directories whose entry in the index's cache tree is still valid
+    aren't rebuilt: their cached SHA is reused, and their entries
+    skipped. The cache tree is updated along the way, so the caller
+    should write the index back.
+    """
+
+    if (not index.cache_tree):
+        # Indexes without a cache tree may come from older versions of
+        # tea, which didn't keep entries sorted.
+        names = [ e.name for e in index.entries ]
+        if (names != sorted(names)):
+            index.entries.sort(key=lambda e: e.name)
+
+        index.cache_tree = TeaCacheTree()
+
+    tree_from_index_update(repo, index.cache_tree, index.entries, 0, "")
+
+    return index.cache_tree.sha
+
+def tree_from_index_update(repo, node, entries, start, prefix):
+    """
+    Bring node, the cache tree for directory prefix ("" or ending with
+    "/"), up to date. Its entries start at entries[start]. Return the
+    number of entries it covers.
+    """
+
+    if (node.entry_count >= 0):
+        return node.entry_count
+
+    # Prepare a new, empty tree object
+    tree = TeaTree()
+    subtrees = dict()
+
+    i = start
+    while (i < len(entries) and entries[i].name.startswith(prefix)):
+        entry = entries[i]
+        name = entry.name[len(prefix):]
+        slash = name.find("/")
+
+        if (slash == -1): # Regular entry (a file)
+            # We transcode the mode: the entry stores it as integers,
+            # we need an octal ASCII representation of the key
+            leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
+            tree.items.append(TeaTreeLeaf(mode=leaf_mode, path=name, sha=entry.sha))
+            i += 1
+        else: # A subdirectory, whose entries all follow.
+            base = name[:slash]
+            child = node.subtrees.get(base) or TeaCacheTree()
+
+            i += tree_from_index_update(repo, child, entries, i, prefix + base + "/")
+
+            tree.items.append(TeaTreeLeaf(mode=b"040000", path=base, sha=child.sha))
+            subtrees[base] = child
+
+    # Write the new tree object to the store. Subdirectories that no
+    # longer hold anything have disappeared from the cache tree.
+    node.sha = object_write(tree, repo)
+    node.entry_count = i - start
+    node.subtrees = subtrees
+
+    return node.entry_count
 
 def commit_create(repo, tree, parent, author, timestamp, message):
     commit = TeaCommit() # Create the new commit object.
@@ -0,0 +1,79 @@
+import zlib
+
+# Only this much of an object is test-compressed to guess whether the
+# rest is worth compressing.
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+
+# Samples smaller than this say too little to decide anything.
+COMPRESSION_SAMPLE_MIN = 4096
+
+# If level 1 can't shrink the sample below this ratio, the data is
+# already compressed (media, archives...) and we store it as is.
+INCOMPRESSIBLE_RATIO = 0.95
+
+# inflate_chunks never returns more than this at once
+INFLATE_CHUNK_SIZE = 1 << 20
+
+def inflate_chunks(chunks, max_length=INFLATE_CHUNK_SIZE):
+    """
+    Inflate the zlib stream given as chunks, an iterable of compressed
+    bytes, and yield its data max_length bytes at most at a time. Stop
+    at the end of the stream, whatever follows it.
+    """
+
+    d = zlib.decompressobj()
+
+    for chunk in chunks:
+        while (True):
+            data = d.decompress(chunk, max_length)
+            if (data):
+                yield data
+
+            if (d.eof):
+                return
+
+            # Out of input, and no output pending: next chunk
+            chunk = d.unconsumed_tail
+            if (not chunk and not data):
+                break
+
+    raise Exception("Truncated zlib stream")
+
+def compression_level_config(repo, loose=True):
+    """
+    The zlib level configured for loose objects (core.looseCompression) or
+    packs (pack.compression), both defaulting to core.compression.
+    """
+
+    level = -1
+    conf = repo.conf if repo else None
+
+    if (conf):
+        specific = ("core", "looseCompression") if loose else ("pack", "compression")
+
+        if (conf.has_option(*specific)):
+            level = conf.getint(*specific)
+        elif (conf.has_option("core", "compression")):
+            level = conf.getint("core", "compression")
+
+    if (not -1 <= level <= 9):
+        raise Exception(f"Bad zlib compression level {level}")
+
+    return level
+
+def compression_level(level, sample):
+    """
+    Lower level to 0 (store) when sample, the beginning of the data to
+    compress, looks incompressible.
+    """
+
+    if (level == 0 or len(sample) < COMPRESSION_SAMPLE_MIN):
+        return level
+
+    sample = sample[:COMPRESSION_SAMPLE_SIZE]
+
+    INCOMPRESSIBLE = len(zlib.compress(sample, 1)) > len(sample) * INCOMPRESSIBLE_RATIO
+    if (INCOMPRESSIBLE):
+        return 0
+
+    return level
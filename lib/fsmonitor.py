@@ -0,0 +1,380 @@
+import os
+import sys
+import time
+import errno
+import socket
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from lib.repo_functions import repo_file
+
+# inotify(7) event masks
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+FSMONITOR_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event: wd, mask, cookie, len, then the name (len
+# bytes, NUL-padded)
+INOTIFY_EVENT = struct.Struct("iIII")
+
+# Replies to "since <token>": the new token, a NUL, then either
+# FSMONITOR_ALL (the caller must look at everything), or the paths
+# changed since token, NUL-separated. Paths ending with "/" are
+# directories, and stand for everything under them.
+FSMONITOR_ALL = "*"
+
+# How long status waits for the daemon before giving up on it
+FSMONITOR_TIMEOUT = 1.0
+
+# How many changed paths the daemon remembers. Tokens older than the
+# changes it forgets get FSMONITOR_ALL: past that many, a full scan is
+# about as cheap anyway.
+FSMONITOR_MAX_CHANGES = 1 << 16
+
+def fsmonitor_socket_path(repo):
+    return repo_file(repo, "fsmonitor.sock")
+
+class TeaFsmonitor(object):
+    """
+    The fsmonitor daemon: watches every directory of the worktree (but
+    .tea) with inotify, and remembers which paths changed when.
+
+    Changes are numbered; a token is "<daemon id>:<number>". Tokens
+    from another daemon, from before the kernel's event queue
+    overflowed (events were lost), or older than the changes we still
+    remember (see FSMONITOR_MAX_CHANGES), can only be answered with
+    FSMONITOR_ALL.
+    """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.id = f"{os.getpid()}.{time.time_ns()}"
+        self.seq = 0
+        # Path -> number of its last change, oldest change first
+        self.changes = dict()
+        # Tokens before this number predate lost or forgotten events
+        self.overflow_seq = 0
+        # Watch descriptor -> directory, relative to the worktree
+        self.watches = dict()
+        self.teadir = os.path.relpath(repo.teadir, repo.worktree)
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if (self.fd < 0):
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), "inotify_init1")
+
+        self.watch_tree("")
+
+    def watch_tree(self, rel_dir):
+        """
+        Watch rel_dir and every directory under it.
+        """
+
+        pending = [ rel_dir ]
+
+        while (pending):
+            rel_dir = pending.pop()
+            abs_dir = os.path.join(self.repo.worktree, rel_dir)
+
+            wd = self.inotify_add_watch(self.fd, os.fsencode(abs_dir), FSMONITOR_WATCH_MASK)
+            if (wd < 0):
+                e = ctypes.get_errno()
+
+                # Gone already: whoever removed it will be reported
+                if (e in (errno.ENOENT, errno.ENOTDIR)):
+                    continue
+
+                # Out of watches (fs.inotify.max_user_watches): we
+                # can't see everything, so we say so.
+                print(f"fsmonitor: cannot watch {abs_dir}: {os.strerror(e)}", file=sys.stderr)
+                self.overflow()
+                continue
+
+            self.watches[wd] = rel_dir
+
+            try:
+                with os.scandir(abs_dir) as it:
+                    for dirent in it:
+                        if (dirent.is_dir(follow_symlinks=False) and dirent.path != self.repo.teadir):
+                            pending.append(f"{rel_dir}/{dirent.name}" if rel_dir else dirent.name)
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+
+    def overflow(self):
+        self.seq += 1
+        self.overflow_seq = self.seq
+
+        # No token they would be reported to can be answered any more
+        self.changes.clear()
+
+    def changed(self, path):
+        self.seq += 1
+
+        # Moved to the end: changes stay ordered by number
+        self.changes.pop(path, None)
+        self.changes[path] = self.seq
+
+        if (len(self.changes) > FSMONITOR_MAX_CHANGES):
+            oldest = next(iter(self.changes))
+            self.overflow_seq = max(self.overflow_seq, self.changes.pop(oldest))
+
+    def read_events(self):
+        """
+        Record every event the kernel has queued for us.
+        """
+
+        while (True):
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            idx = 0
+            while (idx < len(buf)):
+                (wd, mask, _, length) = INOTIFY_EVENT.unpack_from(buf, idx)
+                name = os.fsdecode(buf[idx + INOTIFY_EVENT.size:idx + INOTIFY_EVENT.size + length].rstrip(b"\x00"))
+                idx += INOTIFY_EVENT.size + length
+
+                if (mask & IN_Q_OVERFLOW):
+                    self.overflow()
+                    continue
+
+                rel_dir = self.watches.get(wd)
+                if (rel_dir is None):
+                    continue
+
+                if (mask & IN_IGNORED):
+                    del self.watches[wd]
+                    continue
+
+                if (not name):
+                    # Event about a watched directory itself. Its
+                    # parent reports its removal or renaming.
+                    if (mask & (IN_DELETE_SELF | IN_MOVE_SELF) and not rel_dir):
+                        # The worktree itself is gone
+                        self.overflow()
+                    continue
+
+                path = f"{rel_dir}/{name}" if rel_dir else name
+
+                if (path == self.teadir):
+                    continue
+
+                if (mask & IN_ISDIR):
+                    # Whatever was created inside a new directory before
+                    # we watched it is covered by reporting it whole.
+                    if (mask & (IN_CREATE | IN_MOVED_TO)):
+                        self.watch_tree(path)
+
+                    path += "/"
+
+                self.changed(path)
+
+    def since(self, token):
+        """
+        The reply to a "since token" query.
+        """
+
+        self.read_events()
+
+        reply = f"{self.id}:{self.seq}\x00"
+
+        (daemon_id, _, seq) = token.partition(":")
+        if (daemon_id != self.id or not seq.isdigit() or int(seq) < self.overflow_seq):
+            return reply + FSMONITOR_ALL
+
+        seq = int(seq)
+        paths = list()
+
+        # Newest first, down to the token: older changes aren't looked at
+        for (path, path_seq) in reversed(self.changes.items()):
+            if (path_seq <= seq):
+                break
+            paths.append(path)
+
+        return reply + "\x00".join(paths)
+
+    def serve(self, server):
+        """
+        Answer queries on server, a listening socket, until asked to
+        quit.
+        """
+
+        while (True):
+            (readable, _, _) = select.select([ self.fd, server ], [], [])
+
+            if (self.fd in readable):
+                self.read_events()
+
+            if (server not in readable):
+                continue
+
+            (conn, _) = server.accept()
+            with conn:
+                conn.settimeout(FSMONITOR_TIMEOUT)
+
+                try:
+                    request = fsmonitor_recv(conn).decode("utf8")
+                except (socket.timeout, OSError):
+                    continue
+
+                if (request == "quit"):
+                    conn.sendall(b"bye")
+                    return
+
+                if (request.startswith("since ")):
+                    try:
+                        conn.sendall(self.since(request[6:]).encode("utf8"))
+                    except OSError:
+                        pass
+
+def fsmonitor_recv(conn):
+    """
+    Read a whole message: the sender shuts its side down when done.
+    """
+
+    chunks = list()
+
+    while (True):
+        chunk = conn.recv(65536)
+        if (not chunk):
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+def fsmonitor_request(repo, request):
+    """
+    Send request to the daemon and return its reply, or None if no
+    daemon is listening.
+    """
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    with sock:
+        sock.settimeout(FSMONITOR_TIMEOUT)
+
+        try:
+            sock.connect(fsmonitor_socket_path(repo))
+            sock.sendall(request.encode("utf8"))
+            sock.shutdown(socket.SHUT_WR)
+            return fsmonitor_recv(sock).decode("utf8")
+        except OSError:
+            # No socket, nobody listening, or too slow to answer
+            return None
+
+class TeaFsmonitorChanges(object):
+    """
+    Paths the daemon reported as changed since a token.
+    """
+
+    def __init__(self, paths):
+        self.paths = set(p.rstrip("/") for p in paths)
+        # Directories reported whole
+        self.prefixes = tuple(p for p in paths if p.endswith("/"))
+        # Directories whose listing may have changed
+        self.dirs = set(os.path.dirname(p) for p in self.paths)
+
+    def path_changed(self, path):
+        return path in self.paths or path.startswith(self.prefixes)
+
+    def dir_changed(self, rel_dir):
+        return rel_dir in self.dirs or (rel_dir and (rel_dir + "/").startswith(self.prefixes))
+
+def fsmonitor_query(repo, token):
+    """
+    Ask the daemon what changed since token. Return the new token and a
+    TeaFsmonitorChanges, or None instead of the latter when everything
+    must be looked at. Return (None, None) without a daemon.
+    """
+
+    reply = fsmonitor_request(repo, f"since {token or ''}")
+
+    if (reply is None):
+        return (None, None)
+
+    (new_token, _, paths) = reply.partition("\x00")
+
+    if (paths == FSMONITOR_ALL):
+        return (new_token, None)
+
+    return (new_token, TeaFsmonitorChanges(paths.split("\x00") if paths else []))
+
+def fsmonitor_run(repo, detach=False):
+    """
+    Run the daemon for repo, in the background if detach.
+    """
+
+    path = fsmonitor_socket_path(repo)
+
+    if (fsmonitor_request(repo, "ping") is not None):
+        raise Exception(f"An fsmonitor daemon is already running for {repo.worktree}")
+
+    # Left over by a daemon that didn't exit cleanly
+    if (os.path.exists(path)):
+        os.unlink(path)
+
+    if (detach):
+        pid = os.fork()
+        if (pid > 0):
+            os.waitpid(pid, 0)
+
+            # Return once the daemon answers, so that the next command
+            # finds it.
+            for _ in range(50):
+                if (fsmonitor_request(repo, "ping") is not None):
+                    return
+                time.sleep(0.1)
+
+            raise Exception("The fsmonitor daemon didn't start")
+
+        os.setsid()
+        if (os.fork() > 0):
+            os._exit(0)
+
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+
+    # Watches are in place before we answer anything: no change made
+    # after the first token is missed.
+    monitor = TeaFsmonitor(repo)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+
+    try:
+        monitor.serve(server)
+    finally:
+        server.close()
+        os.unlink(path)
+        os.close(monitor.fd)
+
+        if (detach):
+            os._exit(0)
+
+def fsmonitor_stop(repo):
+    if (fsmonitor_request(repo, "quit") is None):
+        raise Exception(f"No fsmonitor daemon is running for {repo.worktree}")
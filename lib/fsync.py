@@ -0,0 +1,55 @@
+import os
+import ctypes
+import ctypes.util
+
+# core.fsync values:
+#   false  : never fsync (the default). Writes are still atomic.
+#   true   : fsync every object and the index as they are written.
+#   batch  : keep new objects under temporary names, and make them all
+#            durable with a single filesystem sync when the command
+#            publishes them (before the index or a ref points to them).
+FSYNC_NONE   = 'false'
+FSYNC_ALWAYS = 'true'
+FSYNC_BATCH  = 'batch'
+
+def fsync_mode(repo):
+    value = repo.conf.get("core", "fsync", fallback="false").strip().lower()
+
+    match value:
+        case 'batch'                         : return FSYNC_BATCH
+        case 'true' | 'yes' | 'on' | '1'     : return FSYNC_ALWAYS
+        case 'false' | 'no' | 'off' | '0'    : return FSYNC_NONE
+        case _:
+            raise Exception(f"Bad core.fsync value {value}")
+
+def fsync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fs_sync(path):
+    """
+    Flush everything written to the filesystem holding path, with one
+    syncfs(2) call. Falls back to sync(2) where syncfs is unavailable.
+    """
+
+    libc_name = ctypes.util.find_library("c")
+    syncfs = getattr(ctypes.CDLL(libc_name, use_errno=True), "syncfs", None) if libc_name else None
+
+    if (not syncfs):
+        os.sync()
+        return
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if (syncfs(fd) != 0):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
@@ -2,15 +2,19 @@ import os
 import grp
 import pwd
 import sys
+import time
 import argparse
 from datetime import datetime
 
-from lib.commit import add, commit_create, teaconfig_user_get, teaconfig_read, rm, tree_from_index
-from lib.refs_tags_branch import ref_list, tag_create
+from lib.commit import add, commit_create, index_from_checkout, index_write, teaconfig_user_get, teaconfig_read, rm, tree_from_index
+from lib.fsmonitor import fsmonitor_run, fsmonitor_stop
+from lib.object_cache import object_caches
+from lib.refs_tags_branch import ref_create, ref_list, tag_create
 from lib.repo_functions import repo_create, repo_file, repo_find
 from lib.staging import check_ignore, cmd_status_head_index, cmd_status_index_worktree, teaignore_read, index_read
-from lib.tea_object_function import object_read, object_find
-from lib.wrapper import branch_get_active, cat_file, cmd_status_branch, hash_object, log_graphviz, show_ref, tree_checkout, ls_tree
+from lib.switch import switch
+from lib.tea_object_function import object_find, object_flush, object_read
+from lib.wrapper import branch_get_active, cat_file, cat_file_batch, cat_file_info, cmd_status_branch, diff_tree, hash_object, log_graphviz, repack, show_ref, tree_checkout, ls_tree
 
 # =================================================================
 #                           ARGUMENT PARSER
@@ -32,10 +36,18 @@ argsp = argsubparsers.add_parser(
     help = 'Add file contents to the index.'
 )
 
+argsp.add_argument(
+    '-j',
+    '--jobs',
+    type    = int,
+    default = None,
+    help    = 'Number of files hashed in parallel (default: add.jobs, or one per CPU).'
+)
+
 argsp .add_argument(
     'path',
     nargs = '+',
-    help  = 'Files to add.'
+    help  = 'Files to add. Directories are added recursively, minus ignored files.'
 )
 
 # CAT-FILE
@@ -44,16 +56,55 @@ argsp = argsubparsers.add_parser(
     help = 'Provide the content of a repository object.'
 )
 
+argsgrp = argsp.add_mutually_exclusive_group()
+
+argsgrp.add_argument(
+    '-t',
+    dest   = 'show_type',
+    action = 'store_true',
+    help   = 'Show the object type instead of its content.'
+)
+
+argsgrp.add_argument(
+    '-s',
+    dest   = 'show_size',
+    action = 'store_true',
+    help   = 'Show the object size instead of its content.'
+)
+
+argsgrp.add_argument(
+    '--batch',
+    dest   = 'batch',
+    action = 'store_const',
+    const  = 'batch',
+    help   = 'Read object names from stdin, print their header and content.'
+)
+
+argsgrp.add_argument(
+    '--batch-check',
+    dest   = 'batch',
+    action = 'store_const',
+    const  = 'batch-check',
+    help   = 'Read object names from stdin, print their header only.'
+)
+
+argsp.add_argument(
+    '--buffer',
+    action = 'store_true',
+    help   = 'In batch mode, only flush the output when stdin is exhausted.'
+)
+
 argsp.add_argument(
     'type',
     metavar = 'type',
-    choices = ['blob', "commit", "tag", "tree"],
-    help    = 'Specify the type.'
+    nargs   = '?',
+    help    = 'Specify the type (blob, commit, tag or tree).'
 )
 
 argsp.add_argument(
     'object',
     metavar = 'object',
+    nargs   = '?',
     help    = 'The object to display.'
 )
 
@@ -63,9 +114,15 @@ argsp = argsubparsers.add_parser(
     help = 'Check path(s) against ignore rules.'
 )
 
+argsp.add_argument(
+    '--stdin',
+    action = 'store_true',
+    help   = 'Read paths from standard input, one per line.'
+)
+
 argsp.add_argument(
     'path',
-    nargs = '+',
+    nargs = '*',
     help  = 'Paths to check.'
 )
 
@@ -75,13 +132,21 @@ argsp = argsubparsers.add_parser(
     help = 'Checkout a commit inside of a directory.'
 )
 
+argsp.add_argument(
+    '-j',
+    '--jobs',
+    type    = int,
+    default = None,
+    help    = 'Number of files written in parallel (default: checkout.jobs, or one per CPU).'
+)
+
 argsp.add_argument(
     'commit',
     help = 'The commit or tree to checkout to.'
 )
 argsp.add_argument(
     'path',
-    help = 'The EMPTY directory to checkout on.'
+    help = 'The EMPTY directory to checkout on. The worktree, if it only holds .tea, also gets its index written.'
 )
 
 # COMMIT
@@ -124,6 +189,47 @@ argsp.add_argument(
     help = 'Read object from <file>.'
 )
 
+# DIFF-TREE
+argsp = argsubparsers.add_parser(
+    'diff-tree',
+    help = 'Compare the content of two tree objects.'
+)
+
+argsp.add_argument(
+    '-r',
+    dest = 'recursive',
+    action = 'store_true',
+    help = 'Recurse into sub-trees.'
+)
+
+argsp.add_argument(
+    'tree_a',
+    help = 'A tree-ish object.'
+)
+
+argsp.add_argument(
+    'tree_b',
+    help = 'Another tree-ish object.'
+)
+
+# FSMONITOR
+argsp = argsubparsers.add_parser(
+    'fsmonitor',
+    help = 'Run a daemon watching the worktree, to speed up status (see core.fsmonitor).'
+)
+
+argsp.add_argument(
+    '--detach',
+    action = 'store_true',
+    help   = 'Run in the background.'
+)
+
+argsp.add_argument(
+    '--stop',
+    action = 'store_true',
+    help   = 'Stop the running daemon.'
+)
+
 # INIT
 argsp = argsubparsers.add_parser(
     'init',
@@ -181,6 +287,12 @@ argsp.add_argument(
     help = 'A tree-ish object.'
 )
 
+# REPACK
+argsp = argsubparsers.add_parser(
+    'repack',
+    help = 'Pack loose objects into a pack file.'
+)
+
 # REV-PARSE
 argsp = argsubparsers.add_parser(
     'rev-parse',
@@ -225,6 +337,25 @@ argsp = argsubparsers.add_parser(
     help = 'Show the working tree status.'
 )
 
+# SWITCH
+argsp = argsubparsers.add_parser(
+    'switch',
+    help = 'Switch the worktree, the index and HEAD to another commit.'
+)
+
+argsp.add_argument(
+    '-j',
+    '--jobs',
+    type    = int,
+    default = None,
+    help    = 'Number of files written in parallel (default: checkout.jobs, or one per CPU).'
+)
+
+argsp.add_argument(
+    'commit',
+    help = 'The branch or commit to switch to.'
+)
+
 # TAG
 argsp = argsubparsers.add_parser(
     'tag',
@@ -251,43 +382,101 @@ argsp.add_argument(
     help    = 'The object the new tag will point to.'
 )
 
+# UPDATE-INDEX
+argsp = argsubparsers.add_parser(
+    'update-index',
+    help = 'Modify the index.'
+)
+
+argsp.add_argument(
+    '--index-version',
+    type     = int,
+    choices  = [2, 4],
+    required = True,
+    help     = 'Rewrite the index in this format version.'
+)
+
 # =================================================================
 #                              COMMANDS
 # =================================================================
 
 def cmd_add(args):
     repo = repo_find()
-    add(repo, args.path)
+    add(repo, args.path, jobs=args.jobs)
 
 def cmd_cat_file(args):
+    if (args.batch):
+        # The repository is opened once for all the lookups
+        repo = repo_find()
+        cat_file_batch(
+            repo,
+            sys.stdin.buffer,
+            sys.stdout.buffer,
+            contents = args.batch == 'batch',
+            flush    = not args.buffer
+        )
+        return
+
+    # With -t and -s, the only positional argument is the object
+    if (args.show_type or args.show_size):
+        if (not args.type or args.object):
+            argparser.error("cat-file: -t and -s take exactly one object")
+
+        repo = repo_find()
+        cat_file_info(repo, args.type, size=args.show_size)
+        return
+
+    if (not (args.type and args.object)):
+        argparser.error("cat-file: a type and an object are required")
+
+    if (not args.type in ['blob', 'commit', 'tag', 'tree']):
+        argparser.error(f"cat-file: invalid type {args.type} (choose from blob, commit, tag, tree)")
+
     repo = repo_find()
     cat_file(repo, args.object, fmt=args.type.encode())
 
 def cmd_checkout(args):
     repo = repo_find()
 
-    obj = object_read(repo, object_find(repo, args.commit))
+    # If the object is a commit, object_find grabs its tree
+    tree = object_find(repo, args.commit, fmt=b'tree')
+    obj = object_read(repo, tree)
+
+    path = os.path.realpath(args.path)
 
-    # If the object is a commit, we grab its tree
-    if (obj.fmt == b'commit'):
-        obj = object_read(repo, obj.kvlm[b'tree'].decode('ascii'))
+    # The worktree itself counts as empty if it only holds .tea
+    in_worktree = path == os.path.realpath(repo.worktree)
+    allowed = [ os.path.basename(repo.teadir) ] if in_worktree else []
 
     # Verify that path is an empty directory
     if (os.path.exists(args.path)):
         if (not os.path.isdir(args.path)):
             raise Exception(f"Not a directory {args.path}!")
-        if (os.listdir(args.path)):
+        if (os.listdir(args.path) != allowed):
             raise Exception(f"Not empty {args.path}!")
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    start = time.perf_counter()
+    files = tree_checkout(repo, obj, path, jobs=args.jobs)
+    elapsed = time.perf_counter() - start
+
+    # The index describes the worktree: it gets the files just written
+    if (in_worktree):
+        index_from_checkout(repo, tree, files)
+
+    print(f"Checked out {len(files)} files in {elapsed:.2f}s ({len(files) / max(elapsed, 1e-9):.0f} files/s)")
 
 def cmd_check_ignore(args):
+    if (args.stdin == bool(args.path)):
+        argparser.error("check-ignore: takes either paths or --stdin")
+
     repo = repo_find()
     rules = teaignore_read(repo)
 
-    for path in args.path:
+    paths = (line.rstrip("\n") for line in sys.stdin) if args.stdin else args.path
+
+    for path in paths:
         if (check_ignore(rules, path)):
             print(path)
 
@@ -295,8 +484,11 @@ def cmd_commit(args):
     repo = repo_find()
     index = index_read(repo)
 
-    # Create trees, grab back SHA for the root tree.
+    # Create trees, grab back SHA for the root tree. Only directories
+    # changed since the last commit are written; the index keeps the
+    # others' trees for next time.
     tree = tree_from_index(repo, index)
+    index_write(repo, index)
 
     # Create the commit object itself
     commit = commit_create(
@@ -312,11 +504,26 @@ def cmd_commit(args):
     active_branch = branch_get_active(repo)
 
     if (active_branch): # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
+        ref_create(repo, os.path.join("heads", active_branch), commit)
     else: # Otherwise we update HEAD itself
+        # Like ref_create: the commit must be durable before HEAD
+        # points to it
+        object_flush(repo)
+
         with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
+            fd.write(commit + "\n")
+
+def cmd_diff_tree(args):
+    repo = repo_find()
+    diff_tree(repo, args.tree_a, args.tree_b, args.recursive)
+
+def cmd_fsmonitor(args):
+    repo = repo_find()
+
+    if (args.stop):
+        fsmonitor_stop(repo)
+    else:
+        fsmonitor_run(repo, detach=args.detach)
 
 def cmd_hash_object(args):
     if (args.write):
@@ -384,6 +591,10 @@ def cmd_ls_tree(args):
     repo = repo_find()
     ls_tree(repo, args.tree, args.recursive)
 
+def cmd_repack(args):
+    repo = repo_find()
+    repack(repo)
+
 def cmd_rev_parse(args):
     if (args.type):
         fmt = args.type.encode()
@@ -410,7 +621,16 @@ def cmd_status(args):
     cmd_status_branch(repo)
     cmd_status_head_index(repo, index)
     print()
-    cmd_status_index_worktree(repo, index)
+
+    # Files found unchanged despite new stat data got their index entry
+    # refreshed: save it, unless another command holds the index or
+    # changed it since we read it.
+    if (cmd_status_index_worktree(repo, index)):
+        index_write(repo, index, opportunistic=True)
+
+def cmd_switch(args):
+    repo = repo_find()
+    switch(repo, args.commit, jobs=args.jobs)
 
 def cmd_tag(args):
     repo = repo_find()
@@ -420,30 +640,52 @@ def cmd_tag(args):
             repo,
             args.name,
             args.object,
-            #args.create_tag_object
-            'object' if args.create_tag_object else 'ref'
+            args.create_tag_object
         )
     else:
         refs = ref_list(repo)
         show_ref(repo, refs['tags'], with_hash=False)
 
+def cmd_update_index(args):
+    repo = repo_find()
+    index = index_read(repo)
+
+    index.version = args.index_version
+    index_write(repo, index)
+
 def main(argv = sys.argv[1:]):
     args = argparser.parse_args(argv)
 
-    match args.command:
-        case 'add'          : cmd_add(args)
-        case 'cat-file'     : cmd_cat_file(args)
-        case 'check-ignore' : cmd_check_ignore(args)
-        case 'checkout'     : cmd_checkout(args)
-        case 'commit'       : cmd_commit(args)
-        case 'hash-object'  : cmd_hash_object(args)
-        case 'init'         : cmd_init(args)
-        case 'log'          : cmd_log(args)
-        case 'ls-files'     : cmd_ls_files(args)
-        case 'ls-tree'      : cmd_ls_tree(args)
-        case 'rev-parse'    : cmd_rev_parse(args)
-        case 'rm'           : cmd_rm(args)
-        case 'show-ref'     : cmd_show_ref(args)
-        case 'status'       : cmd_status(args)
-        case 'tag'          : cmd_tag(args)
-        case _              : print('Bad command')
+    try:
+        match args.command:
+            case 'add'          : cmd_add(args)
+            case 'cat-file'     : cmd_cat_file(args)
+            case 'check-ignore' : cmd_check_ignore(args)
+            case 'checkout'     : cmd_checkout(args)
+            case 'commit'       : cmd_commit(args)
+            case 'diff-tree'    : cmd_diff_tree(args)
+            case 'fsmonitor'    : cmd_fsmonitor(args)
+            case 'hash-object'  : cmd_hash_object(args)
+            case 'init'         : cmd_init(args)
+            case 'log'          : cmd_log(args)
+            case 'ls-files'     : cmd_ls_files(args)
+            case 'ls-tree'      : cmd_ls_tree(args)
+            case 'repack'       : cmd_repack(args)
+            case 'rev-parse'    : cmd_rev_parse(args)
+            case 'rm'           : cmd_rm(args)
+            case 'show-ref'     : cmd_show_ref(args)
+            case 'status'       : cmd_status(args)
+            case 'switch'       : cmd_switch(args)
+            case 'tag'          : cmd_tag(args)
+            case 'update-index' : cmd_update_index(args)
+            case _              : print('Bad command')
+    finally:
+        # Objects written in core.fsync=batch mode that nothing has
+        # published yet (eg. hash-object -w, or a failed command)
+        object_flush()
+
+    # TEA_CACHE_STATS=1 reports how the object cache did, to help
+    # sizing core.objectCacheLimit
+    if (os.environ.get("TEA_CACHE_STATS")):
+        for (teadir, cache) in object_caches.items():
+            print(f"{teadir}: {cache.stats()}", file=sys.stderr)
@@ -0,0 +1,105 @@
+import collections
+
+# Default byte budget of the object cache. Can be changed with
+# core.objectCacheLimit in .tea/config (0 disables the cache).
+OBJECT_CACHE_DEFAULT_LIMIT = 64 * 1024 * 1024
+
+# One cache per repository (keyed by its .tea directory), shared by every
+# TeaRepository instance of the process.
+object_caches = dict()
+
+class TeaObjectCache(object):
+    """
+    A bounded cache of decoded objects, keyed by SHA. Each object is
+    accounted for by the size of its raw data; when the budget is
+    exceeded, the least recently used objects are evicted.
+    """
+
+    limit = None
+    size = None
+    entries = None
+
+    def __init__(self, limit=OBJECT_CACHE_DEFAULT_LIMIT):
+        self.limit = limit
+        self.size = 0
+
+        # sha -> (object, size). Most recently used last.
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        entry = self.entries.get(sha)
+
+        if (entry is None):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(sha)
+        return entry[0]
+
+    def peek(self, sha):
+        """
+        Return (object, size) if sha is cached, without counting a hit or
+        a miss nor refreshing the entry.
+        """
+
+        return self.entries.get(sha)
+
+    def put(self, sha, obj, size):
+        # Objects that could never fit aren't worth evicting everything
+        if (size > self.limit or sha in self.entries):
+            return
+
+        self.entries[sha] = (obj, size)
+        self.size += size
+
+        while (self.size > self.limit):
+            (_, (_, evicted_size)) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        ratio = 100 * self.hits / lookups if lookups else 0
+
+        return "object cache: {} hits, {} misses ({:.1f}% hit rate), {} evictions, {} objects, {}/{} bytes".format(
+            self.hits,
+            self.misses,
+            ratio,
+            self.evictions,
+            len(self.entries),
+            self.size,
+            self.limit
+        )
+
+def config_size_parse(value):
+    """
+    Parse a size such as 1024, 512k, 64m or 1g.
+    """
+
+    value = value.strip().lower()
+    units = { 'k': 1024, 'm': 1024**2, 'g': 1024**3 }
+
+    if (value and value[-1] in units):
+        return int(value[:-1]) * units[value[-1]]
+
+    return int(value)
+
+def object_cache_get(repo):
+    """
+    Return the object cache of repo, creating it on first use.
+    """
+
+    if (not repo.teadir in object_caches):
+        limit = OBJECT_CACHE_DEFAULT_LIMIT
+
+        if (repo.conf.has_option("core", "objectCacheLimit")):
+            limit = config_size_parse(repo.conf.get("core", "objectCacheLimit"))
+
+        object_caches[repo.teadir] = TeaObjectCache(limit)
+
+    return object_caches[repo.teadir]
@@ -0,0 +1,902 @@
+import io
+import os
+import mmap
+import zlib
+import hashlib
+
+from lib.compression import compression_level, inflate_chunks
+from lib.fsync import FSYNC_NONE, fsync_dir, fsync_file, fsync_mode
+from lib.repo_functions import repo_dir
+
+# Object types, as stored in the 3-bit type field of a pack entry header
+PACK_OBJ_COMMIT    = 1
+PACK_OBJ_TREE      = 2
+PACK_OBJ_BLOB      = 3
+PACK_OBJ_TAG       = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_FMT_TO_TYPE = {
+    b'commit' : PACK_OBJ_COMMIT,
+    b'tree'   : PACK_OBJ_TREE,
+    b'blob'   : PACK_OBJ_BLOB,
+    b'tag'    : PACK_OBJ_TAG,
+}
+
+PACK_TYPE_TO_FMT = { v: k for (k, v) in PACK_FMT_TO_TYPE.items() }
+
+# How many preceding objects we try as a delta base, and how long a
+# chain of deltas is allowed to become before we store an object whole.
+PACK_DEFAULT_WINDOW = 10
+PACK_DEFAULT_DEPTH  = 50
+
+# Deltas are computed in pure python, so we don't bother with objects
+# that are too small to win anything or too big to be diffed quickly.
+DELTA_MIN_SIZE   = 64
+DELTA_MAX_SIZE   = 1 << 20
+DELTA_BLOCK_SIZE = 16
+
+# How much of a compressed delta info_at feeds zlib at a time, looking
+# for its header
+PACK_INFO_CHUNK_SIZE = 256
+
+# =================================================================
+#                            DELTA ENCODING
+# =================================================================
+
+def delta_varint_encode(n):
+    """
+    Little-endian base 128 integer, as used for the two sizes that start
+    a delta.
+    """
+
+    ret = bytearray()
+
+    while (True):
+        byte = n & 0x7F
+        n >>= 7
+
+        if (n):
+            ret.append(byte | 0x80)
+        else:
+            ret.append(byte)
+            return bytes(ret)
+
+def delta_varint_decode(data, pos):
+    n = 0
+    shift = 0
+
+    while (True):
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        shift += 7
+
+        if (not (byte & 0x80)):
+            return (n, pos)
+
+def delta_emit_insert(out, data):
+    # An insert instruction can carry at most 127 bytes
+    for i in range(0, len(data), 0x7F):
+        chunk = data[i:i+0x7F]
+        out.append(len(chunk))
+        out += chunk
+
+def delta_emit_copy(out, offset, size):
+    # A copy instruction can copy at most 0x10000 bytes
+    while (size > 0):
+        chunk = min(size, 0x10000)
+
+        cmd = 0x80
+        args = bytearray()
+
+        for i in range(4):
+            byte = (offset >> (8 * i)) & 0xFF
+            if (byte):
+                cmd |= 1 << i
+                args.append(byte)
+
+        # A size of 0x10000 is encoded as no size bytes at all
+        if (chunk != 0x10000):
+            for i in range(3):
+                byte = (chunk >> (8 * i)) & 0xFF
+                if (byte):
+                    cmd |= 0x10 << i
+                    args.append(byte)
+
+        out.append(cmd)
+        out += args
+
+        offset += chunk
+        size -= chunk
+
+def delta_index(base):
+    """
+    Map every aligned block of base to its first offset, so that
+    delta_create can find copy candidates with a dict lookup.
+    """
+
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        index.setdefault(base[i:i+DELTA_BLOCK_SIZE], i)
+
+    return index
+
+def delta_create(base, target, index=None, max_size=None):
+    """
+    Compute a delta that turns base into target. Return None if the
+    delta would be larger than max_size.
+    """
+
+    if (index is None):
+        index = delta_index(base)
+
+    if (max_size is None):
+        max_size = len(target)
+
+    out = bytearray()
+    out += delta_varint_encode(len(base))
+    out += delta_varint_encode(len(target))
+
+    pos = 0
+    pending = pos
+    end = len(target) - DELTA_BLOCK_SIZE + 1
+
+    while (pos < end):
+        offset = index.get(target[pos:pos+DELTA_BLOCK_SIZE])
+
+        if (offset is None):
+            pos += 1
+            continue
+
+        # We have a match: extend it as far as it goes, first in big
+        # steps, then byte by byte.
+        size = DELTA_BLOCK_SIZE
+        limit = min(len(base) - offset, len(target) - pos)
+
+        while (size + 64 <= limit and
+               base[offset+size:offset+size+64] == target[pos+size:pos+size+64]):
+            size += 64
+
+        while (size < limit and base[offset+size] == target[pos+size]):
+            size += 1
+
+        delta_emit_insert(out, target[pending:pos])
+        delta_emit_copy(out, offset, size)
+
+        pos += size
+        pending = pos
+
+        if (len(out) >= max_size):
+            return None
+
+    delta_emit_insert(out, target[pending:])
+
+    if (len(out) >= max_size):
+        return None
+
+    return bytes(out)
+
+def delta_apply(base, delta):
+    """
+    Rebuild an object from its base and a delta.
+    """
+
+    (base_size, pos) = delta_varint_decode(delta, 0)
+    (target_size, pos) = delta_varint_decode(delta, pos)
+
+    if (base_size != len(base)):
+        raise Exception("Delta base size mismatch")
+
+    out = bytearray()
+    end = len(delta)
+
+    while (pos < end):
+        cmd = delta[pos]
+        pos += 1
+
+        if (cmd & 0x80): # Copy from base
+            offset = 0
+            for i in range(4):
+                if (cmd & (1 << i)):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+
+            size = 0
+            for i in range(3):
+                if (cmd & (0x10 << i)):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+
+            if (size == 0):
+                size = 0x10000
+
+            out += base[offset:offset+size]
+        elif (cmd): # Insert literal data
+            out += delta[pos:pos+cmd]
+            pos += cmd
+        else:
+            raise Exception("Invalid delta opcode 0")
+
+    if (len(out) != target_size):
+        raise Exception("Delta result size mismatch")
+
+    return bytes(out)
+
+# =================================================================
+#                             PACK FILES
+# =================================================================
+
+def pack_entry_header(type, size):
+    """
+    Encode the type and the inflated size of an entry: 3 bits of type and
+    4 bits of size in the first byte, then 7 more bits of size per byte.
+    """
+
+    ret = bytearray()
+
+    byte = (type << 4) | (size & 0x0F)
+    size >>= 4
+
+    while (size):
+        ret.append(byte | 0x80)
+        byte = size & 0x7F
+        size >>= 7
+
+    ret.append(byte)
+    return bytes(ret)
+
+def pack_ofs_encode(n):
+    """
+    Encode the (negative) distance to an OFS_DELTA base. Each
+    continuation adds one, so that no two encodings mean the same number.
+    """
+
+    ret = bytearray([ n & 0x7F ])
+    n >>= 7
+
+    while (n):
+        n -= 1
+        ret.insert(0, 0x80 | (n & 0x7F))
+        n >>= 7
+
+    return bytes(ret)
+
+class TeaPack(object):
+    """
+    A pack file: many objects, zlib-compressed one after the other, some
+    of them stored as deltas against another object of the same pack.
+    """
+
+    path = None
+    data = None
+    count = None
+    index = None
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        BAD_SIGNATURE = self.data[0:4] != b'PACK'
+        if (BAD_SIGNATURE):
+            raise Exception(f"Not a pack file {path}")
+
+        version = int.from_bytes(self.data[4:8], 'big')
+        if (version != 2):
+            raise Exception(f"Unsupported pack version {version} in {path}")
+
+        self.count = int.from_bytes(self.data[8:12], 'big')
+
+        # Packs written before we had indexes get one on first use
+        idx_path = path[:-len(".pack")] + ".idx"
+        if (not os.path.exists(idx_path)):
+            pack_index_write(idx_path, self.scan(), self.data[-20:])
+
+        self.index = TeaPackIndex(idx_path)
+
+        if (self.index.count != self.count):
+            raise Exception(f"Pack index {idx_path} doesn't match its pack")
+
+    def entry_header(self, offset):
+        """
+        Parse the header of the entry at offset. Return (type, size,
+        base, data_offset), where base is the offset (OFS_DELTA) or the
+        SHA (REF_DELTA) of the delta base, None otherwise.
+        """
+
+        start = offset
+        byte = self.data[offset]
+        offset += 1
+
+        type = (byte >> 4) & 0x07
+        size = byte & 0x0F
+        shift = 4
+
+        while (byte & 0x80):
+            byte = self.data[offset]
+            offset += 1
+            size |= (byte & 0x7F) << shift
+            shift += 7
+
+        base = None
+
+        if (type == PACK_OBJ_OFS_DELTA):
+            byte = self.data[offset]
+            offset += 1
+            distance = byte & 0x7F
+
+            while (byte & 0x80):
+                byte = self.data[offset]
+                offset += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7F)
+
+            base = start - distance
+        elif (type == PACK_OBJ_REF_DELTA):
+            base = self.data[offset:offset+20].hex()
+            offset += 20
+
+        return (type, size, base, offset)
+
+    def inflate(self, offset, size=None):
+        """
+        Inflate the zlib stream starting at offset. Return the data and
+        the offset right after the stream.
+        """
+
+        d = zlib.decompressobj()
+        chunks = list()
+        pos = offset
+        end = len(self.data) - 20
+
+        while (not d.eof):
+            CORRUPT_STREAM = pos >= end
+            if (CORRUPT_STREAM):
+                raise Exception(f"Truncated entry at {offset} in {self.path}")
+
+            chunk = self.data[pos:pos+65536]
+            chunks.append(d.decompress(chunk))
+            pos += len(chunk)
+
+        pos -= len(d.unused_data)
+        data = b''.join(chunks)
+
+        if (size is not None and len(data) != size):
+            raise Exception(f"Malformed entry at {offset} in {self.path}: bad length")
+
+        return (data, pos)
+
+    def read_at(self, offset, repo=None):
+        """
+        Read the entry at offset, resolving deltas. Return (fmt, data).
+        """
+
+        (type, size, base, data_offset) = self.entry_header(offset)
+        (data, _) = self.inflate(data_offset, size)
+
+        if (type == PACK_OBJ_OFS_DELTA):
+            (fmt, base_data) = self.read_at(base, repo)
+            return (fmt, delta_apply(base_data, data))
+
+        if (type == PACK_OBJ_REF_DELTA):
+            (fmt, base_data) = self.read_sha(base, repo)
+            return (fmt, delta_apply(base_data, data))
+
+        if (type not in PACK_TYPE_TO_FMT):
+            raise Exception(f"Unknown pack entry type {type} at {offset} in {self.path}")
+
+        return (PACK_TYPE_TO_FMT[type], data)
+
+    def read_into(self, offset, out, repo=None):
+        """
+        Write the data of the entry at offset to out, a binary file.
+        Return (fmt, size). Only deltas are held in memory as a whole,
+        their base being needed to apply them.
+        """
+
+        (type, size, base, data_offset) = self.entry_header(offset)
+
+        if (type not in PACK_TYPE_TO_FMT):
+            (fmt, data) = self.read_at(offset, repo)
+            out.write(data)
+            return (fmt, len(data))
+
+        end = len(self.data) - 20
+        written = 0
+
+        for data in inflate_chunks(self.data[pos:pos+65536] for pos in range(data_offset, end, 65536)):
+            out.write(data)
+            written += len(data)
+
+        if (written != size):
+            raise Exception(f"Malformed entry at {offset} in {self.path}: bad length")
+
+        return (PACK_TYPE_TO_FMT[type], size)
+
+    def info_at(self, offset, repo=None):
+        """
+        Return (fmt, size) for the entry at offset. Deltas are only
+        inflated far enough to read the size of the object they produce;
+        the type comes from the header at the end of the base chain.
+        """
+
+        (type, size, base, data_offset) = self.entry_header(offset)
+
+        if (type in PACK_TYPE_TO_FMT):
+            return (PACK_TYPE_TO_FMT[type], size)
+
+        # The delta starts with the base size and the result size,
+        # two varints of at most 10 bytes each. Deflate may only
+        # output them once it has read its whole Huffman table: input
+        # is fed until they come out, or the delta ends.
+        chunks = (self.data[i:i + PACK_INFO_CHUNK_SIZE]
+                  for i in range(data_offset, len(self.data), PACK_INFO_CHUNK_SIZE))
+        delta_header = b''
+
+        for data in inflate_chunks(chunks, 20):
+            delta_header += data
+            if (len(delta_header) >= 20):
+                break
+
+        (_, pos) = delta_varint_decode(delta_header, 0)
+        (size, _) = delta_varint_decode(delta_header, pos)
+
+        if (type == PACK_OBJ_OFS_DELTA):
+            (fmt, _) = self.info_at(base, repo)
+        elif (type == PACK_OBJ_REF_DELTA):
+            base_offset = self.lookup(base)
+
+            if (base_offset is not None):
+                (fmt, _) = self.info_at(base_offset, repo)
+            else:
+                (fmt, _) = pack_object_info(repo, base)
+        else:
+            raise Exception(f"Unknown pack entry type {type} at {offset} in {self.path}")
+
+        return (fmt, size)
+
+    def read_sha(self, sha, repo=None):
+        offset = self.lookup(sha)
+
+        if (offset is not None):
+            return self.read_at(offset, repo)
+
+        # A REF_DELTA base may live outside of this pack
+        if (repo):
+            raw = pack_object_read(repo, sha)
+            if (raw):
+                return raw
+
+        raise Exception(f"Missing delta base {sha} for {self.path}")
+
+    def scan(self):
+        """
+        Walk every entry of the pack, hashing the objects to find out
+        their names. Return a list of (sha, offset, crc32), as needed to
+        build the pack index.
+        """
+
+        ret = list()
+        offsets = dict()
+        by_offset = dict()
+        pos = 12
+
+        for _ in range(self.count):
+            (type, size, base, data_offset) = self.entry_header(pos)
+            (data, end) = self.inflate(data_offset, size)
+
+            if (type == PACK_OBJ_OFS_DELTA):
+                (fmt, base_data) = by_offset[base]
+                data = delta_apply(base_data, data)
+            elif (type == PACK_OBJ_REF_DELTA):
+                (fmt, base_data) = by_offset[offsets[base]]
+                data = delta_apply(base_data, data)
+            else:
+                fmt = PACK_TYPE_TO_FMT[type]
+
+            header = fmt + b' ' + str(len(data)).encode() + b'\x00'
+            sha = hashlib.sha1(header + data).hexdigest()
+
+            ret.append((sha, pos, zlib.crc32(self.data[pos:end])))
+            offsets[sha] = pos
+            by_offset[pos] = (fmt, data)
+            pos = end
+
+        return ret
+
+    def lookup(self, sha):
+        """
+        Return the offset of object sha in this pack, or None.
+        """
+
+        return self.index.lookup(sha)
+
+    def prefix_lookup(self, prefix):
+        return self.index.prefix_lookup(prefix)
+
+# =================================================================
+#                             PACK INDEX
+# =================================================================
+
+# Layout of a .idx file (version 2, as in git):
+#
+#   magic, version       : b'\377tOc', 2
+#   fanout[256]          : 4 bytes each, fanout[b] is the number of
+#                          objects whose first SHA byte is <= b
+#   shas[N]              : 20 bytes each, sorted
+#   crc32[N]             : 4 bytes each, of the packed entry
+#   offsets[N]           : 4 bytes each; if the high bit is set, the low
+#                          31 bits index into the large offset table
+#   large_offsets[M]     : 8 bytes each
+#   pack sha, index sha  : 20 bytes each
+
+PACK_IDX_MAGIC = b'\377tOc'
+
+class TeaPackIndex(object):
+    """
+    The index of a pack, mmap'd. Objects are found by binary search in the
+    sorted SHA table, narrowed down by the fanout table.
+    """
+
+    path = None
+    data = None
+    count = None
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        BAD_HEADER = self.data[0:4] != PACK_IDX_MAGIC or int.from_bytes(self.data[4:8], 'big') != 2
+        if (BAD_HEADER):
+            raise Exception(f"Unsupported pack index {path}")
+
+        self.count = self.fanout(255)
+
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+    def fanout(self, byte):
+        pos = 8 + 4 * byte
+        return int.from_bytes(self.data[pos:pos+4], 'big')
+
+    def sha_at(self, i):
+        pos = self.sha_table + 20 * i
+        return self.data[pos:pos+20]
+
+    def offset_at(self, i):
+        pos = self.offset_table + 4 * i
+        offset = int.from_bytes(self.data[pos:pos+4], 'big')
+
+        if (offset & 0x80000000):
+            pos = self.large_offset_table + 8 * (offset & 0x7FFFFFFF)
+            offset = int.from_bytes(self.data[pos:pos+8], 'big')
+
+        return offset
+
+    def search(self, key):
+        """
+        Return the position of the first SHA >= key (a bytes string of
+        at most 20 bytes) in the SHA table.
+        """
+
+        first = key[0]
+        lo = self.fanout(first - 1) if first else 0
+        hi = self.fanout(first)
+
+        while (lo < hi):
+            mid = (lo + hi) // 2
+            if (self.sha_at(mid)[:len(key)] < key):
+                lo = mid + 1
+            else:
+                hi = mid
+
+        return lo
+
+    def lookup(self, sha):
+        key = bytes.fromhex(sha)
+        i = self.search(key)
+
+        FOUND = i < self.count and self.sha_at(i) == key
+        if (FOUND):
+            return self.offset_at(i)
+
+        return None
+
+    def prefix_lookup(self, prefix):
+        """
+        Return the SHAs starting with the hex string prefix.
+        """
+
+        ret = list()
+
+        # Search on the whole bytes of the prefix, then filter on the
+        # odd nibble if there's one.
+        key = bytes.fromhex(prefix[:len(prefix) & ~1])
+        i = self.search(key)
+
+        while (i < self.count):
+            sha = self.sha_at(i).hex()
+            if (not sha.startswith(prefix[:len(key) * 2])):
+                break
+            if (sha.startswith(prefix)):
+                ret.append(sha)
+            i += 1
+
+        return ret
+
+def pack_index_write(path, entries, pack_checksum, sync=False):
+    """
+    Write the index of a pack. entries is a list of (sha, offset, crc32).
+    With sync, it is made durable before it gets its final name.
+    """
+
+    entries = sorted(entries)
+    checksum = hashlib.sha1()
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, 'wb') as f:
+        def out(data):
+            checksum.update(data)
+            f.write(data)
+
+        out(PACK_IDX_MAGIC + (2).to_bytes(4, 'big'))
+
+        # Fanout table
+        counts = [ 0 ] * 256
+        for (sha, _, _) in entries:
+            counts[int(sha[0:2], 16)] += 1
+
+        total = 0
+        fanout = bytearray()
+        for c in counts:
+            total += c
+            fanout += total.to_bytes(4, 'big')
+        out(bytes(fanout))
+
+        out(b''.join(bytes.fromhex(sha) for (sha, _, _) in entries))
+        out(b''.join(crc.to_bytes(4, 'big') for (_, _, crc) in entries))
+
+        # Offsets that don't fit on 31 bits go to the large offset table
+        offsets = bytearray()
+        large_offsets = bytearray()
+        for (_, offset, _) in entries:
+            if (offset < 0x80000000):
+                offsets += offset.to_bytes(4, 'big')
+            else:
+                offsets += (0x80000000 | (len(large_offsets) // 8)).to_bytes(4, 'big')
+                large_offsets += offset.to_bytes(8, 'big')
+        out(bytes(offsets))
+        out(bytes(large_offsets))
+
+        out(bytes(pack_checksum))
+        f.write(checksum.digest())
+
+        if (sync):
+            fsync_file(f)
+
+    os.replace(tmp_path, path)
+
+def pack_list(repo):
+    """
+    Open (once) every pack of the repository.
+    """
+
+    if (repo.packs is None):
+        packs = list()
+        path = repo_dir(repo, "objects", "pack")
+
+        if (path):
+            for f in sorted(os.listdir(path)):
+                if (f.startswith("pack-") and f.endswith(".pack")):
+                    packs.append(TeaPack(os.path.join(path, f)))
+
+        # Only publish the complete list: other threads may be looking
+        repo.packs = packs
+
+    return repo.packs
+
+def pack_object_read(repo, sha):
+    """
+    Look for object sha in the packs. Return (fmt, data) or None.
+    """
+
+    for pack in pack_list(repo):
+        offset = pack.lookup(sha)
+
+        if (offset is not None):
+            return pack.read_at(offset, repo)
+
+    return None
+
+def pack_object_read_into(repo, sha, out):
+    """
+    Look for object sha in the packs, and write its data to out. Return
+    (fmt, size) or None.
+    """
+
+    for pack in pack_list(repo):
+        offset = pack.lookup(sha)
+
+        if (offset is not None):
+            return pack.read_into(offset, out, repo)
+
+    return None
+
+def pack_object_info(repo, sha):
+    """
+    Look for object sha in the packs. Return (fmt, size) or None.
+    """
+
+    for pack in pack_list(repo):
+        offset = pack.lookup(sha)
+
+        if (offset is not None):
+            return pack.info_at(offset, repo)
+
+    return None
+
+def pack_contains(repo, sha):
+    for pack in pack_list(repo):
+        if (pack.lookup(sha) is not None):
+            return True
+
+    return False
+
+class TeaPackEntryWriter(object):
+    """
+    A binary file that deflates what is written to it into a pack entry,
+    for objects too big to be held in memory. The level is picked from
+    the first write, and the CRC32 of the compressed data is kept for the
+    pack index.
+    """
+
+    def __init__(self, out, level, crc):
+        self.out = out
+        self.level = level
+        self.crc = crc
+        self.size = 0
+        self.compressor = None
+
+    def write(self, data):
+        if (not data):
+            return
+
+        if (self.compressor is None):
+            self.compressor = zlib.compressobj(compression_level(self.level, data))
+
+        self.emit(self.compressor.compress(data))
+
+    def close(self):
+        if (self.compressor is None):
+            self.compressor = zlib.compressobj(self.level)
+
+        self.emit(self.compressor.flush())
+
+    def emit(self, payload):
+        if (payload):
+            self.crc = zlib.crc32(payload, self.crc)
+            self.size += len(payload)
+            self.out(payload)
+
+def pack_write(repo, objects, read_into, window=PACK_DEFAULT_WINDOW, depth=PACK_DEFAULT_DEPTH, level=-1):
+    """
+    Write objects, a list of (sha, fmt, size), into a new pack. Objects
+    are sorted by type and decreasing size, and each one is tried as a
+    delta against the few objects right before it. Return the pack path.
+
+    Data comes from read_into(sha, out), which writes it to the binary
+    file out. Only the objects of the delta window are held in memory:
+    the ones too big to be deltified are deflated into the pack as they
+    are read.
+    """
+
+    objects = sorted(objects, key=lambda o: (PACK_FMT_TO_TYPE[o[1]], -o[2]))
+
+    path = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(path, f"tmp_pack_{os.getpid()}")
+
+    checksum = hashlib.sha1()
+
+    # Entries we may still delta against, as (fmt, data, offset, depth, index)
+    candidates = list()
+
+    # (sha, offset, crc32) of every entry, for the pack index
+    entries = list()
+
+    with open(tmp_path, 'wb') as f:
+        def out(data):
+            checksum.update(data)
+            f.write(data)
+
+        out(b'PACK' + (2).to_bytes(4, 'big') + len(objects).to_bytes(4, 'big'))
+        offset = 12
+
+        for (sha, fmt, size) in objects:
+            if (size > DELTA_MAX_SIZE):
+                header = pack_entry_header(PACK_FMT_TO_TYPE[fmt], size)
+                out(header)
+
+                writer = TeaPackEntryWriter(out, level, zlib.crc32(header))
+                read_into(sha, writer)
+                writer.close()
+
+                entries.append((sha, offset, writer.crc))
+                offset += len(header) + writer.size
+                continue
+
+            buf = io.BytesIO()
+            read_into(sha, buf)
+            data = buf.getvalue()
+
+            best = None
+
+            CAN_DELTA = DELTA_MIN_SIZE <= len(data)
+            if (CAN_DELTA):
+                for (i, c) in enumerate(candidates):
+                    (base_fmt, base, base_offset, base_depth, index) = c
+
+                    # Don't bother with bases of another kind, chains that
+                    # are already too long, or bases much smaller than us.
+                    if (base_fmt != fmt or base_depth >= depth or len(base) < len(data) // 32):
+                        continue
+
+                    if (index is None):
+                        index = delta_index(base)
+                        candidates[i] = (base_fmt, base, base_offset, base_depth, index)
+
+                    max_size = len(best[0]) if best else len(data) // 2
+                    delta = delta_create(base, data, index, max_size)
+
+                    if (delta):
+                        best = (delta, base_offset, base_depth + 1)
+
+            if (best):
+                (delta, base_offset, entry_depth) = best
+                header = pack_entry_header(PACK_OBJ_OFS_DELTA, len(delta))
+                header += pack_ofs_encode(offset - base_offset)
+                payload = zlib.compress(delta, compression_level(level, delta))
+            else:
+                entry_depth = 0
+                header = pack_entry_header(PACK_FMT_TO_TYPE[fmt], len(data))
+                payload = zlib.compress(data, compression_level(level, data))
+
+            out(header)
+            out(payload)
+            entries.append((sha, offset, zlib.crc32(payload, zlib.crc32(header))))
+
+            if (CAN_DELTA):
+                candidates.append((fmt, data, offset, entry_depth, None))
+                if (len(candidates) > window):
+                    candidates.pop(0)
+
+            offset += len(header) + len(payload)
+
+        pack_sha = checksum.hexdigest()
+        f.write(checksum.digest())
+
+        # Callers may delete other copies of these objects (such as
+        # loose ones) once we return: with core.fsync, the pack must be
+        # durable by then.
+        sync = fsync_mode(repo) != FSYNC_NONE
+        if (sync):
+            fsync_file(f)
+
+    # The index goes first, so that a pack is never visible without it
+    pack_index_write(os.path.join(path, f"pack-{pack_sha}.idx"), entries, checksum.digest(), sync)
+
+    pack_path = os.path.join(path, f"pack-{pack_sha}.pack")
+    os.replace(tmp_path, pack_path)
+
+    # The renames themselves live in the directory
+    if (sync):
+        fsync_dir(path)
+
+    # Make the new pack visible to this process too
+    repo.packs = None
+
+    return pack_path
@@ -4,7 +4,7 @@ import collections
 
 from lib.repo_functions import repo_dir, repo_file
 from lib.tea_object import TeaTag
-from lib.tea_object_function import object_find, object_write, ref_resolve
+from lib.tea_object_function import object_find, object_flush, object_write, ref_resolve
 
 # ref: refs/remotes/origin/main
 
@@ -32,7 +32,7 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
     if (create_tag_object):
         # create tag object (commit)
-        tag = TeaTag(repo)
+        tag = TeaTag()
         tag.kvlm = collections.OrderedDict()
         tag.kvlm[b'object'] = sha.encode()
         tag.kvlm[b'type'] = b'commit'
@@ -41,7 +41,7 @@ def tag_create(repo, name, ref, create_tag_object=False):
         tag.kvlm[b'tagger'] = b'tea <tea@example.com>'
         tag.kvlm[None] = b'A default tag generated by tea'
 
-        tag_sha = object_write(tag)
+        tag_sha = object_write(tag, repo)
 
         # create ref
         ref_create(repo, 'tags/' + name, tag_sha)
@@ -50,5 +50,9 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, 'tags/' + name, sha)
 
 def ref_create(repo, ref_name, sha):
+    # Objects written in batch mode must be durable before a ref
+    # points to them
+    object_flush(repo)
+
     with open(repo_file(repo, 'refs/' + ref_name), 'w') as fp:
         fp.write(sha + '\n')
@@ -9,6 +9,7 @@ class TeaRepository(object):
     worktree = None
     teadir = None
     conf = None
+    packs = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -69,6 +70,20 @@ def repo_dir(repo, *path, mkdir=False):
     else:
         return None
 
+def repo_jobs(repo, section, jobs=None):
+    """
+    Number of worker threads for a command: jobs if given, otherwise
+    <section>.jobs from the configuration, otherwise one per CPU.
+    """
+
+    if (not jobs):
+        jobs = repo.conf.getint(section, "jobs", fallback=0)
+
+    if (not jobs):
+        jobs = os.cpu_count() or 1
+
+    return jobs
+
 def repo_default_config():
     ret = configparser.ConfigParser()
 
@@ -1,21 +1,116 @@
 import os
+import re
+import mmap
+import time
+import struct
+import hashlib
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.fsmonitor import fsmonitor_query
+from lib.repo_functions import repo_file, repo_jobs
+from lib.tea_object_function import object_find, object_read
+from lib.wrapper import hash_object, tree_diff
 
-from fnmatch import fnmatch
-from math import ceil
+# Index header: signature, version, number of entries
+INDEX_HEADER = struct.Struct(">4sLL")
 
-from lib.repo_functions import repo_file
-from lib.tea_object_function import object_find, object_read
-from lib.wrapper import hash_object
+# Fixed part of an index entry: ctime (s, ns), mtime (s, ns), dev, ino,
+# mode, uid, gid, size, SHA and flags. The NUL-terminated name follows.
+INDEX_ENTRY = struct.Struct(">LLLLLLLLLL20sH")
+
+# The flags alone, at the end of the fixed part
+INDEX_FLAGS = struct.Struct(">H")
+INDEX_FLAGS_OFFSET = INDEX_ENTRY.size - INDEX_FLAGS.size
+
+def index_entry_size(name_length):
+    """
+    On-disk size of an entry: the fixed part, the name and at least one
+    NUL, padded to a multiple of eight bytes.
+    """
+
+    return (INDEX_ENTRY.size + name_length + 8) & ~7
+
+# Supported index versions. Version 4 stores each name as the number of
+# bytes to strip from the end of the previous name, followed by the
+# suffix to append, and does not pad entries.
+INDEX_VERSIONS = (2, 4)
+
+def index_version_config(repo):
+    """
+    The version new indexes are written with (index.version, default 2).
+    Existing indexes keep their version until converted with
+    `tea update-index --index-version`.
+    """
+
+    version = repo.conf.getint("index", "version", fallback=2) if repo.conf else 2
+
+    if (version not in INDEX_VERSIONS):
+        raise Exception(f"Unsupported index.version {version}")
+
+    return version
+
+def index_varint_encode(n):
+    """
+    Encode n the way index v4 stores name prefix lengths (the same
+    encoding as OFS_DELTA distances in packs).
+    """
+
+    ret = bytearray([ n & 0x7F ])
+    n >>= 7
+
+    while (n):
+        n -= 1
+        ret.insert(0, 0x80 | (n & 0x7F))
+        n >>= 7
+
+    return bytes(ret)
+
+def index_varint_decode(raw, idx):
+    """
+    Decode the number at raw[idx]: return it, and the index of the byte
+    following it.
+    """
+
+    byte = raw[idx]
+    n = byte & 0x7F
+    idx += 1
+
+    while (byte & 0x80):
+        byte = raw[idx]
+        n = ((n + 1) << 7) | (byte & 0x7F)
+        idx += 1
+
+    return (n, idx)
 
 class TeaIndexEntry(object):
+    # Entries read from the index only decode their name eagerly. They
+    # keep a reference to the mapped index file and the offset of their
+    # record, and the other slots stay empty until one of them is first
+    # used: __getattr__ is only called for those, and fills them all.
+    __slots__ = ('ctime', 'mtime', 'dev', 'ino', 'mode_type', 'mode_perms',
+                 'uid', 'gid', 'fsize', 'sha', 'flag_assume_valid',
+                 'flag_stage', 'name', 'raw', 'offset')
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, raw=None, offset=None):
+        # Name of the object (full path)
+        self.name = name
+
+        # The mapped index and the offset of this entry's record, until
+        # it is decoded
+        self.raw = raw
+        self.offset = offset
+
+        if (raw is not None):
+            return
+
         # The last time a file's metadata changed. This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
-        
+
         # The last time a file's data changed. This is a pair
         # (timestamp in seconds, nanoseconds)
         self.mtime = mtime
@@ -47,97 +142,298 @@ class TeaIndexEntry(object):
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
 
-        # Name of the object (full path)
-        self.name = name
+    def __getattr__(self, attr):
+        if (self.raw is None):
+            raise AttributeError(attr)
+
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = INDEX_ENTRY.unpack_from(self.raw, self.offset)
+
+        # The high 16 bits of the mode are unused
+        assert mode >> 16 == 0
+        mode_type = mode >> 12
+        assert mode_type in [0b1000, 0b1010, 0b1110]
+
+        self.ctime = (ctime_s, ctime_ns)
+        self.mtime = (mtime_s, mtime_ns)
+        self.dev = dev
+        self.ino = ino
+        self.mode_type = mode_type
+        self.mode_perms = mode & 0b0000000111111111
+        self.uid = uid
+        self.gid = gid
+        self.fsize = fsize
+        # SHA (object ID). We'll store it as a lowercase hex string for
+        # consistency
+        self.sha = sha.hex()
+        self.flag_assume_valid = (flags & 0b1000000000000000) != 0
+        self.flag_stage = flags & 0b0011000000000000
+
+        self.raw = None
+
+        return getattr(self, attr)
+
+    def raw_record(self):
+        """
+        The fixed part of the entry as read from the index, or None once
+        it has been decoded (and possibly modified).
+        """
+
+        if (self.raw is None):
+            return None
+
+        return self.raw[self.offset:self.offset + INDEX_ENTRY.size]
+
+def index_entry_from_stat(stat, sha, name):
+    # Seconds and nanoseconds both come from the exact st_*_ns: the
+    # float st_mtime may round up to the next second.
+    (ctime_s, ctime_ns) = divmod(stat.st_ctime_ns, 10**9)
+    (mtime_s, mtime_ns) = divmod(stat.st_mtime_ns, 10**9)
+
+    return TeaIndexEntry(
+                ctime = (ctime_s, ctime_ns),
+                mtime = (mtime_s, mtime_ns),
+                dev = stat.st_dev,
+                ino = stat.st_ino,
+                mode_type = 0b1000,
+                mode_perms = 0o644,
+                uid = stat.st_uid,
+                gid = stat.st_gid,
+                fsize = stat.st_size,
+                sha = sha,
+                flag_assume_valid = False,
+                flag_stage = False,
+                name = name
+            )
+
+def index_entry_stat_changed(entry, stat, filemode=False):
+    """
+    Whether a file's stat disagrees with the stat data of its index
+    entry. If it doesn't, the file is taken to be unchanged without
+    reading it (but see index_entry_racy).
+
+    The index only keeps the low 32 bits of dev, ino and size. The
+    executable bit is only compared when core.filemode is set.
+    """
+
+    return (entry.mtime != divmod(stat.st_mtime_ns, 10**9)
+            or entry.ctime != divmod(stat.st_ctime_ns, 10**9)
+            or entry.fsize != stat.st_size & 0xFFFFFFFF
+            or entry.ino != stat.st_ino & 0xFFFFFFFF
+            or entry.dev != stat.st_dev & 0xFFFFFFFF
+            or entry.mode_type != stat.st_mode >> 12
+            or (filemode and (entry.mode_perms & 0o100) != (stat.st_mode & 0o100)))
+
+def index_entry_racy(entry, index_mtime_ns):
+    """
+    Whether entry is "racy": its file was modified no earlier than the
+    index was written. The file may then have changed again within the
+    same timestamp, after its stat data was recorded, so matching stat
+    data proves nothing.
+    """
+
+    if (index_mtime_ns is None):
+        return False
+
+    return entry.mtime[0] * 10**9 + entry.mtime[1] >= index_mtime_ns
+
+class TeaCacheTree(object):
+    """
+    A node of the TREE index extension: the tree object last written for
+    a directory, and how many index entries it covers. An entry_count of
+    -1 means the directory changed since, and its tree must be rebuilt.
+    """
+
+    def __init__(self, entry_count=-1, sha=None):
+        self.entry_count = entry_count
+        self.sha = sha
+        # Subdirectories, by name
+        self.subtrees = dict()
 
 class TeaIndex(object):
     version = None
     entries = []
-    # ext = None 
-    # sha = None 
-
-    def __init__(self, version=2, entries=None):
+    # The TREE extension, or None
+    cache_tree = None
+    # The untracked cache (TEAU extension), or None
+    untracked_cache = None
+    # The last fsmonitor token, and the entries that weren't clean then
+    # (TEAF extension)
+    fsmonitor_token = None
+    fsmonitor_dirty = None
+    # The trailing checksum of the index file this was read from, or
+    # None
+    sha = None
+
+    def __init__(self, version=2, entries=None, cache_tree=None, untracked_cache=None,
+                 fsmonitor_token=None, fsmonitor_dirty=None, sha=None):
         if (not entries):
             entries = list()
 
         self.version = version
         self.entries = entries
+        self.cache_tree = cache_tree
+        self.untracked_cache = untracked_cache
+        self.fsmonitor_token = fsmonitor_token
+        self.fsmonitor_dirty = fsmonitor_dirty if fsmonitor_dirty else set()
+        self.sha = sha
 
-def index_read(repo):
-    index_file = repo_file(repo, 'index')
+# Extension header: signature, size of the data that follows
+INDEX_EXTENSION = struct.Struct(">4sL")
 
-    # New repositories have no index!
-    if (not os.path.exists(index_file)):
-        return TeaIndex()
+def cache_tree_parse(raw, idx):
+    """
+    Parse the TREE extension node at raw[idx], and its subtrees. Return
+    the node and the index of the byte following it.
 
-    with open(index_file, 'rb') as f:
-        raw = f.read()
+    A node is: the directory name and a NUL, its entry count and
+    number of subtrees as ASCII ("<count> <subtrees>\n"), the tree SHA
+    when the count isn't -1, then the subtrees themselves.
+    """
 
-    header = raw[:12]
+    name_end = raw.find(b'\x00', idx)
+    name = raw[idx:name_end].decode('utf8')
 
-    signature = header[:4]
-    assert signature == b'DIRC' # DirCache
+    line_end = raw.find(b'\n', name_end)
+    (entry_count, subtree_count) = [ int(x) for x in raw[name_end + 1:line_end].split(b' ') ]
+    idx = line_end + 1
 
-    version = int.from_bytes(header[4:8], 'big')
-    assert version == 2
+    node = TeaCacheTree(entry_count)
 
-    count = int.from_bytes(header[8:12], 'big')
+    if (entry_count >= 0):
+        node.sha = raw[idx:idx + 20].hex()
+        idx += 20
 
-    entries = list()
+    for _ in range(subtree_count):
+        (child_name, child, idx) = cache_tree_parse(raw, idx)
+        node.subtrees[child_name] = child
 
-    content = raw[12:]
-    idx = 0
-    for _ in range(0, count):
-        # Read creation time as unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the 'epoch')
-        ctime_s = int.from_bytes(content[idx : idx+4], 'big')
+    return (name, node, idx)
 
-        # Read creation time as nanoseconds after that timestamps,
-        # for extra precision
-        ctime_ns = int.from_bytes(content[idx+4 : idx+8], 'big')
+def cache_tree_invalidate(cache_tree, path):
+    """
+    Mark every directory above path (a file name relative to the
+    worktree) as changed. Other directories keep their cached tree.
+    """
 
-        # Same for modification time: first seconds from epoch
-        mtime_s = int.from_bytes(content[idx+8 : idx+12], 'big')
+    if (not cache_tree):
+        return
 
-        # Nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12 : idx+16], 'big')
+    node = cache_tree
+    node.entry_count = -1
 
-        # Device ID
-        dev = int.from_bytes(content[idx+16 : idx+20], 'big')
+    for name in path.split('/')[:-1]:
+        node = node.subtrees.get(name)
 
-        # Inode
-        ino = int.from_bytes(content[idx+20 : idx+24], 'big')
+        if (not node):
+            return
 
-        # Ignored
-        unused = int.from_bytes(content[idx+24 : idx+26], 'big')
-        assert unused == 0
+        node.entry_count = -1
 
-        mode = int.from_bytes(content[idx+26 : idx+28], 'big')
-        mode_type = mode >> 12
-        assert mode_type in [0b1000, 0b1010, 0b1110]
-        mode_perms = mode & 0b0000000111111111
 
-        # User ID
-        uid = int.from_bytes(content[idx+28 : idx+32], 'big')
+# Directories modified less than this long before status lists them
+# aren't cached: they could change again without their mtime changing,
+# on filesystems with coarse timestamps.
+UNTRACKED_CACHE_RACY_NS = 10**9
+
+class TeaUntrackedDir(object):
+    """
+    What status found in a directory, for the untracked cache: still
+    valid as long as the directory's mtime and the ignore rules in
+    effect (ignore_sha) don't change.
+    """
+
+    def __init__(self, mtime_ns, ignore_sha, untracked, subdirs):
+        self.mtime_ns = mtime_ns
+        self.ignore_sha = ignore_sha
+        # Untracked, non-ignored names. Directories holding no tracked
+        # file end with "/": whether they hold anything not ignored
+        # is checked on every use.
+        self.untracked = untracked
+        # Subdirectories holding tracked files, that status descends into
+        self.subdirs = subdirs
+
+def untracked_cache_parse(raw, idx, end):
+    """
+    Parse the TEAU extension in raw[idx:end]: a list of directories,
+    each "<path>\0<mtime_ns> <ignore_sha> <untracked> <subdirs>\n",
+    followed by that many NUL-terminated names.
+
+    This is tea's own extension, not git's UNTR: git skips it.
+    """
+
+    ret = dict()
+
+    while (idx < end):
+        path_end = raw.find(b'\x00', idx)
+        path = raw[idx:path_end].decode('utf8')
+
+        line_end = raw.find(b'\n', path_end)
+        (mtime_ns, ignore_sha, untracked_count, subdir_count) = raw[path_end + 1:line_end].split(b' ')
+        idx = line_end + 1
 
-        # Group ID
-        gid = int.from_bytes(content[idx+32 : idx+36], 'big')
+        names = list()
+        for _ in range(int(untracked_count) + int(subdir_count)):
+            name_end = raw.find(b'\x00', idx)
+            names.append(raw[idx:name_end].decode('utf8'))
+            idx = name_end + 1
 
-        # Size
-        fsize = int.from_bytes(content[idx+36 : idx+40], 'big')
+        untracked_count = int(untracked_count)
+        ret[path] = TeaUntrackedDir(int(mtime_ns), ignore_sha.decode('ascii'),
+                                    names[:untracked_count], names[untracked_count:])
+
+    return ret
 
-        # SHA (object ID). We'll store it as a lowercase hex string
-        # for consistency
-        sha = format(int.from_bytes(content[idx+40 : idx+60], 'big'), '040x')
+def untracked_cache_invalidate(untracked_cache, path):
+    """
+    Forget what was found in the directories above path, which is
+    being added to or removed from the index: it changes whether they
+    are tracked, and so what status reports in them.
+    """
+
+    if (not untracked_cache):
+        return
+
+    parent = os.path.dirname(path)
 
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60 : idx+62], 'big')
+    while (True):
+        untracked_cache.pop(parent, None)
+
+        if (not parent):
+            break
+
+        parent = os.path.dirname(parent)
+
+def index_read(repo):
+    index_file = repo_file(repo, 'index')
+
+    # New repositories have no index!
+    if (not os.path.exists(index_file)):
+        return TeaIndex(version=index_version_config(repo))
+
+    # The index is mapped rather than read: entries decode their
+    # fields straight from it, when they need them. The mapping outlives
+    # the file if the index gets replaced.
+    with open(index_file, 'rb') as f:
+        raw = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (signature, version, count) = INDEX_HEADER.unpack_from(raw, 0)
+
+    assert signature == b'DIRC' # DirCache
+    assert version in INDEX_VERSIONS
+
+    entries = list()
+
+    # Version 4 names are relative to the previous one
+    prev_name = b''
+
+    idx = INDEX_HEADER.size
+    for _ in range(0, count):
+        # Only the flags are needed now, for the length of the name.
+        (flags,) = INDEX_FLAGS.unpack_from(raw, idx + INDEX_FLAGS_OFFSET)
 
-        # Parse flags
-        flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
         assert not flag_extended
-        flag_stage =  flags & 0b0011000000000000
 
         # Length of the name. This is stored on 12 bits, some max
         # value is 0xFFF, 4095. Since names can occasionally go
@@ -146,49 +442,76 @@ def index_read(repo):
         # name --- at a small, probably very rare, performance cost
         name_length = flags & 0b0000111111111111
 
-        # We've read 62 bytes so far
-        idx += 62
+        name_start = idx + INDEX_ENTRY.size
+
+        if (version == 4):
+            # Almost all prefix lengths fit on one byte
+            strip = raw[name_start]
+            if (strip & 0x80):
+                (strip, suffix_start) = index_varint_decode(raw, name_start)
+            else:
+                suffix_start = name_start + 1
+
+            suffix_end = raw.find(b'\x00', suffix_start)
+
+            name_bytes = prev_name[:len(prev_name) - strip] + raw[suffix_start:suffix_end]
+            prev_name = name_bytes
+
+            name = name_bytes.decode('utf8')
+            entries.append(TeaIndexEntry(name=name, raw=raw, offset=idx))
+
+            # No padding in version 4: the next entry follows the NUL.
+            idx = suffix_end + 1
+            continue
 
         if  (name_length < 0xFFF):
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx : idx+name_length]
-            idx += name_length + 1
+            assert raw[name_start + name_length] == 0x00
+            name_end = name_start + name_length
         else:
             print(f'Notice: Name is 0x{name_length:x} bytes long.')
-
-            null_idx = content.find(b'\x00', idx+0xFFF)
-            raw_name = content[idx:null_idx]
-            idx = null_idx + 1
+            name_end = raw.find(b'\x00', name_start + 0xFFF)
 
         # Just parse the name as utf-8
-        name = raw_name.decode('utf8')
+        name = raw[name_start:name_end].decode('utf8')
+
+        # And we add this entry to our list
+        entries.append(TeaIndexEntry(name=name, raw=raw, offset=idx))
 
         # Data is padded on multiples of eight bytes for pointer
         # alignment, so we skip as many bytes as we need for the next
         # read to start at the right position
-
-        idx = 8 * ceil(idx / 8)
-
-        # And we add this entry to our list
-        entries.append(
-            TeaIndexEntry(
-                ctime=(ctime_s, ctime_ns),
-                mtime=(mtime_s, mtime_ns),
-                dev=dev,
-                ino=ino,
-                mode_type=mode_type,
-                mode_perms=mode_perms,
-                uid=uid,
-                gid=gid,
-                fsize=fsize,
-                sha=sha,
-                flag_assume_valid=flag_assume_valid,
-                flag_stage=flag_stage,
-                name=name
-            )
-        )
-
-    return TeaIndex(version=version, entries=entries)
+        idx += index_entry_size(name_end - name_start)
+
+    # Extensions follow the entries, up to the final checksum. We only
+    # understand TREE, TEAU and TEAF; the others are optional, and get
+    # dropped.
+    cache_tree = None
+    untracked_cache = None
+    fsmonitor_token = None
+    fsmonitor_dirty = None
+
+    while (idx + INDEX_EXTENSION.size <= len(raw) - 20):
+        (signature, size) = INDEX_EXTENSION.unpack_from(raw, idx)
+        idx += INDEX_EXTENSION.size
+
+        if (signature == b'TREE'):
+            (_, cache_tree, _) = cache_tree_parse(raw, idx)
+        elif (signature == b'TEAU'):
+            untracked_cache = untracked_cache_parse(raw, idx, idx + size)
+        elif (signature == b'TEAF'):
+            # The fsmonitor token, then the dirty entries' names, all
+            # NUL-separated
+            (fsmonitor_token, *fsmonitor_dirty) = raw[idx:idx + size].decode('utf8').split('\x00')
+            fsmonitor_dirty = set(fsmonitor_dirty)
+        elif (not b'A' <= signature[0:1] <= b'Z'):
+            raise Exception(f"Unsupported required index extension {signature}")
+
+        idx += size
+
+    return TeaIndex(version=version, entries=entries, cache_tree=cache_tree,
+                    untracked_cache=untracked_cache,
+                    fsmonitor_token=fsmonitor_token, fsmonitor_dirty=fsmonitor_dirty,
+                    sha=raw[-20:])
 
 def teaignore_parse_single(raw):
     raw = raw.strip()
@@ -212,6 +535,53 @@ def teaignore_parse(lines):
 
     return ret
 
+class TeaIgnoreRuleset(object):
+    """
+    The rules of one ignore file, compiled into a single regex.
+
+    Like with fnmatch, "*" also matches "/". The last rule matching a
+    path decides, so the alternatives are listed last rule first: the
+    one that matches first is the one that decides, and the capture
+    group it sits in says which it was.
+    """
+
+    def __init__(self, rules, sha=None):
+        self.rules = rules
+        # The SHA of the file the rules come from
+        self.sha = sha
+
+        rules = list(reversed(rules))
+        self.values = [ value for (_, value) in rules ]
+
+        if (rules):
+            # fnmatch.translate may use groups of its own, named ones
+            # in Python 3.10: the rules' groups are named, so that they
+            # can't be confused with them.
+            self.regex = re.compile("|".join(f"(?P<r{i}>{fnmatch.translate(pattern)})" for (i, (pattern, _)) in enumerate(rules)))
+        else:
+            self.regex = None
+
+    def match(self, path):
+        """
+        True if path is ignored, False if a negated rule keeps it, None
+        if no rule applies.
+        """
+
+        if (not self.regex):
+            return None
+
+        m = self.regex.match(path)
+
+        if (not m):
+            return None
+
+        # "r<i>": the last group to close is the rule's own, around
+        # any group inside it
+        return self.values[int(m.lastgroup[1:])]
+
+# Compiled .teaignore files, by blob SHA
+teaignore_rulesets = dict()
+
 class TeaIgnore(object):
     absolute = None
     scoped = None
@@ -219,15 +589,47 @@ class TeaIgnore(object):
     def __init__(self, absolute, scoped):
         self.absolute = absolute
         self.scoped = scoped
+        # For each directory, the scoped rulesets that apply in it,
+        # nearest first
+        self.chains = dict()
+        # For each directory, a SHA of all the rules that apply in it
+        self.shas = dict()
+
+    def chain(self, dir_name):
+        chain = self.chains.get(dir_name)
+
+        if (chain is None):
+            chain = self.chain(os.path.dirname(dir_name)) if dir_name else ()
+
+            if (dir_name in self.scoped):
+                chain = (self.scoped[dir_name],) + chain
+
+            self.chains[dir_name] = chain
 
-def teaignore_read(repo):
+        return chain
+
+    def sha(self, dir_name):
+        """
+        Identify the rules in effect in dir_name: if this SHA doesn't
+        change, neither does what is ignored there.
+        """
+
+        sha = self.shas.get(dir_name)
+
+        if (sha is None):
+            rulesets = self.chain(dir_name) + tuple(self.absolute)
+            sha = hashlib.sha1(" ".join(r.sha for r in rulesets).encode("ascii")).hexdigest()
+            self.shas[dir_name] = sha
+
+        return sha
+
+def teaignore_read(repo, index=None):
     ret = TeaIgnore(absolute = list(), scoped=dict())
 
     # Read local configuration in .tea/info/exclude
     repo_file = os.path.join(repo.teadir, 'info/exclude')
     if (os.path.exists(repo_file)):
-        with open(repo_file, 'r') as f:
-            ret.absolute.append(teaignore_parse(f.readlines()))
+        ret.absolute.append(teaignore_read_file(repo_file))
 
     # Global config
     if ("XDG_CONFIG_HOME" in os.environ):
@@ -238,50 +640,48 @@ def teaignore_read(repo):
     global_file = os.path.join(config_home, "git/ignore")
 
     if (os.path.exists(global_file)):
-        with open(global_file, 'r') as f:
-            ret.absolute.append(teaignore_parse(f.readlines()))
+        ret.absolute.append(teaignore_read_file(global_file))
 
-    # .teaignore files in the index
-    index = index_read(repo)
+    # .teaignore files in the index. Callers that already hold the
+    # index pass it along.
+    if (not index):
+        index = index_read(repo)
 
     for entry in index.entries:
-        print(entry.name)
         if (entry.name == '.teaignore' or entry.name.endswith('/.teaignore')):
             dir_name = os.path.dirname(entry.name)
-            contents = object_read(repo, entry.sha)
-            lines = contents.blobdata.decode('utf8').splitlines()
-            ret.scoped[dir_name] = teaignore_parse(lines)
 
-    return ret
+            # The same blob is only read and compiled once
+            ruleset = teaignore_rulesets.get(entry.sha)
 
-def check_ignore_single(rules, path):
-    result = None
+            if (not ruleset):
+                contents = object_read(repo, entry.sha)
+                lines = contents.blobdata.decode('utf8').splitlines()
+                ruleset = TeaIgnoreRuleset(teaignore_parse(lines), entry.sha)
+                teaignore_rulesets[entry.sha] = ruleset
 
-    for (pattern, value) in rules:
-        if (fnmatch(path, pattern)):
-            result = value
+            ret.scoped[dir_name] = ruleset
 
-    return result
+    return ret
 
-def check_ignore_scoped(rules, path):
-    parent = os.path.dirname(path)
+def teaignore_read_file(path):
+    with open(path, 'rb') as f:
+        raw = f.read()
 
-    while (True):
-        if (parent in rules):
-            result = check_ignore_single(rules[parent], path)
-            if (result != None):
-                return result
-        if (parent == ""):
-            break
-        parent = os.path.dirname(parent)
+    lines = raw.decode('utf8').splitlines()
+    return TeaIgnoreRuleset(teaignore_parse(lines), hashlib.sha1(raw).hexdigest())
+
+def check_ignore_scoped(rules, path):
+    for ruleset in rules.chain(os.path.dirname(path)):
+        result = ruleset.match(path)
+        if (result != None):
+            return result
 
     return None
 
 def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
-
     for ruleset in rules:
-        result = check_ignore_single(ruleset, path)
+        result = ruleset.match(path)
 
         if (result != None):
             return result
@@ -292,126 +692,348 @@ def check_ignore(rules, path):
     if (os.path.isabs(path)):
         raise Exception("This function requires path to be relative to the repository's root")
 
-    result = check_ignore_scoped(rules.scoped, path)
+    result = check_ignore_scoped(rules, path)
     if (result != None):
         return result
 
     return check_ignore_absolute(rules.absolute, path)
 
-def tree_to_dict(repo, ref, prefix=''):
-    ret = dict()
-    tree_sha = object_find(repo, ref, fmt=b'tree')
-    tree = object_read(repo, tree_sha)
-
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
-
-        # We read the object to extract its type (this is uselessly
-        # expensive: we could just open it as a file and read the
-        # first few bytes)
-        is_subtree = leaf.mode.startswith(b'04')
-
-        # Depending on the type, we either store the path (if it's a
-        # blob, so a regular file), or recursive (if it's another tree,
-        # so a subdir)
-        if (is_subtree):
-            ret.update(tree_to_dict(repo, leaf.sha, full_path))
-        else:
-            ret[full_path] = leaf.sha
+def cmd_status_head_index(repo, index):
+    try:
+        head = object_find(repo, 'HEAD', fmt=b'tree')
+    except TypeError:
+        # No commit yet: everything in the index is added
+        head = None
 
-    return ret
+    for (label, name) in status_diff_tree_index(repo, head, index.cache_tree, index.entries, 0, ""):
+        print(" ", label, name)
 
-def cmd_status_head_index(repo, index):
-    # print("Changes to be committed:")
-
-    # head = tree_to_dict(repo, 'HEAD')
-    # for entry in index.entries:
-    #     if (entry.name in head):
-    #         if (head[entry.name] != entry.sha):
-    #             print("  modified:", entry.name)
-    #         del head[entry.name]
-    #     else:
-    #         print("  added:   ", entry.name)
-
-    # # Keys still in HEAD are files that we haven't met in the index,
-    # # and are thus have been deleted
-    # for entry in head.keys():
-    #     print("  deleted: ", entry)
+def status_diff_tree_index(repo, tree_sha, node, entries, i, prefix):
+    """
+    Compare tree tree_sha (None being the empty tree) with the index
+    entries under prefix ("" or a directory name ending with "/"),
+    which start at entries[i]. node is the cache tree node of that
+    directory, or None. Yield a (label, path) pair per difference, in
+    path order, and return the position of the first entry past prefix.
 
-    try:
-        head = tree_to_dict(repo, 'HEAD')
-        for entry in index.entries:
-            if (entry.name in head):
-                if (head[entry.name] != entry.sha):
-                    print("  modified:", entry.name)
-                del head[entry.name]
-            else:
-                print("  added:   ", entry.name)
-
-        # Keys still in HEAD are files that we haven't met in the index,
-        # and are thus have been deleted
-        for entry in head.keys():
-            print("  deleted: ", entry)
-    except TypeError as _:
-        # git status when no files, do the same thing as ls-files
-        for entry in index.entries:
-            print("  added:   ", entry.name)
-
-def cmd_status_index_worktree(repo, index):
-    print("Changes not staged for commit:")
+    Directories whose cached tree is the tree's own subtree are skipped
+    as a whole, without reading either side.
+    """
 
-    ignore = teaignore_read(repo)
+    if (node and node.entry_count >= 0 and node.sha == tree_sha):
+        return i + node.entry_count
 
-    teadir_prefix = repo.teadir + os.path.sep
+    leaves = object_read(repo, tree_sha).items if tree_sha else []
+    j = 0
 
-    all_files = list()
+    while (True):
+        entry = entries[i] if i < len(entries) and entries[i].name.startswith(prefix) else None
+        leaf = leaves[j] if j < len(leaves) else None
+
+        if (entry is None and leaf is None):
+            return i
+
+        # Both sides are sorted by name, with "/" after directory names
+        if (entry is not None):
+            rest = entry.name[len(prefix):]
+            slash = rest.find("/")
+            entry_key = rest if slash < 0 else rest[:slash + 1]
+
+        if (leaf is not None):
+            is_subtree = leaf.mode.startswith((b'04', b' 4'))
+            leaf_key = leaf.path + "/" if is_subtree else leaf.path
+
+        if (entry is None or (leaf is not None and leaf_key < entry_key)):
+            # Only in the tree
+            if (is_subtree):
+                for (_, path, _, _) in tree_diff(repo, leaf.sha, None, True, prefix + leaf.path):
+                    yield ("deleted: ", path)
+            else:
+                yield ("deleted: ", prefix + leaf.path)
+            j += 1
+        elif (leaf is None or entry_key < leaf_key):
+            # Only in the index, with whatever is under it
+            if (slash < 0):
+                yield ("added:   ", entry.name)
+                i += 1
+            else:
+                while (i < len(entries) and entries[i].name.startswith(prefix + entry_key)):
+                    yield ("added:   ", entries[i].name)
+                    i += 1
+        elif (slash < 0):
+            if (entry.sha != leaf.sha):
+                yield ("modified:", entry.name)
+            i += 1
+            j += 1
+        else:
+            child = node.subtrees.get(entry_key[:-1]) if node else None
+            i = yield from status_diff_tree_index(repo, leaf.sha, child, entries, i, prefix + entry_key)
+            j += 1
+
+def cmd_status_index_worktree(repo, index, jobs=None):
+    """
+    Print changes between the index and the worktree. Return whether
+    the index was refreshed: entries whose files hadn't changed, but
+    their stat data had, the untracked cache, or the fsmonitor token.
+    The caller should write the index back, so that the next status
+    doesn't redo that work.
+
+    With core.fsmonitor and a running daemon, only the entries it
+    reports as changed since the last status, and those that weren't
+    clean then, are looked at.
+    """
 
-    # We begin by walking the filesystem
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if (root == repo.teadir or root.startswith(teadir_prefix)):
-            continue
+    print("Changes not staged for commit:")
+
+    ignore = teaignore_read(repo, index)
+
+    # None means everything has to be looked at
+    monitored = None
+    fsmonitor_token = None
 
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+    if (repo.conf.getboolean("core", "fsmonitor", fallback=False)):
+        (fsmonitor_token, monitored) = fsmonitor_query(repo, index.fsmonitor_token)
 
     # We now traverse the index and compare real files with the cached
-    # versions.
+    # versions. Comparing stat data settles most entries; the others
+    # ("suspicious") are hashed afterwards, in parallel.
+    index_file = repo_file(repo, "index")
+    index_mtime_ns = os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else None
+    filemode = repo.conf.getboolean("core", "filemode", fallback=False)
+
+    changes = dict()
+    suspicious = list()
+
+    for (i, entry) in enumerate(index.entries):
+        if (monitored is not None
+            and entry.name not in index.fsmonitor_dirty
+            and not monitored.path_changed(entry.name)):
+            continue
 
-    for entry in index.entries:
         full_path = os.path.join(repo.worktree, entry.name)
 
-        # That file *name* is in the index
-        if (not os.path.exists(full_path)):
-            print("  deleted: ", entry.name)
-        else:
+        try:
             stat = os.stat(full_path)
+        except FileNotFoundError:
+            # That file *name* is in the index, but not on disk
+            changes[entry.name] = "deleted: "
+            continue
+
+        if (index_entry_stat_changed(entry, stat, filemode)):
+            # A different size means different contents, unless the
+            # entry was smudged (see index_smudge_racy)
+            if (entry.fsize != stat.st_size & 0xFFFFFFFF and entry.fsize != 0):
+                changes[entry.name] = "modified:"
+            else:
+                suspicious.append((i, full_path, stat))
+        elif (index_entry_racy(entry, index_mtime_ns)):
+            suspicious.append((i, full_path, stat))
 
-            # Compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
+    # Hashing reads whole files, and releases the GIL while doing so.
+    # @FIXME This *will* crash on symlinks to dir
+    with ThreadPoolExecutor(max_workers=repo_jobs(repo, "status", jobs)) as pool:
+        hashed = pool.map(lambda s: status_hash_one(s[1]), suspicious)
 
-            if ((stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns)):
-                # If different, deep compare
-                # @FIXME This *will* crash on symlinks to dir
-                with open(full_path, 'rb') as fd:
-                    new_sha = hash_object(fd, b'blob', None)
+        refreshed = False
 
-                    # If the hashes are the same, the files are actually the same
-                    same = entry.sha == new_sha
+        for ((i, full_path, stat), new_sha) in zip(suspicious, hashed):
+            entry = index.entries[i]
 
-                    if (not same):
-                        print("  modified:", entry.name)
+            if (new_sha is None):
+                changes[entry.name] = "deleted: "
+            elif (new_sha != entry.sha):
+                changes[entry.name] = "modified:"
 
-        if (entry.name in all_files):
-            all_files.remove(entry.name)
+                # Racy entries can have stat data that matches the
+                # changed file: once the index is written back, later
+                # than the file, it would be trusted.
+                entry.fsize = 0
+            else:
+                # If the hashes are the same, the files are actually
+                # the same: only the stat data needs updating.
+                index.entries[i] = index_entry_from_stat(stat, entry.sha, entry.name)
+                refreshed = True
+
+    for entry in index.entries:
+        if (entry.name in changes):
+            print(" ", changes[entry.name], entry.name)
 
     print()
     print("Untracked files:")
 
-    for f in all_files:
-        # @TODO If a full directory is untracked, we should
-        # display its name without its content
-        if (not check_ignore(ignore, f)):
-            print(" ", f)
+    (untracked, cache_changed) = status_untracked(repo, index, ignore, monitored)
+
+    for f in untracked:
+        print(" ", f)
+
+    # Whatever isn't clean now must be looked at again next time, even
+    # if the daemon doesn't report it.
+    fsmonitor_changed = (fsmonitor_token != index.fsmonitor_token
+                         or (fsmonitor_token and set(changes) != index.fsmonitor_dirty))
+    index.fsmonitor_token = fsmonitor_token
+    index.fsmonitor_dirty = set(changes) if fsmonitor_token else set()
+
+    return refreshed or cache_changed or fsmonitor_changed
+
+def status_untracked(repo, index, ignore, monitored=None):
+    """
+    The untracked, non-ignored paths of the worktree, sorted, and
+    whether the untracked cache of index was updated (in which case the
+    index is worth writing back).
+
+    Ignored directories and .tea are never entered. A directory holding
+    no tracked file is reported once, as "dir/", as long as something
+    in it isn't ignored.
+
+    With core.untrackedCache, what is found in each directory is kept
+    in the index. Directories whose mtime and ignore rules haven't
+    changed since aren't listed again. Directories in which monitored,
+    the fsmonitor daemon's report, saw no change aren't even stat'ed.
+    """
+
+    # The tracked names are only needed to list directories, which the
+    # untracked cache may spare us entirely.
+    tracked = None
+    tracked_dirs = None
+
+    def list_dir(abs_dir, rel_dir):
+        nonlocal tracked, tracked_dirs
+
+        if (tracked is None):
+            tracked = set(e.name for e in index.entries)
+
+            # Every directory holding a tracked file, at any depth
+            tracked_dirs = set()
+            for name in tracked:
+                parent = os.path.dirname(name)
+
+                while (parent and parent not in tracked_dirs):
+                    tracked_dirs.add(parent)
+                    parent = os.path.dirname(parent)
+
+        return status_list_dir(repo, abs_dir, rel_dir, ignore, tracked, tracked_dirs)
+
+    changed = False
+
+    if (repo.conf.getboolean("core", "untrackedCache", fallback=False)):
+        if (index.untracked_cache is None):
+            index.untracked_cache = dict()
+            changed = True
+    elif (index.untracked_cache is not None):
+        index.untracked_cache = None
+        changed = True
+
+    cache = index.untracked_cache
+    visited = set()
+    start_ns = time.time_ns()
+
+    ret = list()
+    pending = [ "" ]
+
+    while (pending):
+        rel_dir = pending.pop()
+        abs_dir = os.path.join(repo.worktree, rel_dir)
+        visited.add(rel_dir)
+
+        if (cache is not None):
+            ignore_sha = ignore.sha(rel_dir)
+            cached = cache.get(rel_dir)
+
+            if (monitored is not None and cached and cached.ignore_sha == ignore_sha
+                and not monitored.dir_changed(rel_dir)):
+                mtime_ns = cached.mtime_ns
+            else:
+                mtime_ns = os.stat(abs_dir).st_mtime_ns
+
+            if (cached and cached.mtime_ns == mtime_ns and cached.ignore_sha == ignore_sha):
+                (untracked, subdirs) = (cached.untracked, cached.subdirs)
+            else:
+                (untracked, subdirs) = list_dir(abs_dir, rel_dir)
+
+                # A directory modified too recently may change again
+                # within the same mtime: it is listed again next time.
+                if (mtime_ns < start_ns - UNTRACKED_CACHE_RACY_NS):
+                    cache[rel_dir] = TeaUntrackedDir(mtime_ns, ignore_sha, untracked, subdirs)
+                    changed = True
+                elif (cache.pop(rel_dir, None)):
+                    changed = True
+        else:
+            (untracked, subdirs) = list_dir(abs_dir, rel_dir)
+
+        for name in untracked:
+            path = f"{rel_dir}/{name}" if rel_dir else name
+
+            # The contents of untracked directories may have changed
+            # without their parent's mtime changing.
+            if (not name.endswith("/") or status_dir_has_files(os.path.join(repo.worktree, path), path[:-1], ignore)):
+                ret.append(path)
+
+        pending += [ f"{rel_dir}/{name}" if rel_dir else name for name in subdirs ]
+
+    # Directories that are gone, or no longer hold tracked files
+    if (cache is not None):
+        for rel_dir in set(cache).difference(visited):
+            del cache[rel_dir]
+            changed = True
+
+    return (sorted(ret), changed)
+
+def status_list_dir(repo, abs_dir, rel_dir, ignore, tracked, tracked_dirs):
+    """
+    List directory rel_dir for status_untracked: return its untracked,
+    non-ignored names (directories holding no tracked file with a
+    trailing "/"), and its subdirectories holding tracked files.
+    """
+
+    untracked = list()
+    subdirs = list()
+
+    with os.scandir(abs_dir) as it:
+        for dirent in it:
+            path = f"{rel_dir}/{dirent.name}" if rel_dir else dirent.name
+
+            # Symlinks to directories are files, for us as for git
+            if (dirent.is_dir(follow_symlinks=False)):
+                if (dirent.path == repo.teadir or check_ignore(ignore, path)):
+                    continue
+
+                if (path in tracked_dirs):
+                    subdirs.append(dirent.name)
+                else:
+                    untracked.append(dirent.name + "/")
+            elif (path not in tracked and not check_ignore(ignore, path)):
+                untracked.append(dirent.name)
+
+    return (untracked, subdirs)
+
+def status_dir_has_files(abspath, path, ignore):
+    """
+    Whether directory abspath (path, relative to the worktree) holds
+    at least one file that isn't ignored. Stops at the first one.
+    """
+
+    with os.scandir(abspath) as it:
+        for dirent in it:
+            child = f"{path}/{dirent.name}"
+
+            if (check_ignore(ignore, child)):
+                continue
+
+            if (not dirent.is_dir(follow_symlinks=False)):
+                return True
+
+            if (status_dir_has_files(dirent.path, child, ignore)):
+                return True
+
+    return False
+
+def status_hash_one(path):
+    """
+    The blob SHA of the file at path, or None if it has disappeared.
+    """
+
+    try:
+        with open(path, 'rb') as fd:
+            return hash_object(fd, b'blob', None)
+    except FileNotFoundError:
+        return None
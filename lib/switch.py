@@ -0,0 +1,192 @@
+import os
+import bisect
+
+from lib.commit import index_write
+from lib.repo_functions import repo_file, repo_path
+from lib.staging import cache_tree_invalidate, index_entry_from_stat, index_entry_racy, index_entry_stat_changed, index_read, status_hash_one, untracked_cache_invalidate
+from lib.tea_object_function import object_find
+from lib.wrapper import tree_checkout_write, tree_diff
+
+def switch(repo, ref, jobs=None):
+    """
+    Move HEAD, the index and the worktree to commit ref. Only the paths
+    that differ between the two commits' trees are touched, in the
+    worktree as in the index.
+
+    Nothing is done if that would lose a change: a staged change, a
+    modified file, or an untracked file in the way.
+    """
+
+    commit = object_find(repo, ref, fmt=b'commit')
+    if (not commit):
+        raise Exception(f"Not a commit: {ref}")
+
+    try:
+        head = object_find(repo, 'HEAD', fmt=b'tree')
+    except TypeError:
+        # No commit yet
+        head = None
+
+    target = object_find(repo, commit, fmt=b'tree')
+
+    index = index_read(repo)
+    index_file = repo_file(repo, "index")
+    index_mtime_ns = os.stat(index_file).st_mtime_ns if os.path.exists(index_file) else None
+    filemode = repo.conf.getboolean("core", "filemode", fallback=False)
+
+    changes = list(tree_diff(repo, head, target, recursive=True))
+
+    conflicts = list()
+
+    for (_, path, old_leaf, new_leaf) in changes:
+        if (switch_path_conflicts(repo, index, path, old_leaf, new_leaf, index_mtime_ns, filemode)):
+            conflicts.append(path)
+
+    if (conflicts):
+        raise Exception("Your local changes to the following files would be overwritten by switch:\n"
+                        + "".join(f"\t{path}\n" for path in conflicts)
+                        + "Commit them, or remove them, before you switch.")
+
+    # Removals first: a file may be replaced by a directory of the same
+    # name, or the reverse.
+    files = list()
+
+    for (_, path, old_leaf, new_leaf) in changes:
+        full_path = os.path.join(repo.worktree, path)
+
+        if (new_leaf):
+            files.append((new_leaf.sha, full_path))
+            continue
+
+        try:
+            os.unlink(full_path)
+        except FileNotFoundError:
+            pass
+
+        switch_prune_dirs(repo, os.path.dirname(path))
+
+    for (_, full_path) in files:
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+    stats = iter(tree_checkout_write(repo, files, jobs))
+    mtime_ns = 0
+
+    # The index gets the new files' stat data: the next status won't
+    # need to read them. Entries are updated in place, in sorted order.
+    for (_, path, _, new_leaf) in changes:
+        i = bisect.bisect_left(index.entries, path, key=lambda e: e.name)
+        found = i < len(index.entries) and index.entries[i].name == path
+
+        if (new_leaf):
+            # Written in the same order as changes lists them
+            stat = next(stats)
+            mtime_ns = max(mtime_ns, stat.st_mtime_ns)
+            entry = index_entry_from_stat(stat, new_leaf.sha, path)
+
+            if (found):
+                index.entries[i] = entry
+            else:
+                index.entries.insert(i, entry)
+        elif (found):
+            del index.entries[i]
+
+        cache_tree_invalidate(index.cache_tree, path)
+        untracked_cache_invalidate(index.untracked_cache, path)
+
+    index_write(repo, index, newest_mtime_ns=mtime_ns)
+
+    # HEAD follows the branch if ref is one, and holds the commit
+    # itself otherwise.
+    if (os.path.isfile(repo_path(repo, "refs", "heads", ref))):
+        head_data = f"ref: refs/heads/{ref}\n"
+        print(f"Switched to branch '{ref}'")
+    else:
+        head_data = commit + "\n"
+        print(f"HEAD is now at {commit[:7]}")
+
+    with open(repo_file(repo, "HEAD"), "w") as f:
+        f.write(head_data)
+
+    print(f"Updated {len(changes)} paths")
+
+def switch_path_conflicts(repo, index, path, old_leaf, new_leaf, index_mtime_ns, filemode):
+    """
+    Whether switching path from old_leaf to new_leaf (either may be
+    None) would lose something: the index must match HEAD, and the file
+    must match the index, or be what the switch would write anyway.
+    """
+
+    entry = switch_index_find(index, path)
+    new_sha = new_leaf.sha if new_leaf else None
+
+    # Staged changes. An entry already matching the target is fine.
+    if (entry is None):
+        if (old_leaf):
+            return True
+    elif (not old_leaf or entry.sha != old_leaf.sha):
+        if (entry.sha != new_sha):
+            return True
+
+    full_path = os.path.join(repo.worktree, path)
+
+    try:
+        stat = os.lstat(full_path)
+    except FileNotFoundError:
+        # Nothing to lose
+        return False
+    except NotADirectoryError:
+        # A file where a directory should be: only an untracked one is
+        # in the way, the others are replaced too.
+        parent = os.path.dirname(path)
+        while (not os.path.isfile(os.path.join(repo.worktree, parent))):
+            parent = os.path.dirname(parent)
+
+        return switch_index_find(index, parent) is None
+
+    # A directory where a file should be: whatever is tracked in it is
+    # removed by the switch, but untracked files would be in the way.
+    if (os.path.isdir(full_path)):
+        if (not new_leaf):
+            return False
+
+        for (root, _, names) in os.walk(full_path):
+            for name in names:
+                if (switch_index_find(index, os.path.relpath(os.path.join(root, name), repo.worktree)) is None):
+                    return True
+
+        return False
+
+    if (entry is not None
+        and not index_entry_stat_changed(entry, stat, filemode)
+        and not index_entry_racy(entry, index_mtime_ns)):
+        return False
+
+    sha = status_hash_one(full_path)
+
+    return sha != (entry.sha if entry else None) and sha != new_sha
+
+def switch_index_find(index, name):
+    """
+    The entry of index for name, or None. Entries are sorted by name.
+    """
+
+    i = bisect.bisect_left(index.entries, name, key=lambda e: e.name)
+
+    if (i < len(index.entries) and index.entries[i].name == name):
+        return index.entries[i]
+
+    return None
+
+def switch_prune_dirs(repo, rel_dir):
+    """
+    Remove rel_dir, and its parents, as long as they're empty.
+    """
+
+    while (rel_dir):
+        try:
+            os.rmdir(os.path.join(repo.worktree, rel_dir))
+        except OSError:
+            # Not empty, or already gone
+            return
+
+        rel_dir = os.path.dirname(rel_dir)
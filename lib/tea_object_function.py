@@ -1,48 +1,288 @@
 import os
 import re
 import zlib
+import bisect
 import hashlib
-
-from lib.repo_functions import repo_dir, repo_file
+import tempfile
+import threading
+
+from lib.compression import compression_level, compression_level_config, inflate_chunks
+from lib.fsync import FSYNC_ALWAYS, FSYNC_BATCH, fs_sync, fsync_dir, fsync_file, fsync_mode
+from lib.object_cache import object_cache_get
+from lib.pack import pack_contains, pack_list, pack_object_info, pack_object_read, pack_object_read_into
+from lib.repo_functions import repo_dir, repo_file, repo_path
 from lib.tea_object import TeaCommit, TeaTree, TeaTag, TeaBlob
 
+# Full or abbreviated (at least 4 digits) object names
+HASH_RE = re.compile(r'^[0-9A-Fa-f]{4,40}$')
+
+# Objects bigger than this are never held in memory at once by
+# object_write_stream
+OBJECT_CHUNK_SIZE = 1 << 20
+
+# Objects written in core.fsync=batch mode and not flushed yet, per
+# repository (keyed by its .tea directory): sha -> temporary path
+pending_objects = dict()
+pending_lock = threading.Lock()
+
+def object_read_raw(repo, sha):
+    """
+    Find object sha, first in the packs then as a loose object. Return a
+    (fmt, data) pair, or None if the object doesn't exist.
+    """
+
+    packed = pack_object_read(repo, sha)
+    if (packed):
+        return packed
+
+    path = object_path(repo, sha)
+
+    if (not os.path.isfile(path)):
+        return None
+
+    with open(path, "rb") as f:
+        raw = zlib.decompress(f.read())
+
+    # Read object type
+    x = raw.find(b' ')
+    fmt = raw[0:x]
+
+    # Read and validate object size
+    y = raw.find(b'\x00', x)
+    size = int(raw[x:y].decode("ascii"))
+
+    LENGTH_NOT_MATCH = size != len(raw)-y-1
+    if (LENGTH_NOT_MATCH):
+        raise Exception(f"Malformed object {sha}: bad length")
+
+    return (fmt, raw[y+1:])
+
 def object_read(repo, sha):
     """
     Read object object_id from Tea repository repo. Return a TeaObject whose exact
     type depends on the object.
+
+    Decoded objects are kept in the repository's object cache, so the
+    returned object may be shared with other callers: don't modify it.
     """
 
-    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    cache = object_cache_get(repo)
+
+    obj = cache.get(sha)
+    if (obj):
+        return obj
+
+    raw = object_read_raw(repo, sha)
+
+    if (not raw):
+        return None
+
+    (fmt, data) = raw
+
+    # Pick constructor
+    match fmt:
+        case b'commit' : c = TeaCommit
+        case b'tree'   : c = TeaTree
+        case b'tag'    : c = TeaTag
+        case b'blob'   : c = TeaBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+    # Call constructor, cache and return object
+    obj = c(data)
+    cache.put(sha, obj, len(data))
+
+    return obj
+
+def object_read_into(repo, sha, out):
+    """
+    Write the data of object sha to out, a binary file, inflating it
+    chunk by chunk. Return its (fmt, size) pair, or None if it doesn't
+    exist. The object isn't cached: this is meant for blobs, read once.
+    """
+
+    cached = object_cache_get(repo).peek(sha)
+    if (cached):
+        out.write(cached[0].serialize())
+        return (cached[0].fmt, cached[1])
+
+    packed = pack_object_read_into(repo, sha, out)
+    if (packed):
+        return packed
+
+    path = object_path(repo, sha)
 
     if (not os.path.isfile(path)):
         return None
 
     with open(path, "rb") as f:
-        raw = zlib.decompress(f.read())
+        chunks = inflate_chunks(iter(lambda: f.read(65536), b''))
+
+        # The header is "<fmt> <size>\x00", then the data
+        header = b''
+        for data in chunks:
+            header += data
+            if (b'\x00' in header):
+                break
+
+        x = header.find(b' ')
+        y = header.find(b'\x00', x)
+
+        if (y < 0):
+            raise Exception(f"Malformed object {sha}: truncated header")
+
+        fmt = header[0:x]
+        size = int(header[x+1:y].decode("ascii"))
+
+        out.write(header[y+1:])
+        written = len(header) - y - 1
+
+        for data in chunks:
+            out.write(data)
+            written += len(data)
+
+    if (written != size):
+        raise Exception(f"Malformed object {sha}: bad length")
+
+    return (fmt, size)
+
+def object_info(repo, sha):
+    """
+    Return the (fmt, size) pair of object sha, or None if it doesn't
+    exist. Only the header of the object is inflated, so this is cheap
+    even for huge blobs.
+    """
+
+    cached = object_cache_get(repo).peek(sha)
+    if (cached):
+        return (cached[0].fmt, cached[1])
+
+    packed = pack_object_info(repo, sha)
+    if (packed):
+        return packed
+
+    path = object_path(repo, sha)
+
+    if (not os.path.isfile(path)):
+        return None
+
+    d = zlib.decompressobj()
+    header = b''
+
+    with open(path, "rb") as f:
+        # The header is "<fmt> <size>\x00": a few dozen bytes at most
+        while (not b'\x00' in header):
+            chunk = d.unconsumed_tail or f.read(256)
+
+            if (not chunk):
+                raise Exception(f"Malformed object {sha}: truncated header")
+
+            header += d.decompress(chunk, 64)
+
+    x = header.find(b' ')
+    y = header.find(b'\x00', x)
+
+    return (header[0:x], int(header[x+1:y].decode("ascii")))
+
+def object_loose_list(repo):
+    """
+    List the SHA of every loose object of the repository.
+    """
+
+    ret = list()
+    path = repo_dir(repo, "objects")
+
+    for prefix in sorted(os.listdir(path)):
+        IS_OBJECT_DIR = len(prefix) == 2 and os.path.isdir(os.path.join(path, prefix))
+        if (not IS_OBJECT_DIR):
+            continue
+
+        for f in sorted(os.listdir(os.path.join(path, prefix))):
+            if (len(f) == 38):
+                ret.append(prefix + f)
+
+    return ret
+
+def object_path(repo, sha):
+    """
+    Path of loose object sha. Objects written in batch mode that haven't
+    been flushed yet are read from their temporary file.
+    """
+
+    pending = pending_objects.get(repo.teadir)
+
+    if (pending and sha in pending):
+        return pending[sha]
+
+    return repo_path(repo, "objects", sha[0:2], sha[2:])
+
+def object_tmp_open(repo):
+    """
+    Objects are always written to a temporary file first, and renamed
+    into place once complete: a crash never leaves a truncated object
+    under its final name.
+    """
+
+    (tmp_fd, tmp_path) = tempfile.mkstemp(prefix="tmp_obj_", dir=repo_dir(repo, "objects"))
+    return (os.fdopen(tmp_fd, 'wb'), tmp_path)
+
+def object_tmp_close(repo, f):
+    if (fsync_mode(repo) == FSYNC_ALWAYS):
+        fsync_file(f)
+
+    f.close()
+
+def object_tmp_commit(repo, tmp_path, sha):
+    """
+    Move a complete temporary object to its final path, unless we already
+    have it. In batch mode, it stays where it is until object_flush.
+    """
+
+    with pending_lock:
+        pending = pending_objects.setdefault(repo.teadir, dict())
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+
+        ALREADY_STORED = sha in pending or os.path.exists(path) or pack_contains(repo, sha)
+        if (ALREADY_STORED):
+            os.unlink(tmp_path)
+            return
+
+        mode = fsync_mode(repo)
+
+        if (mode == FSYNC_BATCH):
+            pending[sha] = tmp_path
+        else:
+            os.replace(tmp_path, path)
+
+            # The rename itself lives in the directory
+            if (mode == FSYNC_ALWAYS):
+                fsync_dir(os.path.dirname(path))
+
+        resolver_get(repo).object_added(sha)
 
-        # Read object type
-        x = raw.find(b' ')
-        fmt = raw[0:x]
-
-        # Read and validate object size
-        y = raw.find(b'\x00', x)
-        size = int(raw[x:y].decode("ascii"))
-        
-        LENGTH_NOT_MATCH = size != len(raw)-y-1
-        if (LENGTH_NOT_MATCH):
-            raise Exception(f"Malformed object {sha}: bad length")
-
-        # Pick constructor
-        match fmt:
-            case b'commit' : c = TeaCommit
-            case b'tree'   : c = TeaTree
-            case b'tag'    : c = TeaTag
-            case b'blob'   : c = TeaBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
-
-        # Call constructor and return object
-        return c(raw[y+1:])
+def object_flush(repo=None):
+    """
+    Make the objects written in batch mode durable with a single sync,
+    then move them into place. This must run before the index or a ref
+    may point to them. Without repo, flush every repository.
+    """
+
+    with pending_lock:
+        teadirs = [ repo.teadir ] if repo else list(pending_objects.keys())
+
+        for teadir in teadirs:
+            pending = pending_objects.pop(teadir, None)
+
+            if (not pending):
+                continue
+
+            objects_dir = os.path.join(teadir, "objects")
+            fs_sync(objects_dir)
+
+            for (sha, tmp_path) in pending.items():
+                prefix_dir = os.path.join(objects_dir, sha[0:2])
+                os.makedirs(prefix_dir, exist_ok=True)
+                os.replace(tmp_path, os.path.join(prefix_dir, sha[2:]))
 
 def object_write(obj, repo=None):
     # Serialize object data
@@ -55,13 +295,84 @@ def object_write(obj, repo=None):
     sha = hashlib.sha1(result).hexdigest()
 
     if (repo):
-        # Compute path
-        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+        path = object_path(repo, sha)
 
-        PATH_NOT_EXIST = not os.path.exists(path)
+        PATH_NOT_EXIST = not (os.path.exists(path) or pack_contains(repo, sha))
         if (PATH_NOT_EXIST):
-            with open(path, 'wb') as f:
-                f.write(zlib.compress(result))
+            (f, tmp_path) = object_tmp_open(repo)
+
+            try:
+                level = compression_level(compression_level_config(repo), data)
+                f.write(zlib.compress(result, level))
+                object_tmp_close(repo, f)
+            except:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+
+            object_tmp_commit(repo, tmp_path, sha)
+
+    return sha
+
+def object_write_stream(fd, fmt, size, repo=None):
+    """
+    Same as object_write, but for size bytes read from fd: the object is
+    hashed and compressed chunk by chunk into a temporary file, which is
+    then renamed into place. Memory use doesn't depend on the size.
+    """
+
+    header = fmt + b' ' + str(size).encode() + b'\x00'
+
+    hasher = hashlib.sha1(header)
+
+    if (repo):
+        level = compression_level_config(repo)
+        (out, tmp_path) = object_tmp_open(repo)
+    else:
+        out = None
+
+    # The compressor is only created once we have seen the first chunk,
+    # to pick its level
+    compressor = None
+
+    try:
+        remaining = size
+        while (remaining > 0):
+            chunk = fd.read(min(remaining, OBJECT_CHUNK_SIZE))
+
+            if (not chunk):
+                raise Exception(f"File shrank while hashing it: expected {size} bytes")
+
+            hasher.update(chunk)
+            if (out):
+                if (not compressor):
+                    compressor = zlib.compressobj(compression_level(level, chunk))
+                    out.write(compressor.compress(header))
+
+                out.write(compressor.compress(chunk))
+
+            remaining -= len(chunk)
+
+        if (fd.read(1)):
+            raise Exception(f"File grew while hashing it: expected {size} bytes")
+
+        if (out):
+            if (not compressor): # Empty file
+                compressor = zlib.compressobj(level)
+                out.write(compressor.compress(header))
+
+            out.write(compressor.flush())
+            object_tmp_close(repo, out)
+    except:
+        if (out):
+            out.close()
+            os.unlink(tmp_path)
+        raise
+
+    sha = hasher.hexdigest()
+
+    if (repo):
+        object_tmp_commit(repo, tmp_path, sha)
 
     return sha
 
@@ -80,22 +391,142 @@ def object_find(repo, name, fmt=None, follow=True):
         return sha
 
     while True:
-        obj = object_read(repo, sha)
-    
-        if (obj.fmt == fmt):
+        # Only the header is needed to know whether we're done
+        (obj_fmt, _) = object_info(repo, sha)
+
+        if (obj_fmt == fmt):
             return sha
 
         if (not follow):
             return None
 
         # Follow tags
-        if (obj.fmt == b'tag'):
-            sha = obj.kvlm[b'object'].decode('ascii')
-        elif (obj.fmt == b'commit' and fmt == b'tree'):
-            sha = obj.kvlm[b'tree'].decode('ascii')
+        if (obj_fmt == b'tag'):
+            sha = object_read(repo, sha).kvlm[b'object'].decode('ascii')
+        elif (obj_fmt == b'commit' and fmt == b'tree'):
+            sha = object_read(repo, sha).kvlm[b'tree'].decode('ascii')
         else:
             return None
 
+class TeaResolver(object):
+    """
+    Lookup tables for object_resolve: the sorted SHAs of each loose
+    object directory, listed the first time a hash falls into it.
+
+    Other processes may write objects and packs while we run (a
+    cat-file --batch can run for long): full hashes are looked up
+    directly, and a short one that matches nothing lists its directory
+    and the packs again.
+    """
+
+    repo = None
+    loose = None
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.loose = dict()
+        self.lock = threading.Lock()
+
+    def loose_list(self, prefix):
+        """
+        Sorted SHAs of the loose objects in directory objects/prefix.
+        """
+
+        if (not prefix in self.loose):
+            path = repo_dir(self.repo, 'objects', prefix, mkdir=False)
+
+            shas = set()
+
+            if (path):
+                shas.update(prefix + f for f in os.listdir(path))
+
+            # Objects waiting for object_flush aren't in there yet
+            pending = pending_objects.get(self.repo.teadir, dict())
+            shas.update(sha for sha in pending if sha.startswith(prefix))
+
+            self.loose[prefix] = sorted(shas)
+
+        return self.loose[prefix]
+
+    def hashes(self, name):
+        """
+        Return every object SHA that starts with name.
+        """
+
+        if (len(name) == 40):
+            return [ name ] if self.contains(name) else []
+
+        ret = self.hashes_listed(name)
+
+        if (not ret):
+            # Maybe written since we listed them
+            self.loose.pop(name[0:2], None)
+            self.repo.packs = None
+            ret = self.hashes_listed(name)
+
+        return ret
+
+    def hashes_listed(self, name):
+        ret = list()
+
+        shas = self.loose_list(name[0:2])
+        i = bisect.bisect_left(shas, name)
+
+        while (i < len(shas) and shas[i].startswith(name)):
+            ret.append(shas[i])
+            i += 1
+
+        # Packed objects
+        for pack in pack_list(self.repo):
+            for sha in pack.prefix_lookup(name):
+                if (not sha in ret):
+                    ret.append(sha)
+
+        return ret
+
+    def contains(self, sha):
+        """
+        Whether object sha exists, loose (flushed or not) or packed.
+        """
+
+        if (os.path.exists(object_path(self.repo, sha)) or pack_contains(self.repo, sha)):
+            return True
+
+        # Maybe packed since we opened the packs
+        self.repo.packs = None
+        return pack_contains(self.repo, sha)
+
+    def ref(self, ref):
+        """
+        Resolve ref (eg. refs/heads/main). Refs are read on every
+        lookup, since another process may move them; most names aren't
+        refs, and cost a single stat.
+        """
+
+        if (not os.path.isfile(repo_path(self.repo, ref))):
+            return None
+
+        return ref_resolve(self.repo, ref)
+
+    def object_added(self, sha):
+        with self.lock:
+            shas = self.loose.get(sha[0:2])
+
+            # Directories we haven't listed yet will see it when we do
+            if (shas is not None):
+                i = bisect.bisect_left(shas, sha)
+                if (i == len(shas) or shas[i] != sha):
+                    shas.insert(i, sha)
+
+# One resolver per repository (keyed by its .tea directory)
+resolvers = dict()
+
+def resolver_get(repo):
+    if (not repo.teadir in resolvers):
+        resolvers[repo.teadir] = TeaResolver(repo)
+
+    return resolvers[repo.teadir]
+
 def object_resolve(repo, name):
     """
     Resolve name to an object hash in a repo.
@@ -109,7 +540,7 @@ def object_resolve(repo, name):
     """
 
     candidates = list()
-    hashRE = re.compile(r'^[0-9A-Fa-f]{4,40}$')
+    resolver = resolver_get(repo)
 
     # Empty string? abort.
     if (not name.strip()):
@@ -120,28 +551,19 @@ def object_resolve(repo, name):
         return [ ref_resolve(repo, 'HEAD') ]
 
     # If it's a hex string, try for a hash
-    if (hashRE.match(name)):
+    if (HASH_RE.match(name)):
         # This may be a hash, either small or full. 4 seems to be the
         # minimal length for tea to consider something a short hash.
         # This limit is documented in man tea-rev-parse
         name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, 'objects', prefix, mkdir=False)
-
-        if (path):
-            rem = name[2:]
-            for f in os.listdir(path):
-                if (f.startswith(rem)):
-                    # Notice a string startswit() itself, so this
-                    # works for full hashes
-                    candidates.append(prefix + f)
+        candidates += resolver.hashes(name)
 
     # Try for references.
-    as_tag = ref_resolve(repo, 'refs/tags/' + name)
+    as_tag = resolver.ref('refs/tags/' + name)
     if (as_tag): # Check if tag is found
         candidates.append(as_tag)
 
-    as_branch = ref_resolve(repo, 'refs/heads/' + name)
+    as_branch = resolver.ref('refs/heads/' + name)
     if (as_branch): # Check if branch is found
         candidates.append(as_branch)
 
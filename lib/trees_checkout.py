@@ -1,39 +1,57 @@
+import re
+
 class TeaTreeLeaf(object):
-    def __init__(self, mode, path, sha):
+    # Leaves parsed from a tree keep the raw 20-byte SHA, and only
+    # convert it to hex when sha is first used; leaves built from hex
+    # SHAs (eg. from the index) do the opposite for raw_sha. Either is
+    # given, not both: __getattr__ is only called for the empty one.
+    __slots__ = ('mode', 'path', 'sha', 'raw_sha')
+
+    def __init__(self, mode, path, sha=None, raw_sha=None):
+        assert sha is not None or raw_sha is not None
+
         self.mode = mode
         self.path = path
-        self.sha  = sha
 
-# [6-MODE] space [PATH] 0x00 [20-SHA-1]
-def tree_parse_one(raw, start=0):
-    # Find the space terminator
-    x = raw.find(b' ', start)
-
-    assert x-start == 5 or x-start == 6
+        if (sha is not None):
+            self.sha = sha
+        if (raw_sha is not None):
+            self.raw_sha = raw_sha
 
-    # Read the mode
-    mode = raw[start:x]
-    if (len(mode) == 5):
-        mode = b" " + mode
+    def __getattr__(self, attr):
+        if (attr == 'sha'):
+            self.sha = self.raw_sha.hex()
+            return self.sha
 
-    # Find the NULL terminator
-    y = raw.find(b'\x00', x)
-    # read the path
-    path = raw[x+1:y]
+        if (attr == 'raw_sha'):
+            self.raw_sha = bytes.fromhex(self.sha)
+            return self.raw_sha
 
-    # Read the SHA and convert to a hex string
-    sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
+        raise AttributeError(attr)
 
-    return (y+21, TeaTreeLeaf(mode, path.decode("utf8"), sha))
+# [6-MODE] space [PATH] 0x00 [20-SHA-1]
+TREE_LEAF = re.compile(rb"([0-7]{5,6}) ([^\x00]*)\x00(.{20})", re.DOTALL)
 
 def tree_parse(raw):
+    """
+    Parse all the leaves of a tree at once. The regex does the scanning
+    over a memoryview of raw, so only the fields themselves are copied.
+    """
+
     pos = 0
-    max = len(raw)
     ret = list()
 
-    while (pos < max):
-        pos, data = tree_parse_one(raw, pos)
-        ret.append(data)
+    for (mode, path, sha) in TREE_LEAF.findall(memoryview(raw)):
+        # Anything the regex skipped shows up as a length mismatch
+        pos += len(mode) + len(path) + 22
+
+        if (len(mode) == 5):
+            mode = b" " + mode
+
+        ret.append(TeaTreeLeaf(mode, path.decode("utf8"), raw_sha=sha))
+
+    if (pos != len(raw)):
+        raise Exception("Malformed tree")
 
     return ret
 
@@ -46,13 +64,4 @@ def tree_leaf_sort_key(leaf):
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
 
-    ret = b''
-    for i in obj.items:
-        ret += i.mode
-        ret += b' '
-        ret += i.path.encode("utf8")
-        ret += b'\x00'
-        sha = int(i.sha, 16)
-        ret += sha.to_bytes(20, byteorder="big")
-
-    return ret
+    return b"".join([ b"%s %s\x00%s" % (i.mode, i.path.encode("utf8"), i.raw_sha) for i in obj.items ])
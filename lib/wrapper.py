@@ -1,19 +1,81 @@
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
-from lib.repo_functions import repo_file
-from lib.tea_object_function import object_find, object_read, object_write
+from lib.compression import compression_level_config
+from lib.pack import PACK_DEFAULT_DEPTH, PACK_DEFAULT_WINDOW, pack_list, pack_write
+from lib.repo_functions import repo_dir, repo_file, repo_jobs
+from lib.tea_object_function import object_find, object_flush, object_info, object_loose_list, object_read, object_read_into, object_read_raw, object_resolve, object_write, object_write_stream
 from lib.tea_object import TeaBlob, TeaCommit, TeaTag, TeaTree
+from lib.trees_checkout import tree_leaf_sort_key
 
 def cat_file(repo, obj, fmt=None):
     obj = object_read(repo, object_find(repo, obj, fmt=fmt))
     sys.stdout.buffer.write(obj.serialize())
 
+def cat_file_batch(repo, stream, out, contents=True, flush=True):
+    """
+    Read object names from stream, one per line, and write for each one
+    "<sha> <type> <size>" followed, if contents is true, by the object
+    itself and a newline. Unknown and ambiguous names are reported as
+    "<name> missing" and "<name> ambiguous".
+    """
+
+    for line in stream:
+        name = line.rstrip(b'\r\n').decode("utf8")
+
+        candidates = object_resolve(repo, name) if name.strip() else None
+
+        if (not candidates or candidates[0] is None):
+            out.write(f"{name} missing\n".encode("utf8"))
+        elif (len(candidates) > 1):
+            out.write(f"{name} ambiguous\n".encode("utf8"))
+        else:
+            sha = candidates[0]
+
+            if (contents):
+                raw = object_read_raw(repo, sha)
+                info = (raw[0], len(raw[1])) if raw else None
+            else:
+                info = object_info(repo, sha)
+
+            if (not info):
+                out.write(f"{name} missing\n".encode("utf8"))
+            else:
+                out.write(f"{sha} {info[0].decode('ascii')} {info[1]}\n".encode("ascii"))
+
+                if (contents):
+                    out.write(raw[1])
+                    out.write(b'\n')
+
+        # Tools talking to us through a pipe need each answer right away
+        if (flush):
+            out.flush()
+
+    out.flush()
+
+def cat_file_info(repo, obj, size=False):
+    """
+    Print the type (or the size) of an object, reading only its header.
+    """
+
+    (fmt, obj_size) = object_info(repo, object_find(repo, obj))
+
+    if (size):
+        print(obj_size)
+    else:
+        print(fmt.decode("ascii"))
+
 def hash_object(fd, fmt, repo=None):
     """
     Hash object, writing it to repo if provided.
     """
 
+    # Blobs need no parsing, so they are streamed: big files are never
+    # loaded in memory.
+    if (fmt == b'blob'):
+        return object_write_stream(fd, fmt, os.fstat(fd.fileno()).st_size, repo)
+
     data = fd.read()
 
     # Choose constructor according to fmt argument
@@ -85,18 +147,186 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
         else:
             ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
-def tree_checkout(repo, tree, path):
+def tree_leaf_mode(leaf):
+    """ The mode of leaf as git prints it, six digits. """
+    return leaf.mode.decode('ascii').strip().zfill(6)
+
+def tree_diff(repo, a, b, recursive=False, prefix=""):
+    """
+    Compare trees a and b, given by SHA (None being the empty tree).
+    Yield a (status, path, old leaf, new leaf) tuple per difference, in
+    path order; status is "A", "D" or "M", and the missing leaf None.
+
+    Both trees are walked side by side, in their sort order; subtrees
+    with the same SHA on both sides are never read. Other subtrees are
+    reported as a whole, or descended into if recursive.
+    """
+
+    old = object_read(repo, a).items if a else []
+    new = object_read(repo, b).items if b else []
+
+    i = j = 0
+
+    while (i < len(old) or j < len(new)):
+        old_key = tree_leaf_sort_key(old[i]) if i < len(old) else None
+        new_key = tree_leaf_sort_key(new[j]) if j < len(new) else None
+
+        if (new_key is None or (old_key is not None and old_key < new_key)):
+            (status, old_leaf, new_leaf) = ("D", old[i], None)
+            i += 1
+        elif (old_key is None or new_key < old_key):
+            (status, old_leaf, new_leaf) = ("A", None, new[j])
+            j += 1
+        else:
+            (status, old_leaf, new_leaf) = ("M", old[i], new[j])
+            i += 1
+            j += 1
+
+            if (old_leaf.raw_sha == new_leaf.raw_sha and old_leaf.mode == new_leaf.mode):
+                continue
+
+        path = (new_leaf or old_leaf).path
+        path = f"{prefix}/{path}" if prefix else path
+
+        if (recursive):
+            old_tree = old_leaf.sha if old_leaf and old_leaf.mode.startswith(b'04') else None
+            new_tree = new_leaf.sha if new_leaf and new_leaf.mode.startswith(b'04') else None
+
+            if (old_tree or new_tree):
+                # A subtree replacing something else, or the reverse
+                if (old_leaf and not old_tree):
+                    yield ("D", path, old_leaf, None)
+                if (new_leaf and not new_tree):
+                    yield ("A", path, None, new_leaf)
+
+                yield from tree_diff(repo, old_tree, new_tree, recursive, path)
+                continue
+
+        yield (status, path, old_leaf, new_leaf)
+
+def diff_tree(repo, a, b, recursive=False):
+    a = object_find(repo, a, fmt=b"tree")
+    b = object_find(repo, b, fmt=b"tree")
+
+    for (status, path, old_leaf, new_leaf) in tree_diff(repo, a, b, recursive):
+        print(":{0} {1} {2} {3} {4}\t{5}".format(
+            tree_leaf_mode(old_leaf) if old_leaf else "000000",
+            tree_leaf_mode(new_leaf) if new_leaf else "000000",
+            old_leaf.sha if old_leaf else "0" * 40,
+            new_leaf.sha if new_leaf else "0" * 40,
+            status,
+            path)
+        )
+
+# Files written by a checkout worker in one go
+CHECKOUT_BATCH_SIZE = 256
+
+def tree_checkout(repo, tree, path, jobs=None):
+    """
+    Write the files of tree under path, an existing directory. Return
+    the (sha, path, stat) of the files written, in tree order.
+
+    Directories are all created first, from the trees alone; blobs are
+    then inflated straight into their files, by checkout.jobs threads
+    (zlib and file writes release the GIL).
+    """
+
+    files = list()
+    tree_checkout_dirs(repo, tree, path, files)
+    stats = tree_checkout_write(repo, files, jobs)
+
+    return [ (sha, dest, stat) for ((sha, dest), stat) in zip(files, stats) ]
+
+def tree_checkout_write(repo, files, jobs=None):
+    """
+    Write files, (sha, path) pairs, whose directories exist, with
+    checkout.jobs threads. Return the files' stat, in the same order.
+    """
+
+    # Packs are opened lazily, once per repository: not from threads
+    pack_list(repo)
+
+    # Handing files to the workers one at a time would cost more than
+    # writing most of them
+    batches = [ files[i:i + CHECKOUT_BATCH_SIZE] for i in range(0, len(files), CHECKOUT_BATCH_SIZE) ]
+
+    stats = list()
+
+    with ThreadPoolExecutor(max_workers=repo_jobs(repo, "checkout", jobs)) as pool:
+        # Consuming the results raises the workers' exceptions
+        for batch_stats in pool.map(lambda batch: tree_checkout_files(repo, batch), batches):
+            stats += batch_stats
+
+    return stats
+
+def tree_checkout_dirs(repo, tree, path, files):
+    """
+    Create the directories of tree under path, and list its files.
+    """
+
     for item in tree.items:
-        obj = object_read(repo, item.sha)
         dest = os.path.join(path, item.path)
 
-        if (obj.fmt == b'tree'):
+        # The leaf mode tells us what the object is, no need to read it
+        # just to find out.
+        if (item.mode.startswith(b'04')):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif (obj.fmt == b'blob'):
+            tree_checkout_dirs(repo, object_read(repo, item.sha), dest, files)
+        elif (item.mode.startswith(b'10') or item.mode.startswith(b'12')):
             # @TODO Support symlinks (identified by mode 12****)
-            with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+            files.append((item.sha, dest))
+
+def tree_checkout_files(repo, files):
+    stats = list()
+
+    for (sha, dest) in files:
+        with open(dest, 'wb') as f:
+            if (not object_read_into(repo, sha, f)):
+                raise Exception(f"Missing object {sha} for {dest}")
+
+            # Once flushed, the file won't change anymore: its stat is
+            # what the index needs, without a second lookup by name.
+            f.flush()
+            stats.append(os.fstat(f.fileno()))
+
+    return stats
+
+def repack(repo):
+    """
+    Move every loose object into a new pack, then delete the loose copies.
+    """
+
+    object_flush(repo)
+
+    shas = object_loose_list(repo)
+
+    if (not shas):
+        print("Nothing new to pack.")
+        return None
+
+    # Only the headers are read now: pack_write reads the data as it
+    # goes, so that big blobs never sit in memory.
+    objects = [ (sha, *object_info(repo, sha)) for sha in shas ]
+
+    window = repo.conf.getint("pack", "window", fallback=PACK_DEFAULT_WINDOW)
+    depth = repo.conf.getint("pack", "depth", fallback=PACK_DEFAULT_DEPTH)
+
+    level = compression_level_config(repo, loose=False)
+
+    path = pack_write(repo, objects, lambda sha, out: object_read_into(repo, sha, out),
+                      window=window, depth=depth, level=level)
+
+    # The pack is safely in place (and durable, with core.fsync): the
+    # loose objects are now redundant.
+    for sha in shas:
+        os.unlink(repo_file(repo, "objects", sha[0:2], sha[2:]))
+
+        prefix_dir = repo_dir(repo, "objects", sha[0:2])
+        if (not os.listdir(prefix_dir)):
+            os.rmdir(prefix_dir)
+
+    print(f"Packed {len(shas)} objects into {os.path.basename(path)}")
+    return path
 
 def show_ref(repo, refs, with_hash=True, prefix=''):
     for k, v in refs.items():
@@ -128,4 +358,4 @@ def cmd_status_branch(repo):
     if (branch):
         print(f"On branch {branch}")
     else:
-        print("HEAD detached at {object_find(repo, 'HEAD')}")
+        print(f"HEAD detached at {object_find(repo, 'HEAD')}")